@@ -0,0 +1,174 @@
+"""Measures the memory a live task takes in the backend.
+
+Builds `--tasks` tasks the way the HTTP handlers do, moves each of them
+through the statuses of a completed task and reports the bytes allocated
+per task, as traced by tracemalloc. The tasks are built both in the layout
+they had before the slots and the packed status log, and as they are now.
+
+    python benchmarks/memory_benchmark.py --tasks 100000
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from dispatcher.task import TaskLog, build_task_from_query
+from dispatcher.task_info import ScheduledPayload, TaskStatus, TaskStatusPayload
+
+MODELS = ["sdxl", "sd15", "flux"]
+PIPELINE = json.dumps({
+    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "sdxl"}},
+    "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "a lighthouse at dusk"}},
+})
+
+
+# The task records before they used slots, with a list of TaskLog entries
+# as the status log
+@dataclass
+class ComfyPipelineOptionsBefore:
+    pipeline_data: str
+    pipeline_dependencies: str
+
+
+@dataclass
+class StandardPipelineOptionsBefore:
+    prompt: str
+    model: str
+    size: Optional[str] = None
+    steps: Optional[int] = None
+
+
+@dataclass
+class TaskOptionsBefore:
+    comfy_pipeline: Optional[ComfyPipelineOptionsBefore] = None
+    standard_pipeline: Optional[StandardPipelineOptionsBefore] = None
+
+
+@dataclass
+class TaskInfoBefore:
+    id: str
+    max_cost: int
+    time_to_money_ratio: int
+    task_options: Optional[TaskOptionsBefore] = None
+    priority: int = 0
+    gpu_type: Optional[str] = None
+
+
+@dataclass(kw_only=True)
+class TaskStatusPayloadBefore:
+    task_status: TaskStatus
+
+
+@dataclass(kw_only=True)
+class ScheduledPayloadBefore(TaskStatusPayloadBefore):
+    provider_id: str
+    min_score: int | float
+    waiting_time: int | float
+    task_status: TaskStatus = TaskStatus.SCHEDULED
+
+
+class TaskBefore:
+    def __init__(self, task_info: TaskInfoBefore):
+        self._provider_id = None
+        self._status = TaskStatus.UNSCHEDULED
+        self._log: list[TaskLog] = list()
+        self._task_info = task_info
+        self._priority = task_info.priority
+        self._created_at = datetime.now()
+        self._required_models = None
+
+    def set_status(self, task_status_payload: TaskStatusPayloadBefore) -> None:
+        self._status = task_status_payload.task_status
+        self._log.append(
+            TaskLog(date=datetime.now(), task_status_payload=task_status_payload))
+        if isinstance(task_status_payload, ScheduledPayloadBefore):
+            self._provider_id = task_status_payload.provider_id
+
+
+def build_task_before(task_id: str, **kwargs) -> TaskBefore:
+    standard_pipeline = kwargs.get('standard_pipeline')
+    comfy_pipeline = kwargs.get('comfy_pipeline')
+    return TaskBefore(TaskInfoBefore(
+        id=task_id,
+        max_cost=kwargs.get('max_cost'),
+        time_to_money_ratio=kwargs.get('time_to_money_ratio'),
+        priority=kwargs.get('priority', 0),
+        gpu_type=kwargs.get('gpu_type'),
+        task_options=TaskOptionsBefore(
+            standard_pipeline=StandardPipelineOptionsBefore(
+                **standard_pipeline) if standard_pipeline else None,
+            comfy_pipeline=ComfyPipelineOptionsBefore(
+                pipeline_data=comfy_pipeline.get('pipelineData'),
+                pipeline_dependencies=comfy_pipeline.get('pipelineDependencies'),
+            ) if comfy_pipeline else None)))
+
+
+def complete_task_before(task: TaskBefore) -> None:
+    task.set_status(TaskStatusPayloadBefore(task_status=TaskStatus.QUEUED))
+    task.set_status(ScheduledPayloadBefore(
+        provider_id="provider", min_score=1.5, waiting_time=2.5))
+    task.set_status(TaskStatusPayloadBefore(task_status=TaskStatus.SENT))
+    task.set_status(TaskStatusPayloadBefore(task_status=TaskStatus.COMPLETED))
+
+
+def complete_task(task) -> None:
+    task.set_status(TaskStatusPayload(task_status=TaskStatus.QUEUED))
+    task.set_status(ScheduledPayload(
+        provider_id="provider", min_score=1.5, waiting_time=2.5))
+    task.set_status(TaskStatusPayload(task_status=TaskStatus.SENT))
+    task.set_status(TaskStatusPayload(task_status=TaskStatus.COMPLETED))
+
+
+def build_tasks(count: int, comfy: bool, build=build_task_from_query, complete=complete_task) -> list:
+    tasks = list()
+    for i in range(count):
+        # Every request body is parsed into new strings
+        query = {
+            "max_cost": 15,
+            "time_to_money_ratio": 1,
+            "gpu_type": "rtx4090",
+        }
+        if comfy:
+            query["comfy_pipeline"] = {"pipelineData": PIPELINE, "pipelineDependencies": "{}"}
+        else:
+            query["standard_pipeline"] = {
+                "prompt": "a lighthouse at dusk", "model": MODELS[i % len(MODELS)]}
+        task = build(str(i), **json.loads(json.dumps(query)))
+        complete(task)
+        tasks.append(task)
+    return tasks
+
+
+def measure(count: int, comfy: bool, *layout) -> float:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tasks = build_tasks(count, comfy, *layout)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del tasks
+    return (after - before) / count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=100000)
+    args = parser.parse_args()
+
+    for name, comfy in (("standard", False), ("comfy", True)):
+        before = measure(args.tasks, comfy, build_task_before, complete_task_before)
+        after = measure(args.tasks, comfy)
+        print("{name:>9}: before {before:8.0f} bytes/task, after {after:8.0f} bytes/task ({ratio:.1f}x)".format(
+            name=name, before=before, after=after, ratio=before / after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Measures how many node messages a connection decodes and validates per
+second.
+
+Runs a mix of `result`, `error` and `status` frames, as a node sends them,
+through the decoding of the WebSocket handler before and after the schemas
+were compiled once, and reports messages per second for both.
+
+    python benchmarks/message_benchmark.py --messages 100000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+# The schemas are loaded relative to the backend directory
+os.chdir(os.path.join(os.path.dirname(__file__), ".."))
+
+import jsonschema
+
+from constants.static import TASK_RESULT_SCHEMA
+from messages import TASK_RESULT_VALIDATOR, decode_message, orjson, schema_error
+
+
+def build_frames(count: int) -> list[str]:
+    frames = list()
+    for i in range(count):
+        task_id = f"3f1c2a9e-{i:012d}"
+        if i % 3 == 0:
+            message = {"type": "status", "taskId": task_id, "status": "inProgress"}
+        elif i % 10 == 1:
+            message = {"type": "error", "taskId": task_id, "resultsUrl": [],
+                       "error": "CUDA out of memory"}
+        else:
+            message = {"type": "result", "taskId": task_id, "status": "ready",
+                       "resultsUrl": [f"https://cdn.example.com/{task_id}/{n}.png" for n in range(4)]}
+        frames.append(json.dumps(message))
+    return frames
+
+
+def decode_before(frame: str) -> None:
+    message = json.loads(frame)
+    if message.get("type") in ("result", "error"):
+        try:
+            jsonschema.validate(instance=message, schema=TASK_RESULT_SCHEMA)
+        except Exception:
+            pass
+
+
+def decode_after(frame: str) -> None:
+    message = decode_message(frame)
+    if message.get("type") in ("result", "error"):
+        schema_error(TASK_RESULT_VALIDATOR, message)
+
+
+def measure(decode, frames: list[str]) -> float:
+    start = time.perf_counter()
+    for frame in frames:
+        decode(frame)
+    return len(frames) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100000)
+    args = parser.parse_args()
+
+    frames = build_frames(args.messages)
+    before = measure(decode_before, frames)
+    after = measure(decode_after, frames)
+    print(f"parser: {'orjson' if orjson is not None else 'json'}")
+    print(f"before: {before:,.0f} messages/s")
+    print(f"after:  {after:,.0f} messages/s ({after / before:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
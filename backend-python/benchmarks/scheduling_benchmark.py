@@ -0,0 +1,91 @@
+"""Measures the cost of picking a provider in `Dispatcher._schedule_task`.
+
+Compares the indexed dispatcher with the previous linear scan over every
+registered provider. Tasks are completed in FIFO order once the fleet holds
+`--in-flight` tasks per provider, so the load keeps changing during the run.
+
+    python benchmarks/scheduling_benchmark.py --providers 1000 --tasks 100000
+"""
+import argparse
+import asyncio
+import collections
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from dispatcher.dispatcher import Dispatcher
+from dispatcher.meta_info import PrivateMetaInfo, PublicMetaInfo
+from dispatcher.network_connection import NetworkConnection
+from dispatcher.provider import Provider
+from dispatcher.task import Task
+from dispatcher.task_info import ScheduledPayload, TaskInfo
+
+MAX_PROVIDER_QUEUE_LEN = 50
+
+
+class LinearScanDispatcher(Dispatcher):
+    async def _schedule_task(self, task: Task) -> bool:
+        least_busy_id = None
+        min_queue_length = MAX_PROVIDER_QUEUE_LEN
+        for provider in self.providers.values():
+            if provider.queue_length > MAX_PROVIDER_QUEUE_LEN or not provider.is_online:
+                continue
+            if least_busy_id is None or provider.queue_length < min_queue_length:
+                least_busy_id = provider.id
+                min_queue_length = provider.queue_length
+
+        if least_busy_id is None:
+            return False
+
+        task.set_status(ScheduledPayload(
+            provider_id=least_busy_id,
+            min_score=0,
+            waiting_time=self.providers[least_busy_id].waiting_time
+        ))
+        await self.providers[least_busy_id].schedule_task(task)
+        return True
+
+
+async def run(dispatcher: Dispatcher, providers: int, tasks: int, in_flight: int) -> float:
+    pub_meta_info = PublicMetaInfo(models=[], gpu_type="gpu1", ncpu=8, ram=32)
+    for i in range(providers):
+        dispatcher.add_provider(Provider(
+            str(i), pub_meta_info, PrivateMetaInfo(), NetworkConnection()))
+
+    scheduled = collections.deque()
+    elapsed = 0.0
+    for i in range(tasks):
+        task = Task(TaskInfo(id=str(i), max_cost=15, time_to_money_ratio=1))
+        start = time.perf_counter()
+        await dispatcher.add_task(task)
+        elapsed += time.perf_counter() - start
+        # Tasks are sent by the writers of the providers, a provider with a
+        # full outbox gets no more tasks, so the writers run outside of the
+        # measured time before the assignments are read
+        await asyncio.sleep(0)
+        scheduled.append(task)
+        if len(scheduled) > providers * in_flight:
+            done = scheduled.popleft()
+            start = time.perf_counter()
+            dispatcher.providers[done.provider_id].task_completed(done)
+            elapsed += time.perf_counter() - start
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--providers", type=int, default=1000)
+    parser.add_argument("--tasks", type=int, default=100000)
+    parser.add_argument("--in-flight", type=int, default=10)
+    args = parser.parse_args()
+
+    for name, dispatcher_cls in (("linear scan", LinearScanDispatcher), ("indexed", Dispatcher)):
+        elapsed = asyncio.run(run(dispatcher_cls(), args.providers, args.tasks, args.in_flight))
+        print("{name:>12}: {total:8.2f} s total, {per_task:8.2f} us/task".format(
+            name=name, total=elapsed, per_task=elapsed / args.tasks * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Compares the storage engines behind `StorageManager`.
+
+Submits `--tasks` tasks from `--concurrency` concurrent clients, then stores
+a result and reads every task back, as the HTTP handlers do. With
+`--cache-size` the engines are used through a `TaskCache` of that size.
+
+    python benchmarks/storage_benchmark.py --engines memory sqlite --tasks 10000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from dispatcher.task import Task
+from dispatcher.task_info import TaskInfo
+from storage import StorageManager, TaskCache, create_storage_engine
+from storage.sqlite_engine import SQLiteStorageEngine
+
+
+async def run(manager: StorageManager, tasks: int, concurrency: int, users: int) -> dict[str, float]:
+    async def client(first: int, operation):
+        for i in range(first, tasks, concurrency):
+            await operation(i)
+
+    async def add_task(i: int):
+        await manager.add_task(i % users, str(i), Task(
+            TaskInfo(id=str(i), max_cost=15, time_to_money_ratio=1)))
+
+    async def add_result(i: int):
+        await manager.add_result(str(i), "https://results/{i}.png".format(i=i))
+
+    async def get_task(i: int):
+        await manager.get_task_data_with_verification(i % users, str(i))
+
+    elapsed = dict()
+    for name, operation in (("add_task", add_task), ("add_result", add_result), ("get_task", get_task)):
+        start = time.perf_counter()
+        await asyncio.gather(*(client(first, operation) for first in range(concurrency)))
+        elapsed[name] = time.perf_counter() - start
+    await manager.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engines", nargs="+", default=["memory", "sqlite"])
+    parser.add_argument("--tasks", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--cache-size", type=int, default=0)
+    args = parser.parse_args()
+
+    for name in args.engines:
+        with tempfile.TemporaryDirectory() as directory:
+            if name == "sqlite":
+                engine = SQLiteStorageEngine(os.path.join(directory, "tasks.db"))
+            else:
+                engine = create_storage_engine(name)
+            cache = TaskCache(size=args.cache_size) if args.cache_size > 0 else None
+            elapsed = asyncio.run(
+                run(StorageManager(engine, cache), args.tasks, args.concurrency, args.users))
+        for operation, seconds in elapsed.items():
+            print("{name:>8} {operation:>10}: {total:8.2f} s total, {per_task:8.2f} us/task".format(
+                name=name, operation=operation, total=seconds, per_task=seconds / args.tasks * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,448 @@
+from constants.env import (
+    HEARTBEAT_INTERVAL,
+    HEARTBEAT_TIMEOUT,
+    JOURNAL_PATH,
+    RESULT_CACHE_SIZE,
+    RESULT_CACHE_TTL,
+    RESULT_FOLLOW_TIMEOUT,
+    TASK_RECLAIM_TIMEOUT,
+)
+
+from dispatcher.util.logger import logger
+from dispatcher.dispatcher import Dispatcher
+from dispatcher.meta_info import PrivateMetaInfo, PublicMetaInfo
+from dispatcher.provider import Provider
+from dispatcher.task import Task, build_task_from_query, restore_task
+from dispatcher.task_info import TaskInfo, TaskStatus, TaskStatusPayload
+
+from blob_store import BlobStore
+from heartbeat import HEARTBEAT_FEATURE, Heartbeat
+from journal import TaskJournal, replay_journal
+from messages import TASK_RESULT_VALIDATOR, schema_error
+from result_cache import ResultCache, pipeline_key
+from storage import MemoryStorageEngine, StorageManager, TaskCache, UsersStorage, create_storage_engine
+from ws_connection import WSConnection, encode_task
+
+from typing import Any, Awaitable, Callable, Iterable, Optional
+import asyncio
+import uuid
+
+
+def parse_public_meta_info(metadata: dict) -> PublicMetaInfo:
+    return PublicMetaInfo(
+        models=metadata.get("models", []),
+        gpu_type=metadata.get("gpu_type", ""),
+        ncpu=metadata.get("ncpu", 0),
+        ram=metadata.get("ram", 0),
+        price=metadata.get("price", 0),
+        credits=metadata.get("credits")
+    )
+
+
+def _find_task_blob(tasks: Iterable[Task], blob_hash: str) -> Optional[Any]:
+    for task in tasks:
+        pipeline = task.task_options.comfy_pipeline if task.task_options else None
+        if pipeline is None:
+            continue
+        if pipeline.pipeline_data_hash == blob_hash:
+            return pipeline.pipeline_data
+        if pipeline.pipeline_dependencies_hash == blob_hash:
+            return pipeline.pipeline_dependencies
+    return None
+
+
+class Backend:
+    """State shared by the HTTP and WebSocket handlers: the dispatcher, the
+    storages and the connected nodes.
+
+    `run.py` talks to it only through these coroutines, so in the multi
+    worker mode the same calls are forwarded to the broker process owning
+    the single `Backend` (see `broker.py`).
+    """
+
+    def __init__(
+            self,
+            journal_path: str = JOURNAL_PATH,
+            result_cache_size: int = RESULT_CACHE_SIZE,
+            heartbeat_interval: float = HEARTBEAT_INTERVAL,
+            heartbeat_timeout: float = HEARTBEAT_TIMEOUT,
+            result_follow_timeout: float = RESULT_FOLLOW_TIMEOUT,
+    ):
+        self.dispatcher = Dispatcher()
+        engine = create_storage_engine()
+        # The memory engine holds the tasks themselves already
+        self.storage_manager = StorageManager(
+            engine, None if isinstance(engine, MemoryStorageEngine) else TaskCache())
+        self.users_storage = UsersStorage()
+        self.blob_store = BlobStore()
+        self.result_cache: Optional[ResultCache] = ResultCache(
+            result_cache_size, RESULT_CACHE_TTL) if result_cache_size > 0 else None
+        self._result_follow_timeout = result_follow_timeout
+        # id of a task waiting for an identical task -> its wait for a result
+        self._follow_futures: dict[str, asyncio.Future] = dict()
+        # node id -> connection object the node is reachable through
+        self._nodes: dict[str, Any] = dict()
+        self._result_listeners: list[Callable[[str, dict], None]] = list()
+        self.heartbeat = Heartbeat(heartbeat_interval, heartbeat_timeout)
+        self.heartbeat.set_on_silent(self._node_silent)
+        # message type -> coroutine handling the messages of that type
+        self._message_handlers: dict[str, Callable[[str, Optional[Provider], dict], Awaitable[None]]] = {
+            "result": self._handle_result,
+            "error": self._handle_result,
+            "status": self._handle_status,
+            "blob": self._handle_blob_request,
+            "credits": self._handle_credits,
+            "pong": self._handle_pong,
+        }
+        self._journal_path = journal_path
+        self._journal: Optional[TaskJournal] = None
+
+    def add_result_listener(self, callback: Callable[[str, dict], None]) -> None:
+        """Calls `callback(task_id, message)` for every result or error
+        message received from a node."""
+        self._result_listeners.append(callback)
+
+    async def start(self) -> None:
+        """Recovers the tasks not done when the backend last stopped."""
+        if not self._journal_path:
+            return
+
+        tasks = replay_journal(self._journal_path)
+        self._journal = TaskJournal(self._journal_path)
+        self._journal.open(tasks)
+
+        reclaimable: dict[str, list[Task]] = dict()
+        unscheduled: list[Task] = list()
+        for task_id, journaled in tasks.items():
+            info = TaskInfo.from_dict(journaled.info)
+            if info.task_options is not None and info.task_options.comfy_pipeline is not None:
+                self.blob_store.add_pipeline(info.task_options.comfy_pipeline)
+            task = restore_task(info, journaled.status,
+                                journaled.provider_id, journaled.submitted_at)
+            encode_task(task)
+            task.set_on_status_changed(self._task_status_changed)
+            await self.storage_manager.add_task(journaled.user_id, task_id, task)
+            # The node may still be working on the task, it gets the task
+            # back if it registers again in time
+            if journaled.provider_id is not None and journaled.status in (
+                    TaskStatus.SCHEDULED, TaskStatus.SENT):
+                reclaimable.setdefault(journaled.provider_id, []).append(task)
+            else:
+                unscheduled.append(task)
+
+        logger.info(f"Recovered {len(tasks)} tasks from the journal")
+        self.dispatcher.reclaim_tasks(reclaimable, TASK_RECLAIM_TIMEOUT)
+        for task in unscheduled:
+            await self.dispatcher.add_task(task)
+
+    async def close(self) -> None:
+        for future in self._follow_futures.values():
+            future.cancel()
+        self.heartbeat.close()
+        await self.dispatcher.close()
+        await self.storage_manager.close()
+        if self._journal is not None:
+            self._journal.close()
+
+    async def available_nodes(self) -> int:
+        return len(self._nodes)
+
+    async def add_task(self, token: Optional[str], task_query: dict) -> str:
+        return (await self.add_tasks(token, [task_query]))[0]
+
+    async def add_tasks(self, token: Optional[str], task_queries: list[dict]) -> list[str]:
+        """Adds the tasks of one user with a single storage write and
+        scheduling pass, returns their ids in the order of the queries."""
+        user_id = self.users_storage.get_user_id(token)
+        tasks = list()
+        for task_query in task_queries:
+            task = build_task_from_query(str(uuid.uuid4()), **task_query)
+            if task.task_options.comfy_pipeline is not None:
+                self.blob_store.add_pipeline(task.task_options.comfy_pipeline)
+            encode_task(task)
+            if self._journal is not None:
+                self._journal.task_submitted(user_id, task)
+            task.set_on_status_changed(self._task_status_changed)
+            tasks.append(task)
+        await self.storage_manager.add_tasks(user_id, tasks)
+
+        to_dispatch = list()
+        for task in tasks:
+            error = task.node_payload.error
+            if error is not None:
+                logger.error(f"Task {task.id} has invalid options: {error}")
+                await self._complete_task(task, {
+                    "type": "error", "taskId": task.id, "error": f"Invalid task options: {error}"})
+            elif not await self._take_cached_result(task, user_id):
+                to_dispatch.append(task)
+        await self.dispatcher.add_tasks(to_dispatch)
+        for task in to_dispatch:
+            if task.status == TaskStatus.FAILED:
+                await self.storage_manager.add_error(task.id, "Task queue is full")
+        return [task.id for task in tasks]
+
+    def _task_status_changed(self, task: Task, payload: TaskStatusPayload) -> None:
+        if self._journal is not None:
+            self._journal.task_status_changed(task, payload)
+        self.storage_manager.task_status_changed(task)
+        # A task the dispatcher drops never gets a result, the tasks
+        # waiting for its pipeline get its error. A task failed by its
+        # provider either reports the error or is scheduled again.
+        if (self.result_cache is not None and task.status == TaskStatus.FAILED
+                and type(payload) is TaskStatusPayload):
+            _, followers = self.result_cache.finish(task.id)
+            if followers:
+                asyncio.ensure_future(self._complete_followers(
+                    followers, {"type": "error", "error": "Task was dropped"}))
+
+    async def _take_cached_result(self, task: Task, user_id: int) -> bool:
+        """Returns True if the task is done with the result of the same
+        pipeline or waits for its execution, so it is not dispatched."""
+        if self.result_cache is None:
+            return False
+        key = pipeline_key(task, user_id)
+        if key is None:
+            return False
+        results_url = self.result_cache.get(key)
+        if results_url is not None:
+            await self._complete_task(
+                task, {"type": "result", "taskId": task.id, "resultsUrl": results_url})
+            return True
+        if self.result_cache.follow(key, task):
+            future = asyncio.ensure_future(self._stop_following(task))
+            self._follow_futures[task.id] = future
+            future.add_done_callback(
+                lambda _: self._follow_futures.pop(task.id, None))
+            return True
+        self.result_cache.start(key, task.id)
+        return False
+
+    async def _stop_following(self, task: Task) -> None:
+        """Dispatches the task itself if the identical task executing its
+        pipeline has no result within the follow timeout."""
+        await asyncio.sleep(self._result_follow_timeout)
+        if self.result_cache.unfollow(task):
+            logger.warning(
+                f"Task {task.id} waited too long for an identical task, dispatching it")
+            await self.dispatcher.add_task(task)
+
+    async def _complete_task(self, task: Task, message: dict) -> None:
+        """Ends a task not executed by a node with the result or error
+        `message` of the same pipeline."""
+        if message.get("type") == "result":
+            task.set_status(TaskStatusPayload(
+                task_status=TaskStatus.COMPLETED))
+            await self.storage_manager.add_result(task.id, message.get("resultsUrl"))
+        else:
+            task.set_status(TaskStatusPayload(task_status=TaskStatus.FAILED))
+            await self.storage_manager.add_error(task.id, message.get("error"))
+        for callback in self._result_listeners:
+            callback(task.id, message)
+
+    async def _finish_pipeline(self, task_id: str, message: dict) -> None:
+        key, followers = self.result_cache.finish(task_id)
+        if key is not None and message.get("type") == "result":
+            self.result_cache.put(key, message.get("resultsUrl"))
+        await self._complete_followers(followers, message)
+
+    async def _complete_followers(self, followers: list[Task], message: dict) -> None:
+        for task in followers:
+            future = self._follow_futures.pop(task.id, None)
+            if future is not None:
+                future.cancel()
+            await self._complete_task(task, {**message, "taskId": task.id})
+
+    async def storage_stats(self) -> dict:
+        return {
+            **self.storage_manager.stats(),
+            "cached_tokens": len(self.users_storage),
+            "blobs": len(self.blob_store),
+            "blob_bytes": self.blob_store.size,
+            **(self.result_cache.stats() if self.result_cache is not None else {}),
+        }
+
+    async def get_task(self, token: Optional[str], task_id: str) -> Optional[dict]:
+        task_data = await self.storage_manager.get_task_data_with_verification(
+            self.users_storage.get_user_id(token), task_id
+        )
+        if not task_data:
+            return None
+        return {"status": task_data["status"], "result": task_data.get("result")}
+
+    async def get_tasks(self, token: Optional[str]) -> Optional[dict]:
+        tasks = await self.storage_manager.get_tasks(
+            self.users_storage.get_user_id(token))
+        if not tasks:
+            return None
+        return {
+            task_id: {"status": task_data["status"],
+                      "result": task_data.get("result")}
+            for task_id, task_data in tasks.items()
+        }
+
+    async def get_tasks_page(
+            self,
+            token: Optional[str],
+            limit: int,
+            after: Optional[str] = None,
+            status: Optional[str] = None,
+    ) -> dict:
+        page = await self.storage_manager.get_tasks_page(
+            self.users_storage.get_user_id(token), limit, after, status)
+        return {
+            "tasks": {
+                task_id: {"status": task_data["status"],
+                          "result": task_data.get("result")}
+                for task_id, task_data in page.tasks.items()
+            },
+            "next": page.next_cursor,
+        }
+
+    async def register_node(
+            self,
+            node_id: str,
+            metadata: dict,
+            features: Iterable[str],
+            connection: Any,
+            task_ids: Iterable[str] = (),
+    ) -> None:
+        """Registers the node, `task_ids` are the ids of the tasks the node
+        still holds, so they are not scheduled again."""
+        public_meta = parse_public_meta_info(metadata)
+
+        logger.info(f"Node {node_id} connected")
+        if node_id in self.dispatcher.providers:
+            existing_provider = self.dispatcher.providers[node_id]
+            existing_provider.update_public_meta_info(public_meta)
+            existing_provider.restore_connection(
+                ws=connection, features=features)
+            logger.info(f"Updated ws for {node_id}")
+        else:
+            private_meta = PrivateMetaInfo()
+            network_connection = WSConnection(connection, features)
+            provider = Provider(node_id, public_meta,
+                                private_meta, network_connection)
+            self.dispatcher.add_provider(provider, task_ids)
+
+        if node_id in self._nodes and self._nodes[node_id] is not connection:
+            logger.warning(
+                f"Disconnected provider connection found saved in registered")
+        self._nodes[node_id] = connection
+        if HEARTBEAT_FEATURE in features:
+            self.heartbeat.add_node(node_id, connection)
+        else:
+            self.heartbeat.remove_node(node_id)
+
+        logger.info(f"Registered providers: {list(self._nodes.keys())}")
+
+    async def node_disconnected(self, node_id: str, connection: Any) -> None:
+        # The node may have registered again through another connection
+        if self._nodes.get(node_id) is not connection:
+            return
+
+        logger.info(f"Node {node_id} disconnected")
+        self._nodes.pop(node_id)
+        self.heartbeat.remove_node(node_id)
+        provider = self.dispatcher.providers.get(node_id)
+        if provider:
+            await provider.on_connection_lost()
+
+    async def _node_silent(self, node_id: str) -> None:
+        connection = self._nodes.get(node_id)
+        if connection is None:
+            return
+        await self.node_disconnected(node_id, connection)
+        # The node registers again through a new connection once it notices
+        try:
+            await connection.close(code=1001, reason="heartbeat timeout")
+        except Exception as e:
+            logger.warning(
+                f"Failed to close the connection of node {node_id}: {e}")
+
+    async def handle_node_message(self, node_id: str, data_json: dict) -> None:
+        self.heartbeat.seen(node_id)
+        handler = self._message_handlers.get(data_json.get("type"))
+        if handler is None:
+            logger.warning(f"Unknown message type: {data_json.get('type')}")
+            return
+        await handler(node_id, self.dispatcher.providers.get(node_id), data_json)
+
+    async def _handle_result(self, node_id: str, provider: Optional[Provider], data_json: dict) -> None:
+        msg_type = data_json.get("type")
+        task_id = data_json.get("taskId")
+        error = schema_error(TASK_RESULT_VALIDATOR, data_json)
+        if error is not None and not isinstance(task_id, str):
+            logger.error(
+                f"Dropping task result {data_json} of node {node_id}: {error}")
+            return
+        if error is not None and msg_type == "result":
+            # A malformed result fails the task instead of being stored
+            logger.error(
+                f"Task result {data_json} failed schema validation: {error}")
+            msg_type = "error"
+            data_json = {"type": "error", "taskId": task_id,
+                         "error": f"Invalid task result: {error}"}
+
+        # The provider holds the dispatched task, engines other than the
+        # memory one return a copy rebuilt from the stored row
+        task = provider.get_task_in_progress(
+            task_id) if provider is not None else None
+        if task is not None:
+            if msg_type == "result":
+                provider.task_completed(task)
+            else:
+                provider.task_failed(task, data_json.get("error"))
+                await self.storage_manager.add_error(task_id, data_json.get("error"))
+        # A result of a task taken from the provider meanwhile is kept too
+        stored = msg_type == "result" and provider is not None and (
+            task is not None or await self.storage_manager.get_task_data(task_id))
+        if stored:
+            await self.storage_manager.add_result(
+                task_id, data_json.get("resultsUrl"))
+        # An error of a task taken from the provider does not end the
+        # execution by the provider holding it now
+        if self.result_cache is not None and (stored or msg_type == "error" and task is not None):
+            await self._finish_pipeline(task_id, data_json)
+
+        for callback in self._result_listeners:
+            callback(task_id, data_json)
+
+    async def _handle_status(self, node_id: str, provider: Optional[Provider], data_json: dict) -> None:
+        if provider is None:
+            logger.warning(f"Unknown provider {node_id} sent status")
+            return
+
+        task = provider.get_task_in_progress(data_json.get("taskId"))
+        if task is not None and data_json.get("status") == "inProgress":
+            provider.task_started(task)
+
+    async def _handle_blob_request(self, node_id: str, provider: Optional[Provider], data_json: dict) -> None:
+        blob_hash = data_json.get("hash")
+        blob = self.blob_store.get(blob_hash)
+        if blob is None and provider is not None:
+            # The store may have dropped a blob a task in progress holds
+            blob = _find_task_blob(provider.tasks_in_progress, blob_hash)
+        if provider is None:
+            logger.warning(
+                f"Unknown provider {node_id} requested blob {blob_hash}")
+            return
+        reply = {"type": "blob", "hash": blob_hash}
+        if blob is None:
+            reply["error"] = "unknown blob"
+        else:
+            reply["data"] = blob
+        provider.send_blob(reply)
+
+    async def _handle_credits(self, node_id: str, provider: Optional[Provider], data_json: dict) -> None:
+        credits = data_json.get("credits")
+        if provider is None:
+            logger.warning(f"Unknown provider {node_id} sent credits")
+        elif not isinstance(credits, int) or credits < 0:
+            logger.warning(f"Invalid credits {credits} from node {node_id}")
+        else:
+            provider.set_credits(credits)
+
+    async def _handle_pong(self, node_id: str, provider: Optional[Provider], data_json: dict) -> None:
+        rtt = self.heartbeat.pong(node_id, data_json.get("t"))
+        if rtt is not None and provider is not None:
+            provider.record_rtt(rtt)
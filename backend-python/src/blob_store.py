@@ -0,0 +1,67 @@
+from dispatcher.task_info import ComfyPipelineOptions
+
+from collections import OrderedDict
+from typing import Any, Optional
+import hashlib
+import json
+
+BLOB_STORE_MAX_BYTES = 256 * 1024 * 1024
+
+
+def encode_blob(value: Any) -> bytes:
+    return json.dumps(value, sort_keys=True, separators=(',', ':')).encode()
+
+
+class BlobStore:
+    """Keeps one copy of every distinct pipeline and pipeline dependencies
+    value, addressed by the SHA-256 of its canonical JSON.
+
+    Tasks submitted with the same workflow share the stored object. Blobs
+    are dropped the least recently used first once they take more than
+    `max_bytes`, the tasks holding them keep their reference, so only the
+    sharing with later tasks is lost.
+    """
+
+    def __init__(self, max_bytes: int = BLOB_STORE_MAX_BYTES):
+        self._max_bytes = max_bytes
+        # hash -> (value, encoded size), the least recently used first
+        self._blobs: OrderedDict[str, tuple[Any, int]] = OrderedDict()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return len(self._blobs)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def put(self, value: Any) -> tuple[str, Any]:
+        """Returns the hash of `value` and the stored copy of it."""
+        encoded = encode_blob(value)
+        key = hashlib.sha256(encoded).hexdigest()
+        if key in self._blobs:
+            self._blobs.move_to_end(key)
+            return key, self._blobs[key][0]
+
+        self._blobs[key] = (value, len(encoded))
+        self._size += len(encoded)
+        while self._size > self._max_bytes and len(self._blobs) > 1:
+            _, (_, size) = self._blobs.popitem(last=False)
+            self._size -= size
+        return key, value
+
+    def get(self, key: str) -> Optional[Any]:
+        blob = self._blobs.get(key)
+        if blob is None:
+            return None
+        self._blobs.move_to_end(key)
+        return blob[0]
+
+    def add_pipeline(self, pipeline: ComfyPipelineOptions) -> None:
+        """Hashes the pipeline and its dependencies and makes it share their
+        stored copies."""
+        pipeline.pipeline_data_hash, pipeline.pipeline_data = self.put(
+            pipeline.pipeline_data)
+        if pipeline.pipeline_dependencies is not None:
+            pipeline.pipeline_dependencies_hash, pipeline.pipeline_dependencies = self.put(
+                pipeline.pipeline_dependencies)
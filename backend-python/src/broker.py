@@ -0,0 +1,431 @@
+from dispatcher.util.logger import logger
+from backend import Backend
+from utils.delay import delay
+
+from fastapi import WebSocketDisconnect
+from typing import Any, Awaitable, Callable, Iterable, Optional
+import asyncio
+import itertools
+import json
+import os
+import struct
+
+# Calls a worker may forward to the broker's Backend
+BACKEND_CALLS = {
+    "available_nodes",
+    "add_task",
+    "add_tasks",
+    "get_task",
+    "get_tasks",
+    "get_tasks_page",
+    "storage_stats",
+}
+# Calls carrying messages of a node, handled in the order they were sent
+NODE_CALLS = {
+    "register_node",
+    "node_disconnected",
+    "handle_node_message",
+}
+
+CONNECT_ATTEMPTS = 50
+CONNECT_RETRY_DELAY_MS = 100
+
+_HEADER = struct.Struct("!I")
+
+
+async def read_frame(reader: asyncio.StreamReader) -> dict:
+    header = await reader.readexactly(_HEADER.size)
+    (length,) = _HEADER.unpack(header)
+    return json.loads(await reader.readexactly(length))
+
+
+def write_frame(writer: asyncio.StreamWriter, message: dict) -> None:
+    data = json.dumps(message).encode()
+    writer.write(_HEADER.pack(len(data)) + data)
+
+
+class _RemoteWebSocket:
+    """Stands for the WebSocket of a node connected to another worker
+    process, so `WSConnection` works unchanged in the broker.
+
+    A send returns once the worker has written the message to the node, so
+    a slow node backs up the outbox of its provider as it would without
+    the broker.
+    """
+
+    def __init__(self, session: "_WorkerSession", node_id: str):
+        self._session = session
+        self._node_id = node_id
+
+    async def send_json(self, data: Any):
+        await self._session.send_to_node({"op": "send", "node_id": self._node_id, "message": data})
+
+    async def send_text(self, text: str):
+        await self._session.send_to_node({"op": "send_text", "node_id": self._node_id, "text": text})
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        if self._session.closed:
+            return
+        await self._session.send({"op": "close", "node_id": self._node_id, "code": code, "reason": reason})
+
+
+class _WorkerSession:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+        self.nodes: dict[str, _RemoteWebSocket] = dict()
+        self.node_lock = asyncio.Lock()
+        self._write_lock = asyncio.Lock()
+        # send id -> future of a message to a node the worker has not
+        # written yet
+        self._sends: dict[int, asyncio.Future] = dict()
+        self._send_counter = itertools.count()
+
+    async def send(self, message: dict):
+        async with self._write_lock:
+            write_frame(self.writer, message)
+            await self.writer.drain()
+
+    async def send_to_node(self, message: dict):
+        """Sends a message to a node of the worker, raises
+        `WebSocketDisconnect` if the worker fails to write it."""
+        if self.closed:
+            raise WebSocketDisconnect()
+        send_id = next(self._send_counter)
+        future = asyncio.get_running_loop().create_future()
+        self._sends[send_id] = future
+        try:
+            await self.send({**message, "send_id": send_id})
+            error = await future
+        finally:
+            self._sends.pop(send_id, None)
+        if error is not None:
+            raise WebSocketDisconnect(reason=error)
+
+    def node_written(self, send_id: int, error: Optional[str]):
+        future = self._sends.get(send_id)
+        if future is not None and not future.done():
+            future.set_result(error)
+
+    def fail_sends(self):
+        for future in self._sends.values():
+            if not future.done():
+                future.set_result("worker connection lost")
+
+
+class BrokerServer:
+    """Owns the single `Backend` of a multi worker deployment.
+
+    Worker processes forward their HTTP and WebSocket traffic here over a
+    Unix socket. Tasks for a node are sent back to the worker holding the
+    node's WebSocket, and results are broadcast to every worker, so any
+    worker can wait for any task.
+
+    Frames are a 4 byte big endian length followed by a JSON object.
+    """
+
+    def __init__(self, backend: Backend):
+        self._backend = backend
+        self._sessions: set[_WorkerSession] = set()
+        # Calls and result broadcasts in flight
+        self._futures: set[asyncio.Future] = set()
+        self._backend.add_result_listener(self._broadcast_result)
+
+    async def serve(self, path: str) -> None:
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self._on_connect, path=path)
+        async with server:
+            await server.serve_forever()
+
+    def _run_in_background(self, awaitable: Awaitable[Any]) -> None:
+        future = asyncio.ensure_future(awaitable)
+        self._futures.add(future)
+        future.add_done_callback(self._background_done)
+
+    def _background_done(self, future: asyncio.Future) -> None:
+        self._futures.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Broker task failed: {future.exception()}")
+
+    def _broadcast_result(self, task_id: str, message: dict) -> None:
+        for session in self._sessions:
+            self._run_in_background(session.send(
+                {"op": "result", "task_id": task_id, "message": message}))
+
+    async def _on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = _WorkerSession(reader, writer)
+        self._sessions.add(session)
+        try:
+            while True:
+                message = await read_frame(reader)
+                if message.get("op") == "written":
+                    session.node_written(
+                        message["send_id"], message.get("error"))
+                else:
+                    self._run_in_background(
+                        self._handle_call(session, message))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            session.closed = True
+            session.fail_sends()
+            self._sessions.discard(session)
+            writer.close()
+            for node_id, connection in list(session.nodes.items()):
+                await self._backend.node_disconnected(node_id, connection)
+
+    async def _handle_call(self, session: _WorkerSession, message: dict):
+        method = message.get("method")
+        params = message.get("params", {})
+        try:
+            if method in BACKEND_CALLS:
+                result = await getattr(self._backend, method)(**params)
+            elif method in NODE_CALLS:
+                result = await self._handle_node_call(session, method, params)
+            else:
+                raise ValueError(f"Unknown broker call {method}")
+            reply = {"op": "reply", "id": message.get("id"), "result": result}
+        except Exception as e:
+            logger.error(f"Broker call {method} failed: {e}")
+            reply = {"op": "reply", "id": message.get("id"), "error": str(e)}
+
+        if not session.closed:
+            await session.send(reply)
+
+    async def _handle_node_call(self, session: _WorkerSession, method: str, params: dict):
+        node_id = params["node_id"]
+        if method == "node_disconnected":
+            # Waiting for the node to come back must not hold the other
+            # nodes of the worker
+            connection = session.nodes.pop(node_id, None)
+            if connection is not None:
+                await self._backend.node_disconnected(node_id, connection)
+            return None
+
+        async with session.node_lock:
+            if method == "register_node":
+                session.nodes[node_id] = _RemoteWebSocket(session, node_id)
+                await self._backend.register_node(
+                    node_id, params["metadata"], params["features"], session.nodes[node_id],
+                    params["task_ids"])
+            elif node_id in session.nodes:
+                await self._backend.handle_node_message(node_id, params["data_json"])
+        return None
+
+
+class _NodeWriter:
+    """Writes the messages the broker sends to one node in order, so a node
+    slow to take them holds up neither the worker's read loop nor the
+    other nodes. Every written message with a send id is acknowledged."""
+
+    def __init__(self, node_id: str, ws: Any, on_written: Callable[[dict, Optional[str]], Awaitable[None]]):
+        self._node_id = node_id
+        self._ws = ws
+        self._on_written = on_written
+        self._queue: asyncio.Queue[dict] = asyncio.Queue()
+        self._future = asyncio.ensure_future(self._run())
+
+    def put(self, message: dict) -> None:
+        self._queue.put_nowait(message)
+
+    async def close(self) -> None:
+        """Stops the writer, the messages not written are acknowledged as
+        failed."""
+        self._future.cancel()
+        await asyncio.gather(self._future, return_exceptions=True)
+        while not self._queue.empty():
+            await self._on_written(self._queue.get_nowait(), "node disconnected")
+
+    async def _run(self) -> None:
+        while True:
+            message = await self._queue.get()
+            try:
+                await self._write(message)
+            except asyncio.CancelledError:
+                await self._on_written(message, "node disconnected")
+                raise
+            except Exception as e:
+                # The WebSocket handler notices the disconnect and reports it
+                logger.warning(f"Failed to send to node {self._node_id}: {e}")
+                await self._on_written(message, str(e) or type(e).__name__)
+            else:
+                await self._on_written(message, None)
+
+    async def _write(self, message: dict) -> None:
+        op = message["op"]
+        if op == "send_text":
+            # Task payloads come encoded already
+            await self._ws.send_text(message["text"])
+        elif op == "send":
+            await self._ws.send_json(message["message"])
+        elif op == "close":
+            await self._ws.close(code=message["code"], reason=message["reason"])
+
+
+class BrokerClient:
+    """Worker side of the broker, with the same coroutines as `Backend`."""
+
+    def __init__(self, path: str):
+        self._path = path
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._read_future: Optional[asyncio.Future] = None
+        self._calls: dict[int, asyncio.Future] = dict()
+        self._counter = itertools.count()
+        # node id -> WebSocket of the nodes connected to this worker
+        self._nodes: dict[str, Any] = dict()
+        self._node_writers: dict[str, _NodeWriter] = dict()
+        self._result_listeners: list[Callable[[str, dict], None]] = list()
+
+    async def connect(self) -> None:
+        for attempt in range(CONNECT_ATTEMPTS):
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(self._path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if attempt == CONNECT_ATTEMPTS - 1:
+                    raise
+                await delay(CONNECT_RETRY_DELAY_MS)
+        self._read_future = asyncio.ensure_future(self._read_loop())
+
+    async def close(self) -> None:
+        for writer in self._node_writers.values():
+            await writer.close()
+        self._node_writers.clear()
+        if self._read_future is not None:
+            self._read_future.cancel()
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+
+    def add_result_listener(self, callback: Callable[[str, dict], None]) -> None:
+        self._result_listeners.append(callback)
+
+    async def available_nodes(self) -> int:
+        return await self._call("available_nodes")
+
+    async def add_task(self, token: Optional[str], task_query: dict) -> str:
+        return await self._call("add_task", token=token, task_query=task_query)
+
+    async def add_tasks(self, token: Optional[str], task_queries: list[dict]) -> list[str]:
+        return await self._call("add_tasks", token=token, task_queries=task_queries)
+
+    async def storage_stats(self) -> dict:
+        return await self._call("storage_stats")
+
+    async def get_task(self, token: Optional[str], task_id: str) -> Optional[dict]:
+        return await self._call("get_task", token=token, task_id=task_id)
+
+    async def get_tasks(self, token: Optional[str]) -> Optional[dict]:
+        return await self._call("get_tasks", token=token)
+
+    async def get_tasks_page(
+            self,
+            token: Optional[str],
+            limit: int,
+            after: Optional[str] = None,
+            status: Optional[str] = None,
+    ) -> dict:
+        return await self._call("get_tasks_page", token=token, limit=limit, after=after, status=status)
+
+    async def register_node(
+            self,
+            node_id: str,
+            metadata: dict,
+            features: Iterable[str],
+            connection: Any,
+            task_ids: Iterable[str] = (),
+    ) -> None:
+        self._nodes[node_id] = connection
+        writer = self._node_writers.pop(node_id, None)
+        if writer is not None:
+            await writer.close()
+        self._node_writers[node_id] = _NodeWriter(
+            node_id, connection, self._node_written)
+        await self._call("register_node", node_id=node_id, metadata=metadata,
+                         features=list(features), task_ids=list(task_ids))
+
+    async def node_disconnected(self, node_id: str, connection: Any) -> None:
+        if self._nodes.get(node_id) is not connection:
+            return
+        self._nodes.pop(node_id)
+        await self._node_writers.pop(node_id).close()
+        await self._call("node_disconnected", node_id=node_id)
+
+    async def handle_node_message(self, node_id: str, data_json: dict) -> None:
+        await self._call("handle_node_message", node_id=node_id, data_json=data_json)
+
+    async def _call(self, method: str, **params):
+        # Calls made once the read loop is gone would never get a reply
+        if self._read_future is None or self._read_future.done():
+            raise ConnectionError("not connected to the broker")
+        call_id = next(self._counter)
+        future = asyncio.get_running_loop().create_future()
+        self._calls[call_id] = future
+        write_frame(self._writer, {"id": call_id,
+                    "method": method, "params": params})
+        await self._writer.drain()
+        return await future
+
+    async def _read_loop(self):
+        try:
+            while True:
+                message = await read_frame(self._reader)
+                op = message.get("op")
+                if op == "reply":
+                    future = self._calls.pop(message.get("id"), None)
+                    if future is None or future.done():
+                        continue
+                    if "error" in message:
+                        future.set_exception(RuntimeError(message["error"]))
+                    else:
+                        future.set_result(message.get("result"))
+                elif op in ("send", "send_text", "close"):
+                    writer = self._node_writers.get(message["node_id"])
+                    if writer is None:
+                        logger.warning(
+                            f"Node {message['node_id']} is not connected to this worker")
+                        await self._node_written(message, "node not connected")
+                    else:
+                        writer.put(message)
+                elif op == "result":
+                    for callback in self._result_listeners:
+                        callback(message["task_id"], message["message"])
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            logger.error(f"Connection to the broker lost: {e}")
+        except Exception as e:
+            logger.error(f"Broker read loop failed: {e}")
+        finally:
+            for future in self._calls.values():
+                if not future.done():
+                    future.set_exception(
+                        ConnectionError("broker connection lost"))
+            self._calls.clear()
+
+    async def _node_written(self, message: dict, error: Optional[str]):
+        if "send_id" not in message or self._writer is None or self._writer.is_closing():
+            return
+        reply = {"op": "written", "send_id": message["send_id"]}
+        if error is not None:
+            reply["error"] = error
+        try:
+            write_frame(self._writer, reply)
+            await self._writer.drain()
+        except ConnectionError as e:
+            logger.warning(
+                f"Failed to acknowledge a send to node {message.get('node_id')}: {e}")
+
+
+async def _serve_broker(path: str) -> None:
+    backend = Backend()
+    await backend.start()
+    try:
+        await BrokerServer(backend).serve(path)
+    finally:
+        await backend.close()
+
+
+def run_broker(path: str) -> None:
+    asyncio.run(_serve_broker(path))
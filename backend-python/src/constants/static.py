@@ -1,10 +1,21 @@
 import json
 
+# Generated from the zod definitions of the client package, CI checks they
+# match
 TASK_RESULT_SCHEMA_PATH = "src/schemas/task_result_schema.json"
 TASK_SCHEMA_PATH = "src/schemas/task_schema.json"
+# Messages of the node protocol the client package does not define yet
+REGISTER_SCHEMA_PATH = "src/node_schemas/register_schema.json"
+COMFY_BLOB_OPTIONS_SCHEMA_PATH = "src/node_schemas/comfy_blob_options_schema.json"
 
 with open(TASK_RESULT_SCHEMA_PATH) as task_result_schema:
     TASK_RESULT_SCHEMA = json.load(task_result_schema)
 
 with open(TASK_SCHEMA_PATH) as task_schema:
     TASK_SCHEMA = json.load(task_schema)
+
+with open(REGISTER_SCHEMA_PATH) as register_schema:
+    REGISTER_SCHEMA = json.load(register_schema)
+
+with open(COMFY_BLOB_OPTIONS_SCHEMA_PATH) as comfy_blob_options_schema:
+    COMFY_BLOB_OPTIONS_SCHEMA = json.load(comfy_blob_options_schema)
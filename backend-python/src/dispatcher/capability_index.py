@@ -0,0 +1,89 @@
+from dispatcher.provider import Provider
+from dispatcher.provider_index import ProviderIndex
+from dispatcher.task import Task
+
+from typing import Callable, Iterator
+
+
+def model_capability(model: str) -> str:
+    return "model:" + model
+
+
+def gpu_capability(gpu_type: str) -> str:
+    return "gpu:" + gpu_type
+
+
+def provider_capabilities(provider: Provider) -> set[str]:
+    meta_info = provider.public_meta_info
+    capabilities = {model_capability(model) for model in meta_info.models}
+    if meta_info.gpu_type:
+        capabilities.add(gpu_capability(meta_info.gpu_type))
+    return capabilities
+
+
+def task_capabilities(task: Task) -> set[str]:
+    capabilities = {model_capability(model) for model in task.required_models}
+    if task.gpu_type:
+        capabilities.add(gpu_capability(task.gpu_type))
+    return capabilities
+
+
+class CapabilityIndex:
+    """Inverted index from a capability (a model or a GPU class) to the
+    providers having it.
+
+    Every capability keeps its own `ProviderIndex`, so the best capable
+    providers are found without looking at the rest of the fleet.
+    """
+
+    def __init__(
+            self,
+            key: Callable[[Provider], float],
+            is_eligible: Callable[[Provider], bool],
+    ):
+        self._key = key
+        self._is_eligible = is_eligible
+        self._indexes: dict[str, ProviderIndex] = dict()
+        self._capabilities: dict[str, set[str]] = dict()
+
+    def add(self, provider: Provider) -> None:
+        capabilities = provider_capabilities(provider)
+        self._capabilities[provider.id] = capabilities
+        for capability in capabilities:
+            if capability not in self._indexes:
+                self._indexes[capability] = ProviderIndex(
+                    self._key, self._is_eligible)
+            self._indexes[capability].add(provider)
+
+    def remove(self, provider: Provider) -> None:
+        for capability in self._capabilities.pop(provider.id, set()):
+            index = self._indexes[capability]
+            index.remove(provider)
+            if index.is_empty():
+                del self._indexes[capability]
+
+    def update(self, provider: Provider) -> None:
+        for capability in self._capabilities.get(provider.id, set()):
+            self._indexes[capability].update(provider)
+
+    def capabilities(self, provider: Provider) -> set[str]:
+        return self._capabilities.get(provider.id, set())
+
+    def reindex(self, provider: Provider) -> None:
+        self.remove(provider)
+        self.add(provider)
+
+    def tiers_with(self, capabilities: set[str]) -> Iterator[tuple[float, Iterator[Provider]]]:
+        """Yields the price tiers of the eligible providers having all
+        capabilities, like `ProviderIndex.tiers`. The index must not be
+        modified while iterating."""
+        indexes = []
+        for capability in capabilities:
+            if capability not in self._indexes:
+                return
+            indexes.append(self._indexes[capability])
+
+        narrowest = min(indexes, key=len)
+        for tier, providers in narrowest.tiers():
+            yield tier, (provider for provider in providers
+                         if capabilities <= self._capabilities[provider.id])
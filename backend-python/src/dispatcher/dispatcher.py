@@ -1,82 +1,363 @@
 from dispatcher.util.logger import logger
+from dispatcher.entry_queue import EntryQueue
 from dispatcher.provider import Provider
+from dispatcher.provider_index import ProviderIndex
+from dispatcher.capability_index import CapabilityIndex, task_capabilities
 from dispatcher.task import Task
 from dispatcher.task_info import TaskStatus, TaskStatusPayload
 from dispatcher.task_info import ScheduledPayload
 
-from typing import Optional
+from typing import Iterable, Optional
+import asyncio
+import math
 
-MAX_PROVIDER_QUEUE_LEN = 50
-MAX_SCHEDULING_ATTEMPTS = 5
+# Number of the least loaded providers of a price tier compared by score
+MAX_SCHEDULING_CANDIDATES = 8
+# Seconds a stolen task must finish earlier on the idle provider, so tasks
+# do not bounce between providers with similar estimates
+MIN_STEAL_GAIN = 1.0
+
+
+def _provider_load(provider: Provider) -> float:
+    return provider.waiting_time
+
+
+def _is_available(provider: Provider) -> bool:
+    return provider.is_online and provider.has_capacity
+
+
+def _has_tasks_to_steal(provider: Provider) -> bool:
+    # Tasks of a node that does not report started tasks may be running
+    return provider.is_online and provider.reports_started and provider.has_unstarted_tasks
 
 
 class Dispatcher:
     def __init__(self) -> None:
         self._providers: dict[str, Provider] = dict()
+        self._index = ProviderIndex(
+            key=_provider_load, is_eligible=_is_available)
+        self._capability_index = CapabilityIndex(
+            key=_provider_load, is_eligible=_is_available)
+        # Providers with not yet started tasks, the most loaded first
+        self._steal_index = ProviderIndex(
+            key=lambda provider: -provider.waiting_time,
+            is_eligible=_has_tasks_to_steal,
+            tier=lambda provider: 0)
+        self._entry_queue = EntryQueue()
+        self._pulling = False
+        self._pull_future: Optional[asyncio.Future] = None
+        self._stealing: set[str] = set()
+        self._steal_futures: set[asyncio.Future] = set()
+        # provider id -> tasks the provider held before a restart, kept for
+        # it until it registers again
+        self._reclaimable: dict[str, list[Task]] = dict()
+        self._requeue_future: Optional[asyncio.Future] = None
 
     @property
     def providers(self):
         return self._providers
 
+    async def close(self) -> None:
+        """Cancels the pulls, steals and requeues not done yet and closes
+        the providers."""
+        futures = [
+            future for future in (
+                self._pull_future, self._requeue_future, *self._steal_futures)
+            if future is not None and not future.done()
+        ]
+        for future in futures:
+            future.cancel()
+        await asyncio.gather(*futures, return_exceptions=True)
+        for provider in self._providers.values():
+            await provider.close()
+
+    @property
+    def entry_queue(self):
+        return self._entry_queue
+
     async def add_task(self, task: Task) -> None:
-        for _ in range(MAX_SCHEDULING_ATTEMPTS):
-            if await self._schedule_task(task):
-                return
-        logger.warning("Task {id} failed to be scheduled".format(id=task.id))
-        task.set_status(TaskStatusPayload(task_status=TaskStatus.FAILED))
+        if len(self._entry_queue) == 0 and await self._schedule_task(task):
+            return
+
+        self._queue_task(task)
+        await self.pull_tasks()
+
+    async def add_tasks(self, tasks: list[Task]) -> None:
+        """Schedules the tasks in one pass, the tasks left once no provider
+        can take the next one are queued and pulled together."""
+        scheduled = 0
+        while (scheduled < len(tasks) and len(self._entry_queue) == 0
+               and await self._schedule_task(tasks[scheduled])):
+            scheduled += 1
+        if scheduled == len(tasks):
+            return
+
+        for task in tasks[scheduled:]:
+            self._queue_task(task)
+        await self.pull_tasks()
+
+    def _queue_task(self, task: Task) -> None:
+        if not self._entry_queue.add_task(task):
+            logger.warning(
+                "Task {id} failed to be scheduled: entry queue is full".format(id=task.id))
+            task.set_status(TaskStatusPayload(task_status=TaskStatus.FAILED))
+            return
+        logger.info("Task {id} queued".format(id=task.id))
+
+    def reclaim_tasks(self, tasks: dict[str, list[Task]], timeout: float) -> None:
+        """Keeps the tasks recovered for every provider id until the provider
+        registers again, the tasks of providers not back within `timeout`
+        seconds are scheduled anew. A provider registering again takes back
+        only the tasks its node confirms it still holds."""
+        for provider_id, provider_tasks in tasks.items():
+            self._reclaimable.setdefault(
+                provider_id, []).extend(provider_tasks)
+        if self._reclaimable and self._requeue_future is None:
+            self._requeue_future = asyncio.ensure_future(
+                self._requeue_unclaimed_tasks(timeout))
+
+    async def _requeue_unclaimed_tasks(self, timeout: float) -> None:
+        await asyncio.sleep(timeout)
+        self._requeue_future = None
+        reclaimable, self._reclaimable = self._reclaimable, dict()
+        for provider_id, tasks in reclaimable.items():
+            logger.info("Provider {id} did not reclaim {count} tasks".format(
+                id=provider_id, count=len(tasks)))
+            for task in tasks:
+                await self.add_task(task)
+
+    async def pull_tasks(self) -> None:
+        # Scheduling may close a provider and reschedule its tasks through
+        # add_task, the outer loop keeps pulling in that case
+        if self._pulling:
+            return
+
+        # Tasks no available provider can serve within their budget are
+        # parked without blocking the tasks behind them, they are pulled
+        # again once a provider priced within their budget is available
+        self._pulling = True
+        try:
+            while len(self._entry_queue) > 0 and len(self._index) > 0:
+                task = self._entry_queue.pop_task(self._index.min_tier())
+                if task is None:
+                    break
+                if not await self._schedule_task(task):
+                    self._entry_queue.park_task(task)
+        finally:
+            self._pulling = False
+
+    def _request_pull(self) -> None:
+        if self._pulling or len(self._entry_queue) == 0 or len(self._index) == 0:
+            return
+        if self._pull_future is None or self._pull_future.done():
+            self._pull_future = asyncio.ensure_future(self.pull_tasks())
+
+    async def steal_tasks(self, thief: Provider) -> None:
+        """Moves not yet started tasks from the most loaded providers to
+        the idle `thief` while that makes the tasks finish earlier."""
+        if thief.id in self._stealing:
+            return
 
-    def add_provider(self, provider: Provider) -> None:
+        self._stealing.add(thief.id)
+        try:
+            while (len(self._entry_queue) == 0 and thief.id in self._providers
+                   and _is_available(thief) and await self._steal_task(thief)):
+                pass
+        finally:
+            self._stealing.discard(thief.id)
+
+    async def _steal_task(self, thief: Provider) -> bool:
+        thief_capabilities = self._capability_index.capabilities(thief)
+        victims = (
+            provider
+            for _, providers in self._steal_index.tiers()
+            for provider in providers
+            if provider is not thief
+        )
+        for i, victim in enumerate(victims):
+            if i == MAX_SCHEDULING_CANDIDATES:
+                break
+            task = victim.last_unstarted_task
+            if task.max_cost is not None and thief.price > task.max_cost:
+                continue
+            # A task goes to a provider having its models whenever there is
+            # one, so it is not moved away from the models it needs
+            needed = task_capabilities(
+                task) & self._capability_index.capabilities(victim)
+            if not needed <= thief_capabilities:
+                continue
+            # The last task of the victim's queue is done once the whole
+            # queue is, so it finishes after the victim's waiting time
+            finish_time = thief.waiting_time + \
+                thief.rtt + thief.estimate_task_time(task)
+            if finish_time + MIN_STEAL_GAIN >= victim.waiting_time:
+                continue
+
+            logger.info("Task {id} stolen from provider {victim} by provider {thief}".format(
+                id=task.id, victim=victim.id, thief=thief.id))
+            await victim.abort_task(task)
+            time_to_money_ratio = task.time_to_money_ratio if task.time_to_money_ratio is not None else 1
+            task.set_status(ScheduledPayload(
+                provider_id=thief.id,
+                min_score=thief.price + time_to_money_ratio * finish_time,
+                waiting_time=finish_time
+            ))
+            await thief.schedule_task(task)
+            return True
+        return False
+
+    def _request_steal(self, provider: Provider) -> None:
+        if (provider.queue_length > 0 or not _is_available(provider)
+                or len(self._entry_queue) > 0 or len(self._steal_index) == 0
+                or provider.id in self._stealing):
+            return
+        future = asyncio.ensure_future(self.steal_tasks(provider))
+        self._steal_futures.add(future)
+        future.add_done_callback(self._steal_futures.discard)
+
+    def add_provider(self, provider: Provider, held_task_ids: Iterable[str] = ()) -> None:
+        """Adds the provider, `held_task_ids` are the ids of the tasks its
+        node still holds from before the backend restarted."""
         if provider.id in self._providers.keys():
             logger.warning(
                 "Provider {id} already added".format(id=provider.id))
             return
         self._providers[provider.id] = provider
 
+        # A provider closed after its node registered again through a new
+        # provider must not take the new one with it
         async def remove_this_provider():
-            await self.remove_provider(provider.id)
+            if self._providers.get(provider.id) is provider:
+                await self.remove_provider(provider.id)
 
         self._providers[provider.id].set_on_closed(
             remove_this_provider)
 
         async def reschedule_this_providers_tasks():
-            await self.reschedule_tasks_in_progress(provider.id)
+            if self._providers.get(provider.id) is provider:
+                await self.reschedule_tasks_in_progress(provider.id)
 
         self._providers[provider.id].set_on_connection_lost(
             reschedule_this_providers_tasks)
 
+        def update_this_provider_load():
+            self._index.update(provider)
+            self._capability_index.update(provider)
+            self._steal_index.update(provider)
+            self._request_pull()
+            self._request_steal(provider)
+
+        self._providers[provider.id].set_on_load_changed(
+            update_this_provider_load)
+
+        def reindex_this_provider():
+            self._index.update(provider)
+            self._capability_index.reindex(provider)
+            self._request_pull()
+
+        self._providers[provider.id].set_on_meta_info_updated(
+            reindex_this_provider)
+        self._index.add(provider)
+        self._capability_index.add(provider)
+        self._steal_index.add(provider)
+        held_task_ids = set(held_task_ids)
+        for task in self._reclaimable.pop(provider.id, []):
+            if task.id in held_task_ids:
+                provider.reclaim_task(task)
+            else:
+                # The node lost the task, with its restart for instance
+                logger.info("Task {id} not held by provider {provider}".format(
+                    id=task.id, provider=provider.id))
+                self._queue_task(task)
+        if not self._reclaimable and self._requeue_future is not None:
+            self._requeue_future.cancel()
+            self._requeue_future = None
+        self._request_pull()
+        self._request_steal(provider)
+
     async def remove_provider(self, provider_id: str) -> None:
-        await self.reschedule_tasks_in_progress(provider_id)
-        self._providers.pop(provider_id, None)
+        provider = self._providers.pop(provider_id, None)
+        if provider is None:
+            logger.warning(
+                "Provider {id} not in dispatcher".format(id=provider_id))
+            return
+
+        self._remove_from_indexes(provider)
+        for task in provider.take_tasks_in_progress():
+            await self.add_task(task)
 
     async def reschedule_tasks_in_progress(self, provider_id: str) -> None:
+        """Schedules the tasks of a provider anew, the provider itself stays
+        until it is closed, so its node may register again."""
         if provider_id not in self._providers.keys():
             logger.warning(
                 "Provider {id} not in dispatcher".format(id=provider_id))
             return
 
-        provider = self.providers.pop(provider_id)
-        for task in provider.tasks_in_progress:
+        for task in self._providers[provider_id].take_tasks_in_progress():
             await self.add_task(task)
-        provider.tasks_in_progress.clear()
 
-    async def _schedule_task(self, task: Task) -> bool:
-        least_busy_id: Optional[str] = None
-        min_queue_length = MAX_PROVIDER_QUEUE_LEN
-        for provider in self.providers.values():
-            if provider.queue_length > MAX_PROVIDER_QUEUE_LEN or not provider.is_online:
-                continue
-            if least_busy_id is None or provider.queue_length < min_queue_length:
-                least_busy_id = provider.id
-                min_queue_length = provider.queue_length
+    def _remove_from_indexes(self, provider: Provider) -> None:
+        self._index.remove(provider)
+        self._capability_index.remove(provider)
+        self._steal_index.remove(provider)
 
-        if least_busy_id is None:
-            logger.info("Not found provider for task {id}".format(id=task.id))
+    def _find_provider(self, task: Task) -> tuple[Optional[Provider], float, float]:
+        # Prefer providers that already have the models, so the task does
+        # not wait for a checkpoint download
+        capabilities = task_capabilities(task)
+        if capabilities:
+            provider, score, finish_time = _lowest_score(
+                self._capability_index.tiers_with(capabilities), task)
+            if provider is not None:
+                return provider, score, finish_time
+        return _lowest_score(self._index.tiers(), task)
+
+    async def _schedule_task(self, task: Task) -> bool:
+        provider, score, finish_time = self._find_provider(task)
+        if provider is None:
             return False
 
         task.set_status(ScheduledPayload(
-            provider_id=least_busy_id,
-            min_score=0,
-            waiting_time=self._providers[least_busy_id].waiting_time
+            provider_id=provider.id,
+            min_score=score,
+            waiting_time=finish_time
         ))
-        await self._providers[least_busy_id].schedule_task(task)
+        await provider.schedule_task(task)
         return True
+
+
+def _lowest_score(
+        tiers: Iterable[tuple[float, Iterable[Provider]]],
+        task: Task,
+) -> tuple[Optional[Provider], float, float]:
+    """Picks the provider with the lowest score within the task's budget.
+
+    The score of a provider is its price plus the task's time to money
+    ratio times the estimated finish time of the task on the provider,
+    which includes the round trip time to its node.
+    `tiers` must be ordered by price and the providers of a tier by waiting
+    time, which lets the search stop as soon as no provider left can beat
+    the best score.
+    """
+    max_cost = task.max_cost if task.max_cost is not None else math.inf
+    time_to_money_ratio = task.time_to_money_ratio if task.time_to_money_ratio is not None else 1
+
+    best: Optional[Provider] = None
+    best_score = math.inf
+    best_finish_time = math.inf
+    for price, providers in tiers:
+        if price > max_cost or price >= best_score:
+            break
+        for i, provider in enumerate(providers):
+            waiting_time = provider.waiting_time
+            if i == MAX_SCHEDULING_CANDIDATES or price + time_to_money_ratio * waiting_time >= best_score:
+                break
+            finish_time = waiting_time + provider.rtt + \
+                provider.estimate_task_time(task)
+            score = price + time_to_money_ratio * finish_time
+            if score < best_score:
+                best = provider
+                best_score = score
+                best_finish_time = finish_time
+    return best, best_score, best_finish_time
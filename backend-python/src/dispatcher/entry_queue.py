@@ -0,0 +1,102 @@
+from dispatcher.task import Task
+from dispatcher.task_info import TaskStatus, TaskStatusPayload
+
+from typing import Optional
+import bisect
+import heapq
+import itertools
+import math
+
+MAX_ENTRY_QUEUE_LEN = 10000
+
+
+class EntryQueue:
+    """Priority queue of tasks waiting for a provider with free capacity.
+
+    Tasks with a higher priority are served first, tasks with the same
+    priority are served in the order they were created, so a task put back
+    after its provider was lost keeps its place in the queue.
+
+    Tasks no provider can serve within their budget are parked in buckets
+    by `max_cost`, a bucket is only looked at again once a provider priced
+    within it is available, so blocked tasks cost nothing to pull around.
+    """
+
+    def __init__(self, max_size: int = MAX_ENTRY_QUEUE_LEN):
+        self._max_size = max_size
+        self._entries: dict[str, list] = dict()
+        self._heap: list[list] = list()
+        # max_cost -> heap of the parked tasks with that budget
+        self._parked: dict[float, list[list]] = dict()
+        self._parked_costs: list[float] = list()
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, task: Task):
+        return task.id in self._entries
+
+    def add_task(self, task: Task) -> bool:
+        if task.id in self._entries:
+            return True
+        if len(self._entries) >= self._max_size:
+            return False
+
+        heapq.heappush(self._heap, self._new_entry(task))
+        if task.status != TaskStatus.QUEUED:
+            task.set_status(TaskStatusPayload(task_status=TaskStatus.QUEUED))
+        return True
+
+    def park_task(self, task: Task) -> None:
+        """Puts back a task popped from the queue that no provider serves
+        within its budget yet."""
+        max_cost = task.max_cost if task.max_cost is not None else math.inf
+        if max_cost not in self._parked:
+            self._parked[max_cost] = list()
+            bisect.insort(self._parked_costs, max_cost)
+        heapq.heappush(self._parked[max_cost], self._new_entry(task))
+
+    def remove_task(self, task: Task) -> None:
+        entry = self._entries.pop(task.id, None)
+        if entry is not None:
+            entry[-1] = None
+
+    def pop_task(self, min_price: float = -math.inf) -> Optional[Task]:
+        """Pops the first task, parked tasks are only considered if their
+        budget covers `min_price`, the price of the cheapest provider."""
+        best = _first_entry(self._heap)
+        best_heap = self._heap
+        for max_cost in self._parked_costs[bisect.bisect_left(self._parked_costs, min_price):]:
+            entry = _first_entry(self._parked[max_cost])
+            if entry is not None and (best is None or entry < best):
+                best = entry
+                best_heap = self._parked[max_cost]
+        if best is None:
+            self._drop_empty_buckets()
+            return None
+
+        heapq.heappop(best_heap)
+        task = best[-1]
+        del self._entries[task.id]
+        if not best_heap and best_heap is not self._heap:
+            self._drop_empty_buckets()
+        return task
+
+    def _new_entry(self, task: Task) -> list:
+        entry = [-task.priority, task.submitted_at, next(self._counter), task]
+        self._entries[task.id] = entry
+        return entry
+
+    def _drop_empty_buckets(self) -> None:
+        for max_cost in [max_cost for max_cost, heap in self._parked.items()
+                         if _first_entry(heap) is None]:
+            del self._parked[max_cost]
+            self._parked_costs.remove(max_cost)
+
+
+def _first_entry(heap: list[list]) -> Optional[list]:
+    # Entries of removed tasks are dropped lazily
+    while heap and heap[0][-1] is None:
+        heapq.heappop(heap)
+    return heap[0] if heap else None
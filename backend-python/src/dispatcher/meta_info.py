@@ -6,6 +6,8 @@ class PublicMetaInfo(typing.NamedTuple):
     gpu_type: str
     ncpu: int
     ram: int
+    price: float = 0
+    credits: typing.Optional[int] = None
 
 
 class PrivateMetaInfo(typing.NamedTuple):
@@ -8,15 +8,26 @@ class NetworkConnection:
     def __init__(self):
         pass
 
+    @property
+    def supports_batching(self) -> bool:
+        return False
+
     async def send_task(self, task: Task):
         task.set_status(TaskStatusPayload(
             task_status=TaskStatus.SENT))
 
+    async def send_tasks(self, tasks: typing.Sequence[Task]):
+        for task in tasks:
+            await self.send_task(task)
+
     async def abort_task(self, task: Task):
         task.set_status(TaskStatusPayload(task_status=TaskStatus.ABORTED))
 
+    async def send_blob(self, reply: dict):
+        pass
+
     async def close(self):
         pass
 
-    def restore_connection(self, connection_object):
+    def restore_connection(self, connection_object, features: typing.Iterable[str] = ()):
         pass
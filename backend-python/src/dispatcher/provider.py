@@ -1,6 +1,7 @@
 from dispatcher.util.logger import logger
 from dispatcher.meta_info import PublicMetaInfo, PrivateMetaInfo
 from dispatcher.network_connection import NetworkConnection
+from dispatcher.provider_estimator import ProviderEstimator
 from dispatcher.task import Task
 from dispatcher.task_info import (
     FailedByProvider,
@@ -8,13 +9,27 @@ from dispatcher.task_info import (
     TaskStatus
 )
 
-from typing import Callable, Optional, Awaitable
+from typing import Any, Callable, Iterable, Optional, Awaitable
 from websockets.exceptions import ConnectionClosed
 from fastapi import WebSocket, WebSocketDisconnect
 import asyncio
+import collections
 
 
+# Seconds an offline provider waits for its node to register again before
+# it is closed
 OFFLINE_TIMEOUT = 3
+# Number of tasks handed to a provider that did not announce its credits
+DEFAULT_CREDITS = 50
+# Tasks scheduled to a provider within this many seconds are sent in one
+# frame if the provider supports batching
+BATCH_WINDOW = 0.01
+MAX_BATCH_SIZE = 100
+# Messages waiting to be sent to a node, a provider with a full outbox gets
+# no more tasks until its writer catches up
+MAX_OUTBOX_SIZE = 32
+# Weight of the newest sample in the smoothed round trip time
+RTT_SMOOTHING = 0.125
 
 
 class Provider:
@@ -29,15 +44,34 @@ class Provider:
         self._pub_meta_info = public_meta_info
         self._pr_meta_info = private_meta_info
         self._in_progress: set[Task] = set()
+        # Tasks in progress the node has not reported as started, in the
+        # order they were scheduled
+        self._unstarted: dict[Task, None] = dict()
+        # Whether the node reports started tasks, the tasks of a node that
+        # never does are not known to be unstarted
+        self._reports_started = False
+        self._credits = DEFAULT_CREDITS if public_meta_info.credits is None else public_meta_info.credits
+        self._estimator = ProviderEstimator()
 
         self._network_connection = network_connection
+        self._batch: list[Task] = list()
+        self._batch_future: Optional[asyncio.Future] = None
+        # Sends to the node in order, written one at a time by the writer
+        self._outbox: collections.deque[tuple[Callable[[
+            Any], Awaitable[None]], Any]] = collections.deque()
+        self._writer_future: Optional[asyncio.Future] = None
         self._is_online = True
-        self._offline_event: asyncio.Event
+        self._offline_event: Optional[asyncio.Event] = None
+        self._offline_future: Optional[asyncio.Future] = None
+        self._rtt: Optional[float] = None
 
         self._on_closed_callback: Optional[Callable[[
         ], Awaitable[None]]] = None
         self._on_connection_lost_callback: Optional[Callable[[
         ], Awaitable[None]]] = None
+        self._on_load_changed_callback: Optional[Callable[[], None]] = None
+        self._on_meta_info_updated_callback: Optional[Callable[[
+        ], None]] = None
 
     @property
     def id(self):
@@ -47,9 +81,46 @@ class Provider:
     def queue_length(self):
         return len(self._in_progress)
 
+    @property
+    def has_unstarted_tasks(self):
+        return len(self._unstarted) > 0
+
+    @property
+    def reports_started(self):
+        return self._reports_started
+
+    @property
+    def last_unstarted_task(self) -> Optional[Task]:
+        return next(reversed(self._unstarted), None)
+
+    @property
+    def credits(self):
+        return self._credits
+
+    @property
+    def has_capacity(self):
+        return self.queue_length < self._credits and len(self._outbox) < MAX_OUTBOX_SIZE
+
+    @property
+    def outbox_length(self):
+        return len(self._outbox)
+
     @property
     def waiting_time(self):
-        return self.queue_length
+        return self._estimator.get_waiting_time()
+
+    @property
+    def price(self):
+        return self._pub_meta_info.price
+
+    @property
+    def rtt(self) -> float:
+        """Smoothed round trip time to the node, 0 until it is measured."""
+        return self._rtt if self._rtt is not None else 0.0
+
+    @property
+    def public_meta_info(self):
+        return self._pub_meta_info
 
     @property
     def is_online(self):
@@ -59,16 +130,29 @@ class Provider:
     def tasks_in_progress(self):
         return self._in_progress
 
-    async def start_offline(self):
+    def get_task_in_progress(self, task_id: str) -> Optional[Task]:
+        return next((task for task in self._in_progress if task.id == task_id), None)
+
+    def start_offline(self):
+        """Takes the provider out of scheduling, it is closed unless the
+        node registers again within `OFFLINE_TIMEOUT` seconds."""
         if not self._is_online:
             logger.warning("start_offline called twice")
             return
 
         self._is_online = False
         self._offline_event = asyncio.Event()
+        self.on_load_changed()
+        loop = asyncio.get_running_loop()
+        self._offline_future = asyncio.ensure_future(self._close_when_offline(
+            self._offline_event, loop.time() + OFFLINE_TIMEOUT))
+
+    async def _close_when_offline(self, offline_event: asyncio.Event, deadline: float):
         try:
-            await asyncio.wait_for(self._offline_event.wait(), OFFLINE_TIMEOUT)
-        except TimeoutError:
+            async with asyncio.timeout_at(deadline):
+                await offline_event.wait()
+        except asyncio.TimeoutError:
+            self._offline_future = None
             for task in self._in_progress:
                 task.set_status(FailedByProvider(reason="Provider is offline"))
             await self.on_closed()
@@ -78,29 +162,106 @@ class Provider:
             logger.warning("stop_offline called twice")
             return
         self._is_online = True
-        self._offline_event.set
+        self._offline_event.set()
+        self._offline_future = None
+        self.on_load_changed()
+
+    async def close(self):
+        """Cancels the offline timeout, the pending batch and the writer,
+        the sends left in the outbox are dropped."""
+        futures = [
+            future for future in (
+                self._offline_future, self._batch_future, self._writer_future)
+            if future is not None and not future.done()
+        ]
+        self._offline_future = None
+        self._batch_future = None
+        self._writer_future = None
+        self._outbox.clear()
+        for future in futures:
+            future.cancel()
+        await asyncio.gather(*futures, return_exceptions=True)
+
+    def record_rtt(self, rtt: float):
+        if self._rtt is None:
+            self._rtt = rtt
+        else:
+            self._rtt += RTT_SMOOTHING * (rtt - self._rtt)
 
-    def restore_connection(self, ws: WebSocket):
-        self._network_connection.restore_connection(ws)
+    def set_credits(self, credits: int):
+        self._credits = credits
+        self.on_load_changed()
+
+    def estimate_task_time(self, task: Task) -> float:
+        return self._estimator.estimate_task_time(task)
+
+    def restore_connection(self, ws: WebSocket, features: Iterable[str] = ()):
+        self._network_connection.restore_connection(ws, features)
         self.stop_offline()
 
     def update_public_meta_info(self, meta_info: PublicMetaInfo):
         self._pub_meta_info = meta_info
+        if meta_info.credits is not None:
+            self._credits = meta_info.credits
+        if self._on_meta_info_updated_callback is not None:
+            self._on_meta_info_updated_callback()
 
     def update_private_meta_info(self, meta_info: PrivateMetaInfo):
         self._pr_meta_info = meta_info
 
+    def reclaim_task(self, task: Task):
+        """Takes back a task the node was sent before the backend restarted,
+        the node still has it, so it is not sent again."""
+        self._in_progress.add(task)
+        self._unstarted[task] = None
+        self._estimator.add_task(task)
+        self.on_load_changed()
+
+    def take_tasks_in_progress(self) -> list[Task]:
+        """Removes all the tasks in progress, so they can be scheduled to
+        other providers."""
+        tasks = list(self._in_progress)
+        for task in tasks:
+            self._estimator.remove_task(task)
+        self._in_progress.clear()
+        self._unstarted.clear()
+        self._batch.clear()
+        self.on_load_changed()
+        return tasks
+
     async def schedule_task(self, task: Task):
-        try:
-            self._in_progress.add(task)
-            await self._network_connection.send_task(task)
-        except (ConnectionClosed, WebSocketDisconnect):
-            logger.warning(
-                "got ConnectionClosed exception on send_task in provider {id}".format(id=self._id))
-            await self.on_closed()
-        except Exception as e:
-            logger.error(f"unhandled exception in schedule_task: {e}")
-            await self.on_closed()
+        """Hands the task to the provider, the task is sent by the writer of
+        the provider, so a slow node does not hold up the scheduling."""
+        self._in_progress.add(task)
+        self._unstarted[task] = None
+        self._estimator.add_task(task)
+        self.on_load_changed()
+
+        if self._network_connection.supports_batching:
+            self._batch.append(task)
+            if len(self._batch) >= MAX_BATCH_SIZE:
+                self._send_batch()
+            elif self._batch_future is None:
+                self._batch_future = asyncio.ensure_future(
+                    self._send_batch_later())
+            return
+
+        self._enqueue(self._send_task, task)
+
+    async def _send_batch_later(self):
+        await asyncio.sleep(BATCH_WINDOW)
+        self._batch_future = None
+        self._send_batch()
+
+    def _send_batch(self):
+        if self._batch_future is not None:
+            self._batch_future.cancel()
+            self._batch_future = None
+
+        tasks = self._batch
+        self._batch = list()
+        if tasks:
+            self._enqueue(self._send_tasks, tasks)
 
     async def abort_task(self, task: Task):
         if task not in self._in_progress:
@@ -108,29 +269,93 @@ class Provider:
                 f"abort_task called on task {task.id} not in progress")
             return
 
-        try:
-            self._in_progress.remove(task)
-            task.set_status(TaskStatusPayload(task_status=TaskStatus.ABORTED))
-            await self._network_connection.abort_task(task)
-        except (ConnectionClosed, WebSocketDisconnect):
-            logger.warning(
-                "got ConnectionClosed exception on abort_task in provider {id}".format(id=self._id))
-            await self.on_closed()
-        except Exception as e:
-            logger.error(f"unhandled exception in abort_task: {e}")
-            await self.on_closed()
+        self._in_progress.remove(task)
+        self._unstarted.pop(task, None)
+        self._estimator.remove_task(task)
+        self.on_load_changed()
+        task.set_status(TaskStatusPayload(task_status=TaskStatus.ABORTED))
+        self._enqueue(self._network_connection.abort_task, task)
+
+    def send_blob(self, reply: dict):
+        """Queues the reply to a blob request of the node behind the other
+        sends, so a large blob does not hold up reading from the node."""
+        self._enqueue(self._network_connection.send_blob, reply)
+
+    def _enqueue(self, send: Callable[[Any], Awaitable[None]], payload: Any):
+        self._outbox.append((send, payload))
+        # A full outbox takes the provider out of scheduling
+        if len(self._outbox) == MAX_OUTBOX_SIZE:
+            self.on_load_changed()
+        if self._writer_future is None:
+            self._writer_future = asyncio.ensure_future(self._write_outbox())
+
+    async def _write_outbox(self):
+        while self._outbox:
+            send, payload = self._outbox[0]
+            try:
+                await send(payload)
+            except (ConnectionClosed, WebSocketDisconnect):
+                logger.warning(
+                    "got ConnectionClosed exception on {send} in provider {id}".format(
+                        send=send.__name__.lstrip("_"), id=self._id))
+                await self._close_outbox()
+                return
+            except Exception as e:
+                logger.error(
+                    f"unhandled exception in {send.__name__.lstrip('_')}: {e}")
+                await self._close_outbox()
+                return
+
+            self._outbox.popleft()
+            if len(self._outbox) == MAX_OUTBOX_SIZE - 1:
+                self.on_load_changed()
+        self._writer_future = None
+
+    async def _close_outbox(self):
+        self._outbox.clear()
+        self._writer_future = None
+        await self.on_closed()
+
+    # Tasks aborted or rescheduled while waiting in the outbox are skipped
+
+    async def _send_task(self, task: Task):
+        if task in self._in_progress:
+            await self._network_connection.send_task(task)
+
+    async def _send_tasks(self, tasks: list[Task]):
+        tasks = [task for task in tasks if task in self._in_progress]
+        if tasks:
+            await self._network_connection.send_tasks(tasks)
+
+    def task_started(self, task: Task):
+        if task not in self._in_progress:
+            return
+        reported_first = not self._reports_started
+        self._reports_started = True
+        self._estimator.task_started(task)
+        if task in self._unstarted:
+            del self._unstarted[task]
+        elif not reported_first:
+            return
+        self.on_load_changed()
 
     def task_failed(self, task: Task, fail_reason: str):
         if task not in self._in_progress:
             return
         self._in_progress.remove(task)
+        self._unstarted.pop(task, None)
+        self._estimator.remove_task(task)
+        self.on_load_changed()
         task.set_status(FailedByProvider(reason=fail_reason))
 
     def task_completed(self, task: Task):
         if task not in self._in_progress:
             return
         self._in_progress.remove(task)
+        self._unstarted.pop(task, None)
         task.set_status(TaskStatusPayload(task_status=TaskStatus.COMPLETED))
+        self._estimator.task_completed(task)
+        self.on_load_changed()
 
     def set_on_closed(self, callback: Callable[[], None]):
         self._on_closed_callback = callback
@@ -138,6 +363,16 @@ class Provider:
     def set_on_connection_lost(self, callback: Callable[[], None]):
         self._on_connection_lost_callback = callback
 
+    def set_on_load_changed(self, callback: Callable[[], None]):
+        self._on_load_changed_callback = callback
+
+    def set_on_meta_info_updated(self, callback: Callable[[], None]):
+        self._on_meta_info_updated_callback = callback
+
+    def on_load_changed(self):
+        if self._on_load_changed_callback is not None:
+            self._on_load_changed_callback()
+
     async def on_closed(self):
         if self._on_closed_callback is None:
             logger.warning(
@@ -154,5 +389,5 @@ class Provider:
                     id=self._id)
             )
             return
-        await self.start_offline()
+        self.start_offline()
         await self._on_connection_lost_callback()
@@ -0,0 +1,91 @@
+from dispatcher.task import Task
+from dispatcher.task_info import TaskStatus
+
+import time
+
+# Service time in seconds assumed for a pipeline class the provider
+# has not completed yet
+DEFAULT_SERVICE_TIME = 10.0
+# Weight of the latest observation in the running average
+SMOOTHING_FACTOR = 0.2
+
+
+def pipeline_class(task: Task) -> str:
+    task_options = task.task_options
+    if task_options is not None and task_options.standard_pipeline:
+        return "standard:" + (task_options.standard_pipeline.model or "")
+    if task_options is not None and task_options.comfy_pipeline:
+        return "comfy:" + ",".join(sorted(task.required_models))
+    return "unknown"
+
+
+class ProviderEstimator:
+    """Estimates when a provider will be done with its queue.
+
+    Keeps an exponential moving average of the provider's service time per
+    pipeline class, measured for every task from its start, as reported by
+    the node, or else from its SENT timestamp in the task log, to its
+    completion. Tasks run in parallel on nodes taking several of them, so
+    the sum of the estimates of the tasks in progress is shared among the
+    most tasks the node has been seen running at once.
+    """
+
+    def __init__(self):
+        self._service_times: dict[str, float] = dict()
+        self._estimated_time: dict[Task, float] = dict()
+        self._total_estimated_time = 0.0
+        # Tasks the node reported as started and their start times
+        self._started_at: dict[Task, float] = dict()
+        self._concurrency = 1
+
+    def add_task(self, task: Task) -> None:
+        if task in self._estimated_time:
+            return
+        estimated_time = self.estimate_task_time(task)
+        self._estimated_time[task] = estimated_time
+        self._total_estimated_time += estimated_time
+
+    def remove_task(self, task: Task) -> None:
+        self._started_at.pop(task, None)
+        estimated_time = self._estimated_time.pop(task, None)
+        if estimated_time is None:
+            return
+        self._total_estimated_time = max(
+            self._total_estimated_time - estimated_time, 0.0)
+
+    def task_started(self, task: Task) -> None:
+        if task not in self._estimated_time or task in self._started_at:
+            return
+        self._started_at[task] = time.monotonic()
+        self._concurrency = max(self._concurrency, len(self._started_at))
+
+    def task_completed(self, task: Task) -> None:
+        started_at = self._started_at.get(task)
+        self.remove_task(task)
+        if started_at is None:
+            started_at = task.get_status_timestamp(TaskStatus.SENT)
+        if started_at is None:
+            started_at = task.get_status_timestamp(TaskStatus.SCHEDULED)
+        completed_at = task.get_status_timestamp(TaskStatus.COMPLETED)
+        if started_at is None or completed_at is None:
+            return
+        service_time = max(completed_at - started_at, 0.0)
+
+        key = pipeline_class(task)
+        if key in self._service_times:
+            self._service_times[key] += SMOOTHING_FACTOR * \
+                (service_time - self._service_times[key])
+        else:
+            self._service_times[key] = service_time
+
+    @property
+    def concurrency(self) -> int:
+        """Most tasks the node has been seen running at once."""
+        return self._concurrency
+
+    def get_waiting_time(self) -> float:
+        """Returns the time until a new task can be started."""
+        return self._total_estimated_time / self._concurrency
+
+    def estimate_task_time(self, task: Task) -> float:
+        return self._service_times.get(pipeline_class(task), DEFAULT_SERVICE_TIME)
@@ -0,0 +1,167 @@
+from dispatcher.provider import Provider
+
+from typing import Callable, Iterator
+import heapq
+import itertools
+import math
+
+
+class _ProviderHeap:
+    """Min-heap of providers that tracks the position of every provider,
+    so an update moves the provider's entry in place."""
+
+    def __init__(self):
+        self._positions: dict[str, int] = dict()
+        self._heap: list[tuple[float, int, Provider]] = list()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, entry: tuple[float, int, Provider]) -> None:
+        provider = entry[-1]
+        position = self._positions.get(provider.id)
+        if position is None:
+            self._heap.append(entry)
+            self._positions[provider.id] = len(self._heap) - 1
+            self._sift_up(len(self._heap) - 1)
+        else:
+            self._heap[position] = entry
+            self._sift_up(position)
+            self._sift_down(self._positions[provider.id])
+
+    def __iter__(self) -> Iterator[Provider]:
+        # Walks the heap lazily, so taking the first k providers costs
+        # O(k log k)
+        heap = self._heap
+        candidates = [(heap[0][0], heap[0][1], 0)] if heap else []
+        while candidates:
+            _, _, i = heapq.heappop(candidates)
+            yield heap[i][-1]
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap):
+                    heapq.heappush(
+                        candidates, (heap[child][0], heap[child][1], child))
+
+    def delete(self, provider_id: str) -> None:
+        position = self._positions.pop(provider_id, None)
+        if position is None:
+            return
+        last = self._heap.pop()
+        if position == len(self._heap):
+            return
+        self._heap[position] = last
+        self._positions[last[-1].id] = position
+        self._sift_up(position)
+        self._sift_down(self._positions[last[-1].id])
+
+    def _sift_up(self, i: int) -> None:
+        heap = self._heap
+        entry = heap[i]
+        while i > 0:
+            parent = (i - 1) // 2
+            if heap[parent] <= entry:
+                break
+            heap[i] = heap[parent]
+            self._positions[heap[i][-1].id] = i
+            i = parent
+        heap[i] = entry
+        self._positions[entry[-1].id] = i
+
+    def _sift_down(self, i: int) -> None:
+        heap = self._heap
+        entry = heap[i]
+        while True:
+            child = 2 * i + 1
+            if child >= len(heap):
+                break
+            if child + 1 < len(heap) and heap[child + 1] < heap[child]:
+                child += 1
+            if entry <= heap[child]:
+                break
+            heap[i] = heap[child]
+            self._positions[heap[i][-1].id] = i
+            i = child
+        heap[i] = entry
+        self._positions[entry[-1].id] = i
+
+
+class ProviderIndex:
+    """Index of the eligible providers ordered by a load key and grouped
+    into tiers by price.
+
+    The dispatcher keeps the index in sync by calling `update` whenever the
+    load or the state of a provider changes, so picking the least loaded
+    provider of a tier costs O(log n) instead of a scan over every
+    provider. Providers are expected to advertise a handful of distinct
+    prices, so the tiers can be compared one by one.
+    """
+
+    def __init__(
+            self,
+            key: Callable[[Provider], float],
+            is_eligible: Callable[[Provider], bool],
+            tier: Callable[[Provider],
+                           float] = lambda provider: provider.price,
+    ):
+        self._key = key
+        self._is_eligible = is_eligible
+        self._tier = tier
+        self._providers: dict[str, Provider] = dict()
+        self._tier_of: dict[str, float] = dict()
+        self._tiers: dict[float, _ProviderHeap] = dict()
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._tier_of)
+
+    def __contains__(self, provider: Provider):
+        return provider.id in self._tier_of
+
+    def is_empty(self) -> bool:
+        return len(self._providers) == 0
+
+    def min_tier(self) -> float:
+        """Returns the lowest tier of an eligible provider, inf if there is
+        none."""
+        return min(self._tiers, default=math.inf)
+
+    def add(self, provider: Provider) -> None:
+        self._providers[provider.id] = provider
+        self.update(provider)
+
+    def remove(self, provider: Provider) -> None:
+        self._providers.pop(provider.id, None)
+        self._delete(provider.id)
+
+    def update(self, provider: Provider) -> None:
+        if self._providers.get(provider.id) is not provider:
+            return
+        is_eligible = self._is_eligible(provider)
+        tier = self._tier(provider)
+        if not is_eligible or self._tier_of.get(provider.id, tier) != tier:
+            self._delete(provider.id)
+        if not is_eligible:
+            return
+
+        if tier not in self._tiers:
+            self._tiers[tier] = _ProviderHeap()
+        self._tier_of[provider.id] = tier
+        # Equal keys are served in the order of the last update
+        self._tiers[tier].push(
+            (self._key(provider), next(self._counter), provider))
+
+    def tiers(self) -> Iterator[tuple[float, Iterator[Provider]]]:
+        """Yields the tiers in the ascending order of price, each with its
+        providers in the order of their keys. The index must not be
+        modified while iterating."""
+        for tier in sorted(self._tiers):
+            yield tier, iter(self._tiers[tier])
+
+    def _delete(self, provider_id: str) -> None:
+        tier = self._tier_of.pop(provider_id, None)
+        if tier is None:
+            return
+        heap = self._tiers[tier]
+        heap.delete(provider_id)
+        if len(heap) == 0:
+            del self._tiers[tier]
@@ -10,8 +10,18 @@ from dispatcher.task_info import (
 )
 
 import typing
+import json
+import struct
+import time
 from datetime import datetime
 
+# ComfyUI node inputs naming the checkpoint a pipeline needs
+COMFY_MODEL_INPUTS = ("ckpt_name",)
+
+# A status log entry is packed as the status code and the time.monotonic()
+# time, so the time between statuses is not changed by wall clock jumps
+_LOG_ENTRY = struct.Struct("<Bd")
+
 
 class TaskLog(typing.NamedTuple):
     date: datetime
@@ -19,11 +29,38 @@ class TaskLog(typing.NamedTuple):
 
 
 class Task:
-    def __init__(self, task_info: TaskInfo):
+    __slots__ = (
+        "_provider_id",
+        "_status",
+        "_log",
+        "_log_payloads",
+        "_task_info",
+        "_priority",
+        "_created_at",
+        "_clock_offset",
+        "_required_models",
+        "_node_payload",
+        "_on_status_changed_callback",
+    )
+
+    def __init__(self, task_info: TaskInfo, submitted_at: typing.Optional[float] = None):
         self._provider_id = None
         self._status = TaskStatus.UNSCHEDULED
-        self._log: list[TaskLog] = list()
+        self._log = bytearray()
+        # Entry index -> payload, only for payloads with more than a status
+        self._log_payloads: typing.Optional[dict[int,
+                                                 TaskStatusPayload]] = None
         self._task_info = task_info
+        self._priority = task_info.priority
+        # Wall clock time of the submission, kept across restarts
+        self._created_at = time.time() if submitted_at is None else submitted_at
+        # Wall clock time minus monotonic time, turns log times into dates
+        self._clock_offset = time.time() - time.monotonic()
+        self._required_models: typing.Optional[frozenset[str]] = None
+        # Options encoded for the nodes once, when the task is submitted
+        self._node_payload: typing.Optional[typing.Any] = None
+        self._on_status_changed_callback: typing.Optional[typing.Callable[[
+            "Task", TaskStatusPayload], None]] = None
 
     @property
     def id(self):
@@ -33,6 +70,10 @@ class Task:
     def status(self):
         return self._status
 
+    @property
+    def task_info(self):
+        return self._task_info
+
     @property
     def task_options(self):
         return self._task_info.task_options
@@ -41,6 +82,36 @@ class Task:
     def max_cost(self):
         return self._task_info.max_cost
 
+    @property
+    def priority(self):
+        return self._priority
+
+    @property
+    def created_at(self) -> datetime:
+        return datetime.fromtimestamp(self._created_at)
+
+    @property
+    def submitted_at(self) -> float:
+        """Creation time in seconds since the epoch."""
+        return self._created_at
+
+    @property
+    def gpu_type(self):
+        return self._task_info.gpu_type
+
+    @property
+    def required_models(self) -> frozenset[str]:
+        if self._required_models is None:
+            self._required_models = _get_required_models(self.task_options)
+        return self._required_models
+
+    @property
+    def node_payload(self):
+        return self._node_payload
+
+    def set_node_payload(self, payload: typing.Any) -> None:
+        self._node_payload = payload
+
     @property
     def provider_id(self):
         return self._provider_id
@@ -49,21 +120,82 @@ class Task:
     def time_to_money_ratio(self):
         return self._task_info.time_to_money_ratio
 
+    @property
+    def log(self) -> list[TaskLog]:
+        return [
+            TaskLog(date=self._log_date(timestamp),
+                    task_status_payload=self._log_payload(i, TaskStatus(code)))
+            for i, (code, timestamp) in enumerate(_LOG_ENTRY.iter_unpack(self._log))
+        ]
+
     def set_status(self, task_status_payload: TaskStatusPayload) -> None:
         self._status = task_status_payload.task_status
-        self._log.append(
-            TaskLog(date=datetime.now(), task_status_payload=task_status_payload)
-        )
+        if type(task_status_payload) is not TaskStatusPayload:
+            if self._log_payloads is None:
+                self._log_payloads = dict()
+            self._log_payloads[len(self._log) //
+                               _LOG_ENTRY.size] = task_status_payload
+        self._log += _LOG_ENTRY.pack(self._status.value, time.monotonic())
         if isinstance(task_status_payload, ScheduledPayload):
             self._provider_id = task_status_payload.provider_id
+        if self._on_status_changed_callback is not None:
+            self._on_status_changed_callback(self, task_status_payload)
+
+    def set_on_status_changed(self, callback: typing.Callable[["Task", TaskStatusPayload], None]):
+        self._on_status_changed_callback = callback
+
+    def get_status_time(self, status: TaskStatus) -> typing.Optional[datetime]:
+        timestamp = self.get_status_timestamp(status)
+        return self._log_date(timestamp) if timestamp is not None else None
+
+    def get_status_timestamp(self, status: TaskStatus) -> typing.Optional[float]:
+        """Returns the time.monotonic() time the task last got `status`."""
+        for offset in range(len(self._log) - _LOG_ENTRY.size, -1, -_LOG_ENTRY.size):
+            code, timestamp = _LOG_ENTRY.unpack_from(self._log, offset)
+            if code == status.value:
+                return timestamp
+        return None
+
+    def _log_date(self, timestamp: float) -> datetime:
+        return datetime.fromtimestamp(timestamp + self._clock_offset)
+
+    def _log_payload(self, index: int, status: TaskStatus) -> TaskStatusPayload:
+        if self._log_payloads is not None and index in self._log_payloads:
+            return self._log_payloads[index]
+        return TaskStatusPayload(task_status=status)
+
+    def set_priority(self, priority: int) -> None:
+        self._priority = priority
 
     def get_log_string(self):
         return "\n".join(
             t.strftime("%H:%M:%S %d/%m/%Y")
             + " "
             + task_status_payload_to_string(payload)
-            for t, payload in self._log
+            for t, payload in self.log
+        )
+
+
+def _get_required_models(task_options: typing.Optional[TaskOptions]) -> frozenset[str]:
+    if task_options is None:
+        return frozenset()
+    if task_options.standard_pipeline and task_options.standard_pipeline.model:
+        return frozenset([task_options.standard_pipeline.model])
+    if task_options.comfy_pipeline:
+        try:
+            nodes = json.loads(task_options.comfy_pipeline.pipeline_data)
+        except (TypeError, ValueError):
+            return frozenset()
+        if not isinstance(nodes, dict):
+            return frozenset()
+        return frozenset(
+            node["inputs"][name]
+            for node in nodes.values()
+            if isinstance(node, dict) and isinstance(node.get("inputs"), dict)
+            for name in COMFY_MODEL_INPUTS
+            if isinstance(node["inputs"].get(name), str)
         )
+    return frozenset()
 
 
 def build_task_from_query(task_id: str, **kwargs) -> Task:
@@ -71,11 +203,15 @@ def build_task_from_query(task_id: str, **kwargs) -> Task:
     time_to_money_ratio = kwargs.get('time_to_money_ratio')
     standard_pipeline = kwargs.get('standard_pipeline')
     comfy_pipeline = kwargs.get('comfy_pipeline')
+    priority = kwargs.get('priority', 0)
+    gpu_type = kwargs.get('gpu_type')
     task = Task(
         TaskInfo(**{
             'id': task_id,
             'max_cost': max_cost,
             'time_to_money_ratio': time_to_money_ratio,
+            'priority': priority,
+            'gpu_type': gpu_type,
             'task_options': TaskOptions(**{
                 'standard_pipeline': StandardPipelineOptions(**standard_pipeline) if standard_pipeline else None,
                 'comfy_pipeline': ComfyPipelineOptions(**{
@@ -87,3 +223,19 @@ def build_task_from_query(task_id: str, **kwargs) -> Task:
     )
 
     return task
+
+
+def restore_task(
+        task_info: TaskInfo,
+        status: TaskStatus,
+        provider_id: typing.Optional[str] = None,
+        submitted_at: typing.Optional[float] = None,
+) -> Task:
+    """Rebuilds a task read back from storage in its last known status."""
+    task = Task(task_info, submitted_at)
+    if provider_id is not None:
+        task.set_status(ScheduledPayload(
+            provider_id=provider_id, min_score=0, waiting_time=0))
+    if provider_id is None or status != TaskStatus.SCHEDULED:
+        task.set_status(TaskStatusPayload(task_status=status))
+    return task
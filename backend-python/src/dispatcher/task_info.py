@@ -2,6 +2,7 @@ from enum import Enum, auto
 from dataclasses import dataclass, asdict
 from typing import Optional
 import json
+import sys
 
 
 class TaskStatus(Enum):
@@ -13,87 +14,128 @@ class TaskStatus(Enum):
     COMPLETED = auto()
     FAILED = auto()
 
+    QUEUED = auto()
+
 
 class PublicTaskStatus(Enum):
     SUCCESS = auto()
     PENDING = auto()
+    FAILED = auto()
 
 
 def get_public_status(status: TaskStatus) -> PublicTaskStatus:
     if status == TaskStatus.COMPLETED:
         return PublicTaskStatus.SUCCESS
+    if status == TaskStatus.FAILED:
+        return PublicTaskStatus.FAILED
     return PublicTaskStatus.PENDING
 
 
-@dataclass
+def intern_optional(value: Optional[str]) -> Optional[str]:
+    # Model names, sizes and GPU types repeat across most tasks
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+# The task records use slots, hundreds of thousands of them may be alive
+@dataclass(slots=True)
 class ComfyPipelineOptions:
     pipeline_data: str
     pipeline_dependencies: str
+    # Content hashes nodes fetch the values by, see blob_store.py
+    pipeline_data_hash: Optional[str] = None
+    pipeline_dependencies_hash: Optional[str] = None
 
-    @property
-    def __dict__(self):
+    def to_dict(self):
         return asdict(self)
 
     @property
     def json(self):
-        return json.dumps(self.__dict__)
+        return json.dumps(self.to_dict())
 
 
-@dataclass
+@dataclass(slots=True)
 class StandardPipelineOptions:
     prompt: str
     model: str
     size: Optional[str] = None
     steps: Optional[int] = None
 
-    @property
-    def __dict__(self):
+    def __post_init__(self):
+        self.model = intern_optional(self.model)
+        self.size = intern_optional(self.size)
+
+    def to_dict(self):
         return asdict(self)
 
     @property
     def json(self):
-        return json.dumps(self.__dict__)
+        return json.dumps(self.to_dict())
 
 
-@dataclass
+@dataclass(slots=True)
 class TaskOptions:
     comfy_pipeline: Optional[ComfyPipelineOptions] = None
     standard_pipeline: Optional[StandardPipelineOptions] = None
 
-    @property
-    def __dict__(self):
-        print('22222')
+    def to_dict(self):
         return {
-            'comfy_pipeline':  self.comfy_pipeline.__dict__ if self.comfy_pipeline else None,
-            'standard_pipeline':  self.standard_pipeline.__dict__ if self.standard_pipeline else None
+            'comfy_pipeline':  self.comfy_pipeline.to_dict() if self.comfy_pipeline else None,
+            'standard_pipeline':  self.standard_pipeline.to_dict() if self.standard_pipeline else None
         }
 
     @property
     def json(self):
-        return json.dumps(self.__dict__)
+        return json.dumps(self.to_dict())
 
 
-@dataclass
+@dataclass(slots=True)
 class TaskInfo:
     id: str
     max_cost: int
     time_to_money_ratio: int
     task_options: Optional[TaskOptions] = None
+    priority: int = 0
+    gpu_type: Optional[str] = None
+
+    def __post_init__(self):
+        self.gpu_type = intern_optional(self.gpu_type)
+
+    @classmethod
+    def from_dict(cls, info: dict) -> "TaskInfo":
+        """Rebuilds the task info from the output of `to_dict`."""
+        options = info.get('task_options')
+        task_options = None
+        if options is not None:
+            standard_pipeline = options.get('standard_pipeline')
+            comfy_pipeline = options.get('comfy_pipeline')
+            task_options = TaskOptions(
+                standard_pipeline=StandardPipelineOptions(
+                    **standard_pipeline) if standard_pipeline else None,
+                comfy_pipeline=ComfyPipelineOptions(
+                    **comfy_pipeline) if comfy_pipeline else None
+            )
+        return cls(
+            id=info.get('id', 0),
+            max_cost=info.get('max_cost', 0),
+            time_to_money_ratio=info.get('time_to_money_ratio', 0),
+            priority=info.get('priority', 0),
+            gpu_type=info.get('gpu_type'),
+            task_options=task_options
+        )
 
-    @property
-    def __dict__(self):
-        print('11111')
-        # print(self.task_options.__dict__)
+    def to_dict(self):
         return {
             'id': self.id,
             'max_cost': self.max_cost,
             'time_to_money_ratio':  self.time_to_money_ratio,
-            'task_options':  self.task_options.__dict__ if self.task_options else None
+            'task_options':  self.task_options.to_dict() if self.task_options else None,
+            'priority': self.priority,
+            'gpu_type': self.gpu_type
         }
 
     @property
     def json(self):
-        return json.dumps(self.__dict__)
+        return json.dumps(self.to_dict())
 
 
 class TaskResultType(Enum):
@@ -116,12 +158,12 @@ class TaskResultClient:
     error: Optional[str] = None
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, slots=True)
 class TaskStatusPayload:
     task_status: TaskStatus
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, slots=True)
 class ScheduledPayload(TaskStatusPayload):
     provider_id: str
     min_score: int | float
@@ -129,7 +171,7 @@ class ScheduledPayload(TaskStatusPayload):
     task_status: TaskStatus = TaskStatus.SCHEDULED
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, slots=True)
 class FailedByProvider(TaskStatusPayload):
     reason: str
     task_status: TaskStatus = TaskStatus.FAILED
@@ -139,7 +181,7 @@ def task_status_payload_to_string(payload: TaskStatusPayload) -> str:
     if isinstance(payload, FailedByProvider):
         return "FAILED BY PROVIDER: reason={reason}".format(reason=payload.reason)
     elif isinstance(payload, ScheduledPayload):
-        return "ASSIGNED TO PROVIDER: provider_id={id}, min_score={score}, waiting_time={waiting_time}".format(
+        return "ASSIGNED TO PROVIDER: provider_id={provider_id}, min_score={score}, waiting_time={waiting_time}".format(
             provider_id=payload.provider_id,
             score=payload.min_score,
             waiting_time=payload.waiting_time,
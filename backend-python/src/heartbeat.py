@@ -0,0 +1,95 @@
+from dispatcher.util.logger import logger
+
+from typing import Any, Awaitable, Callable, Optional
+import asyncio
+import time
+
+# Feature a node lists in its register message if it answers every
+# {"type": "ping", "t": t} with {"type": "pong", "t": t}. Nodes without it
+# are never pinged, as they would look silent while idle.
+HEARTBEAT_FEATURE = "heartbeat"
+
+
+class Heartbeat:
+    """Pings the nodes with the heartbeat feature every `interval` seconds
+    and measures their round trip time from the pongs.
+
+    Any message of a node shows it is alive, a node silent for `timeout`
+    seconds is dropped and reported through the on silent callback, so the
+    tasks it holds do not wait on a half-dead connection.
+    """
+
+    def __init__(self, interval: float, timeout: float):
+        self._interval = interval
+        self._timeout = timeout
+        # node id -> connection the node is pinged through
+        self._connections: dict[str, Any] = dict()
+        # node id -> time.monotonic() of the last message of the node
+        self._last_seen: dict[str, float] = dict()
+        self._future: Optional[asyncio.Future] = None
+        self._on_silent_callback: Optional[Callable[[
+            str], Awaitable[None]]] = None
+
+    def __len__(self):
+        return len(self._connections)
+
+    def set_on_silent(self, callback: Callable[[str], Awaitable[None]]):
+        self._on_silent_callback = callback
+
+    def add_node(self, node_id: str, connection: Any) -> None:
+        self._connections[node_id] = connection
+        self._last_seen[node_id] = time.monotonic()
+        if self._interval > 0 and self._future is None:
+            self._future = asyncio.ensure_future(self._run())
+
+    def remove_node(self, node_id: str) -> None:
+        self._connections.pop(node_id, None)
+        self._last_seen.pop(node_id, None)
+
+    def seen(self, node_id: str) -> None:
+        if node_id in self._last_seen:
+            self._last_seen[node_id] = time.monotonic()
+
+    def pong(self, node_id: str, sent_at: Any) -> Optional[float]:
+        """Returns the round trip time of the ping answered by a pong, None
+        if the pong does not echo the time of a ping."""
+        now = time.monotonic()
+        if (node_id not in self._connections or isinstance(sent_at, bool)
+                or not isinstance(sent_at, (int, float)) or not 0 <= now - sent_at <= self._timeout):
+            logger.warning(f"Invalid pong {sent_at} from node {node_id}")
+            return None
+        return now - sent_at
+
+    async def check(self) -> None:
+        """Drops the silent nodes and pings the others."""
+        now = time.monotonic()
+        for node_id, connection in list(self._connections.items()):
+            if now - self._last_seen[node_id] > self._timeout:
+                logger.warning(
+                    f"Node {node_id} silent for {now - self._last_seen[node_id]:.1f} seconds")
+                self.remove_node(node_id)
+                if self._on_silent_callback is not None:
+                    await self._on_silent_callback(node_id)
+            else:
+                # A node slow to take the ping does not hold up the others
+                asyncio.ensure_future(self._ping(node_id, connection, now))
+
+    def close(self) -> None:
+        if self._future is not None:
+            self._future.cancel()
+            self._future = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"Heartbeat check failed: {e}")
+
+    async def _ping(self, node_id: str, connection: Any, now: float) -> None:
+        try:
+            await connection.send_json({"type": "ping", "t": now})
+        except Exception as e:
+            # The node is dropped once it has been silent for too long
+            logger.warning(f"Failed to ping node {node_id}: {e}")
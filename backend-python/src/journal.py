@@ -0,0 +1,239 @@
+from dispatcher.util.logger import logger
+from dispatcher.task import Task
+from dispatcher.task_info import ScheduledPayload, TaskStatus, TaskStatusPayload
+
+from dataclasses import dataclass, replace
+from typing import Optional
+import json
+import os
+import threading
+import time
+
+# Seconds events are gathered before they are written and synced together
+JOURNAL_FLUSH_INTERVAL = 0.01
+# Events written between two compactions of the journal
+JOURNAL_COMPACTION_EVENTS = 100000
+
+SUBMITTED_EVENT = "submitted"
+# Statuses after which a task is not recovered
+TERMINAL_STATUSES = (TaskStatus.COMPLETED, TaskStatus.FAILED)
+
+
+@dataclass
+class JournaledTask:
+    user_id: int
+    info: dict
+    submitted_at: float
+    status: TaskStatus = TaskStatus.UNSCHEDULED
+    provider_id: Optional[str] = None
+
+
+def replay_journal(path: str) -> dict[str, JournaledTask]:
+    """Returns the tasks of the journal at `path` that are not completed or
+    failed, in their last journaled status."""
+    tasks: dict[str, JournaledTask] = dict()
+    if not os.path.exists(path):
+        return tasks
+
+    with open(path, "r") as journal:
+        for line_number, line in enumerate(journal, 1):
+            try:
+                event = json.loads(line)
+            except ValueError:
+                # The process may have died in the middle of a write
+                logger.warning(
+                    f"Skipping malformed journal line {line_number}")
+                continue
+            _apply_event(tasks, event)
+
+    # A task failed by a provider going offline is scheduled again, so only
+    # the last status tells whether the task is done
+    return {
+        task_id: task for task_id, task in tasks.items()
+        if task.status not in TERMINAL_STATUSES
+    }
+
+
+class TaskJournal:
+    """Append only log of the lifecycle events of the tasks.
+
+    Events are written by a background thread, which syncs the file once
+    for all the events gathered within `flush_interval`, so callers never
+    wait for the disk. `open` compacts the journal to the tasks recovered
+    from it before new events are appended, and the thread compacts it
+    again after every `compaction_events` written events.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            flush_interval: float = JOURNAL_FLUSH_INTERVAL,
+            compaction_events: int = JOURNAL_COMPACTION_EVENTS,
+    ):
+        self._path = path
+        self._flush_interval = flush_interval
+        self._compaction_events = compaction_events
+        # The tasks as the written events left them, only the thread
+        # touches them once it runs
+        self._tasks: dict[str, JournaledTask] = dict()
+        # task id -> time.monotonic() the task failed at, a task failed by
+        # a provider going offline is scheduled again right away, so it
+        # is kept by the next compaction
+        self._failed_at: dict[str, float] = dict()
+        self._compacted_at = 0.0
+        self._events_since_compaction = 0
+        self._events: list[dict] = list()
+        self._writing = False
+        self._condition = threading.Condition()
+        self._closed = False
+        self._file = None
+        self._thread: Optional[threading.Thread] = None
+
+    def open(self, tasks: dict[str, JournaledTask]) -> None:
+        self._tasks = {task_id: replace(task)
+                       for task_id, task in tasks.items()}
+        self._compact()
+        self._thread = threading.Thread(
+            target=self._run, name="task-journal", daemon=True)
+        self._thread.start()
+
+    def task_submitted(self, user_id: int, task: Task) -> None:
+        self._append(_submitted_event(
+            task.id, user_id, task.task_info.to_dict(), task.submitted_at))
+
+    def task_status_changed(self, task: Task, payload: TaskStatusPayload) -> None:
+        provider_id = payload.provider_id if isinstance(
+            payload, ScheduledPayload) else None
+        self._append(_status_event(task.id, payload.task_status, provider_id))
+
+    def flush(self) -> None:
+        """Waits until every event appended so far is synced."""
+        with self._condition:
+            self._condition.notify_all()
+            self._condition.wait_for(
+                lambda: not self._events and not self._writing)
+
+    def close(self) -> None:
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        if self._file is not None:
+            self._file.close()
+
+    def _append(self, event: dict) -> None:
+        with self._condition:
+            if self._closed:
+                logger.warning(f"Task journal closed, dropping event {event}")
+                return
+            self._events.append(event)
+            self._condition.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._events or self._closed)
+                if not self._events:
+                    return
+                if not self._closed:
+                    self._condition.wait(self._flush_interval)
+                events, self._events = self._events, list()
+                self._writing = True
+
+            try:
+                self._file.write("".join(map(_encode, events)))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except OSError as e:
+                logger.error(
+                    f"Failed to write {len(events)} journal events: {e}")
+            else:
+                self._events_written(events)
+            finally:
+                with self._condition:
+                    self._writing = False
+                    self._condition.notify_all()
+
+    def _events_written(self, events: list[dict]) -> None:
+        now = time.monotonic()
+        for event in events:
+            task = _apply_event(self._tasks, event)
+            if task is not None and task.status == TaskStatus.FAILED:
+                self._failed_at[event["id"]] = now
+        self._events_since_compaction += len(events)
+        if self._events_since_compaction >= self._compaction_events:
+            try:
+                self._compact()
+            except OSError as e:
+                # The journal keeps growing until the next compaction
+                logger.error(f"Failed to compact the journal: {e}")
+                self._events_since_compaction = 0
+
+    def _compact(self) -> None:
+        """Rewrites the journal with the events of the tasks not done."""
+        for task_id, task in list(self._tasks.items()):
+            failed_at = self._failed_at.get(task_id)
+            if task.status == TaskStatus.COMPLETED or (
+                    task.status == TaskStatus.FAILED and failed_at is not None
+                    and failed_at < self._compacted_at):
+                del self._tasks[task_id]
+                self._failed_at.pop(task_id, None)
+            elif task.status != TaskStatus.FAILED:
+                self._failed_at.pop(task_id, None)
+
+        compacted_path = self._path + ".compacted"
+        with open(compacted_path, "w") as compacted:
+            for task_id, task in self._tasks.items():
+                compacted.write(_encode(_submitted_event(
+                    task_id, task.user_id, task.info, task.submitted_at)))
+                if task.status != TaskStatus.UNSCHEDULED:
+                    compacted.write(_encode(_status_event(
+                        task_id, task.status, task.provider_id)))
+            compacted.flush()
+            os.fsync(compacted.fileno())
+        os.replace(compacted_path, self._path)
+
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self._path, "a")
+        self._compacted_at = time.monotonic()
+        self._events_since_compaction = 0
+
+
+def _apply_event(tasks: dict[str, JournaledTask], event: dict) -> Optional[JournaledTask]:
+    """Updates the task of the event, returns None for events of unknown
+    tasks."""
+    if event["e"] == SUBMITTED_EVENT:
+        task = JournaledTask(
+            user_id=event["user_id"], info=event["info"], submitted_at=event["t"])
+        tasks[event["id"]] = task
+        return task
+
+    task = tasks.get(event["id"])
+    if task is None:
+        return None
+    task.status = TaskStatus[event["e"].upper()]
+    # Compaction keeps the provider of a sent task on its status
+    if "provider_id" in event:
+        task.provider_id = event["provider_id"]
+    elif task.status in (TaskStatus.QUEUED, TaskStatus.ABORTED):
+        task.provider_id = None
+    return task
+
+
+def _submitted_event(task_id: str, user_id: int, info: dict, submitted_at: float) -> dict:
+    return {"e": SUBMITTED_EVENT, "id": task_id, "user_id": user_id, "info": info, "t": submitted_at}
+
+
+def _status_event(task_id: str, status: TaskStatus, provider_id: Optional[str]) -> dict:
+    event = {"e": status.name.lower(), "id": task_id}
+    if provider_id is not None:
+        event["provider_id"] = provider_id
+    return event
+
+
+def _encode(event: dict) -> str:
+    return json.dumps(event) + "\n"
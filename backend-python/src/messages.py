@@ -0,0 +1,64 @@
+from constants.static import COMFY_BLOB_OPTIONS_SCHEMA, REGISTER_SCHEMA, TASK_RESULT_SCHEMA, TASK_SCHEMA
+
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
+from typing import Any, Optional
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def compile_schema(schema: dict):
+    """Builds the validator of `schema` once, `jsonschema.validate` builds
+    a new one on every call."""
+    validator_class = validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema)
+
+
+TASK_RESULT_VALIDATOR = compile_schema(TASK_RESULT_SCHEMA)
+# Outbound tasks are validated a part at a time, so the encoded pipelines
+# can be reused without validating them again
+TASK_OPTIONS_VALIDATOR = compile_schema(
+    TASK_SCHEMA["definitions"]["TaskZod"]["properties"]["options"])
+# The options of a task sent to a node with the blobs feature hold the
+# hashes of the pipeline in place of the pipeline
+TASK_COMFY_OPTIONS_VALIDATOR = compile_schema({"$schema": TASK_SCHEMA["$schema"], "anyOf": [
+    COMFY_BLOB_OPTIONS_SCHEMA,
+    TASK_SCHEMA["definitions"]["TaskZod"]["properties"]["comfyOptions"],
+]})
+REGISTER_VALIDATOR = compile_schema(REGISTER_SCHEMA)
+
+
+class InvalidMessage(ValueError):
+    pass
+
+
+def loads(data: str | bytes) -> Any:
+    # orjson parses node messages several times faster, if it is installed
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def decode_message(data: str | bytes) -> dict:
+    """Parses a message of a node, raises `InvalidMessage` if it is not a
+    JSON object."""
+    try:
+        message = loads(data)
+    except ValueError as e:
+        raise InvalidMessage(f"Malformed JSON: {e}")
+    if not isinstance(message, dict):
+        raise InvalidMessage("A message must be a JSON object")
+    return message
+
+
+def schema_error(validator, instance: Any) -> Optional[str]:
+    """Returns why `instance` does not match the schema of `validator`,
+    None if it does."""
+    if validator.is_valid(instance):
+        return None
+    return best_match(validator.iter_errors(instance)).message
@@ -0,0 +1,233 @@
+from messages import InvalidMessage, decode_message, loads
+
+from fastapi import WebSocket, WebSocketDisconnect
+from typing import Any, Iterable, Optional
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Features a node may list in its register message to change the encoding
+# of the frames after it. With "msgpack" binary frames hold MessagePack
+# instead of JSON, with "deflate" every binary frame is compressed with
+# zlib, and JSON messages of at least COMPRESSION_THRESHOLD bytes are sent
+# as such binary frames. Text frames always hold plain JSON.
+MSGPACK_FEATURE = "msgpack"
+DEFLATE_FEATURE = "deflate"
+ENCODING_FEATURES = (MSGPACK_FEATURE, DEFLATE_FEATURE)
+
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_LEVEL = 6
+# Header of a zlib stream compressed at COMPRESSION_LEVEL
+_ZLIB_HEADER = b"\x78\x9c"
+
+
+def _encode_json(value: Any) -> str:
+    # The encoding of WebSocket.send_json
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+def _deflate_block(data: bytes, final: bool = False) -> bytes:
+    # Raw deflate blocks ending on a full flush do not refer to the data
+    # before them, so blocks compressed apart can be joined into one stream
+    compressor = zlib.compressobj(
+        COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_FULL_FLUSH)
+
+
+class EncodedPart:
+    """A value shared by many messages, such as the options of a ComfyUI
+    pipeline, with its JSON text.
+
+    Its MessagePack encoding and the deflated forms of both encodings are
+    made on first use and kept, so the frames of the messages holding it
+    do not encode it again.
+    """
+
+    __slots__ = ("text", "_value", "_data", "_deflated")
+
+    def __init__(self, text: str, value: Optional[Any] = None):
+        self.text = text
+        # Parts kept by many tasks do not keep their value, it is decoded
+        # from the text for the first binary frame
+        self._value = value
+        # binary -> encoding of the part, and its deflated form, made for
+        # the nodes asking for binary frames only
+        self._data: Optional[dict[bool, bytes]] = None
+        self._deflated: Optional[dict[bool, bytes]] = None
+
+    def data(self, binary: bool) -> bytes:
+        if self._data is None:
+            self._data = dict()
+        data = self._data.get(binary)
+        if data is None:
+            if not binary:
+                data = self.text.encode()
+            elif self._value is not None:
+                data = msgpack.packb(self._value)
+            else:
+                data = msgpack.packb(loads(self.text))
+            self._data[binary] = data
+        return data
+
+    def deflated(self, binary: bool) -> bytes:
+        if self._deflated is None:
+            self._deflated = dict()
+        deflated = self._deflated.get(binary)
+        if deflated is None:
+            deflated = self._deflated[binary] = _deflate_block(
+                self.data(binary))
+        return deflated
+
+
+class NodeMessage(str):
+    """A message encoded as JSON, holding `EncodedPart`s anywhere in its
+    dicts and lists. Its binary frames are put together from the kept
+    encodings of the parts and the encodings of the rest of the message."""
+
+    def __new__(cls, value: Any):
+        message = super().__new__(cls, "".join(
+            part if isinstance(part, str) else part.text for part in _parts(value, False)))
+        message.value = value
+        return message
+
+    def frame(self, binary: bool, compressed: bool) -> bytes:
+        parts = [part.encode() if isinstance(part, str)
+                 else part for part in _parts(self.value, binary)]
+        data = [part.data(binary) if isinstance(
+            part, EncodedPart) else part for part in parts]
+        if not compressed:
+            return b"".join(data)
+        blocks = [part.deflated(binary) if isinstance(part, EncodedPart) else _deflate_block(part)
+                  for part in parts]
+        checksum = 1
+        for part_data in data:
+            checksum = zlib.adler32(part_data, checksum)
+        return b"".join((_ZLIB_HEADER, *blocks, _deflate_block(b"", final=True), checksum.to_bytes(4, "big")))
+
+
+def _parts(value: Any, binary: bool) -> list[bytes | str | EncodedPart]:
+    """Returns the encoding of `value` as the `EncodedPart`s it holds and
+    the bytes between them, or str pieces of its JSON if not `binary`."""
+    parts: list = list()
+    pending: list = list()
+
+    def add(piece: Any) -> None:
+        if isinstance(piece, EncodedPart):
+            if pending:
+                parts.append(_join(pending, binary))
+                pending.clear()
+            parts.append(piece)
+        else:
+            pending.append(piece)
+
+    _walk(value, binary, add, msgpack.Packer() if binary else None)
+    if pending:
+        parts.append(_join(pending, binary))
+    return parts
+
+
+def _join(pieces: list, binary: bool) -> bytes | str:
+    return b"".join(pieces) if binary else "".join(pieces)
+
+
+def _walk(value: Any, binary: bool, add, packer: Optional[Any]) -> None:
+    if isinstance(value, EncodedPart):
+        add(value)
+    elif isinstance(value, dict):
+        add(packer.pack_map_header(len(value)) if binary else "{")
+        for i, (key, item) in enumerate(value.items()):
+            add(packer.pack(key) if binary else (
+                "," if i else "") + _encode_json(key) + ":")
+            _walk(item, binary, add, packer)
+        if not binary:
+            add("}")
+    elif isinstance(value, (list, tuple)):
+        add(packer.pack_array_header(len(value)) if binary else "[")
+        for i, item in enumerate(value):
+            if i and not binary:
+                add(",")
+            _walk(item, binary, add, packer)
+        if not binary:
+            add("]")
+    else:
+        add(packer.pack(value) if binary else _encode_json(value))
+
+
+class NodeWebSocket:
+    """WebSocket of a node, encoding and decoding its frames as negotiated
+    in the register message.
+
+    The dispatcher sends through it the same way whatever the encoding,
+    so it stands for the node's connection in the `Backend`.
+    """
+
+    def __init__(self, ws: WebSocket):
+        self.ws = ws
+        self.binary = False
+        self.compressed = False
+
+    def negotiate(self, features: Iterable[str]) -> list[str]:
+        """Switches to the encodings the node asked for and the backend
+        supports, returns their features."""
+        features = set(features)
+        self.binary = MSGPACK_FEATURE in features and msgpack is not None
+        self.compressed = DEFLATE_FEATURE in features
+        return [
+            feature for feature, enabled in
+            ((MSGPACK_FEATURE, self.binary), (DEFLATE_FEATURE, self.compressed))
+            if enabled
+        ]
+
+    async def receive(self) -> str | bytes:
+        frame = await self.ws.receive()
+        if frame["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(frame.get("code", 1000))
+        return frame["text"] if frame.get("text") is not None else frame["bytes"]
+
+    def decode(self, data: str | bytes) -> dict:
+        """Returns the message of a frame, raises `InvalidMessage` if the
+        frame does not hold an object."""
+        if isinstance(data, str):
+            return decode_message(data)
+        try:
+            if self.compressed:
+                data = zlib.decompress(data)
+            message = msgpack.unpackb(data) if self.binary else loads(data)
+        except Exception as e:
+            raise InvalidMessage(f"Malformed binary frame: {e}")
+        if not isinstance(message, dict):
+            raise InvalidMessage("A message must be an object")
+        return message
+
+    async def send_json(self, data: Any):
+        if self.binary:
+            await self._send_binary(msgpack.packb(data))
+        elif self.compressed:
+            await self.send_text(json.dumps(data, separators=(",", ":"), ensure_ascii=False))
+        else:
+            await self.ws.send_json(data)
+
+    async def send_text(self, text: str):
+        """Sends a message encoded as JSON already, the binary frames of a
+        `NodeMessage` reuse the encodings of its parts."""
+        if isinstance(text, NodeMessage) and (
+                self.binary or self.compressed and len(text) >= COMPRESSION_THRESHOLD):
+            await self.ws.send_bytes(text.frame(self.binary, self.compressed))
+        elif self.binary:
+            await self._send_binary(msgpack.packb(loads(text)))
+        elif self.compressed and len(text) >= COMPRESSION_THRESHOLD:
+            await self._send_binary(text.encode())
+        else:
+            await self.ws.send_text(text)
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        await self.ws.close(code=code, reason=reason)
+
+    async def _send_binary(self, data: bytes):
+        if self.compressed:
+            data = zlib.compress(data, COMPRESSION_LEVEL)
+        await self.ws.send_bytes(data)
@@ -0,0 +1,111 @@
+from dispatcher.task import Task
+
+from collections import OrderedDict
+from typing import Any, NamedTuple, Optional
+import time
+
+RESULT_CACHE_SIZE = 10000
+RESULT_CACHE_TTL = 3600
+
+
+class _CachedResult(NamedTuple):
+    expires_at: float
+    results_url: Any
+
+
+def pipeline_key(task: Task, user_id: int) -> Optional[str]:
+    """Returns the key of a task's ComfyUI pipeline and dependencies for
+    the user submitting it, None for tasks without one. ComfyUI graphs
+    carry their seeds, so the same key gives the same images. Results are
+    not shared between users, their URLs may not be public."""
+    options = task.task_options
+    pipeline = options.comfy_pipeline if options is not None else None
+    if pipeline is None or pipeline.pipeline_data_hash is None:
+        return None
+    return f"{user_id}:{pipeline.pipeline_data_hash}:{pipeline.pipeline_dependencies_hash or ''}"
+
+
+class ResultCache:
+    """Results of completed pipelines by pipeline key, and the pipelines
+    being executed with the tasks of the same user waiting for them.
+
+    Results are kept the least recently used first up to `size` of them,
+    each for `ttl` seconds.
+    """
+
+    def __init__(self, size: int = RESULT_CACHE_SIZE, ttl: float = RESULT_CACHE_TTL):
+        self._size = size
+        self._ttl = ttl
+        self._results: OrderedDict[str, _CachedResult] = OrderedDict()
+        # pipeline key -> id of the task executing the pipeline
+        self._leaders: dict[str, str] = dict()
+        # id of a task executing a pipeline -> (pipeline key, tasks waiting for it)
+        self._in_flight: dict[str, tuple[str, list[Task]]] = dict()
+        # id of a task waiting for a pipeline -> id of the task executing it
+        self._following: dict[str, str] = dict()
+        self.hits = 0
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def get(self, key: str) -> Optional[Any]:
+        cached = self._results.get(key)
+        if cached is None:
+            return None
+        if cached.expires_at <= time.monotonic():
+            del self._results[key]
+            return None
+        self._results.move_to_end(key)
+        self.hits += 1
+        return cached.results_url
+
+    def put(self, key: str, results_url: Any) -> None:
+        self._results[key] = _CachedResult(
+            time.monotonic() + self._ttl, results_url)
+        self._results.move_to_end(key)
+        while len(self._results) > self._size:
+            self._results.popitem(last=False)
+
+    def start(self, key: str, task_id: str) -> None:
+        """Marks the pipeline as executed by the task `task_id`."""
+        self._leaders[key] = task_id
+        self._in_flight[task_id] = (key, list())
+
+    def follow(self, key: str, task: Task) -> bool:
+        """Makes `task` wait for the execution of the same pipeline, returns
+        False if the pipeline is not being executed."""
+        task_id = self._leaders.get(key)
+        if task_id is None:
+            return False
+        self._in_flight[task_id][1].append(task)
+        self._following[task.id] = task_id
+        self.coalesced += 1
+        return True
+
+    def unfollow(self, task: Task) -> bool:
+        """Stops `task` waiting for the execution of its pipeline, returns
+        False if it was not waiting."""
+        task_id = self._following.pop(task.id, None)
+        if task_id is None:
+            return False
+        self._in_flight[task_id][1].remove(task)
+        return True
+
+    def finish(self, task_id: str) -> tuple[Optional[str], list[Task]]:
+        """Ends the execution by the task `task_id`, returns the pipeline key
+        and the tasks that waited for it."""
+        key, followers = self._in_flight.pop(task_id, (None, []))
+        if key is not None:
+            del self._leaders[key]
+        for task in followers:
+            del self._following[task.id]
+        return key, followers
+
+    def stats(self) -> dict:
+        return {
+            'cached_results': len(self._results),
+            'result_cache_hits': self.hits,
+            'coalesced_tasks': self.coalesced,
+            'pipelines_in_flight': len(self._leaders),
+        }
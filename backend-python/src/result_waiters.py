@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from typing import Optional
+import asyncio
+import time
+
+# Seconds a result nobody waits for yet is kept, the waiter of a task may
+# start waiting only after the node has already answered
+UNCLAIMED_RESULT_TTL = 60
+MAX_UNCLAIMED_RESULTS = 1000
+
+
+class ResultWaiters:
+    """Lets handlers wait for the result message of a task.
+
+    Every task being waited for has a single future shared by all of its
+    waiters, removed once the result arrives or the last waiter gives up,
+    so the registry only holds tasks somebody is waiting for right now.
+    Results arriving before anybody waits are kept for a short while, at
+    most `max_unclaimed` of them.
+    """
+
+    def __init__(self, ttl: float = UNCLAIMED_RESULT_TTL, max_unclaimed: int = MAX_UNCLAIMED_RESULTS):
+        self._ttl = ttl
+        self._max_unclaimed = max_unclaimed
+        self._futures: dict[str, asyncio.Future] = dict()
+        self._waiter_counts: dict[str, int] = dict()
+        # task id -> (expiration time, message), the oldest first
+        self._unclaimed: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._futures) + len(self._unclaimed)
+
+    async def wait(self, task_id: str, timeout: Optional[float] = None) -> dict:
+        """Returns the result message of the task, raises
+        `asyncio.TimeoutError` if it does not arrive within `timeout`."""
+        self._evict_expired()
+        unclaimed = self._unclaimed.pop(task_id, None)
+        if unclaimed is not None:
+            return unclaimed[1]
+
+        future = self._futures.get(task_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._futures[task_id] = future
+        self._waiter_counts[task_id] = self._waiter_counts.get(task_id, 0) + 1
+        try:
+            # A timed out waiter must not cancel the future of the others
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        finally:
+            self._waiter_counts[task_id] -= 1
+            if self._waiter_counts[task_id] == 0:
+                del self._waiter_counts[task_id]
+                if self._futures.get(task_id) is future:
+                    del self._futures[task_id]
+                    future.cancel()
+
+    def set_result(self, task_id: str, message: dict) -> None:
+        future = self._futures.pop(task_id, None)
+        if future is not None:
+            if not future.done():
+                future.set_result(message)
+            return
+
+        self._evict_expired()
+        self._unclaimed.pop(task_id, None)
+        self._unclaimed[task_id] = (time.monotonic() + self._ttl, message)
+        while len(self._unclaimed) > self._max_unclaimed:
+            self._unclaimed.popitem(last=False)
+
+    def _evict_expired(self) -> None:
+        now = time.monotonic()
+        while self._unclaimed:
+            task_id, (expires_at, _) = next(iter(self._unclaimed.items()))
+            if expires_at > now:
+                break
+            del self._unclaimed[task_id]
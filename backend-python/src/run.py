@@ -1,28 +1,62 @@
-from constants.env import ENFORCE_JWT_AUTH, HTTP_WS_PORT, WS_TASK_TIMEOUT
-from constants.static import TASK_RESULT_SCHEMA
+from constants.env import (
+    BACKEND_WORKERS,
+    BROKER_SOCKET,
+    ENFORCE_JWT_AUTH,
+    HTTP_WS_PORT,
+    WS_PING_INTERVAL,
+    WS_PING_TIMEOUT,
+    WS_TASK_TIMEOUT,
+)
 
 from dispatcher.util.logger import logger
-from dispatcher.dispatcher import Dispatcher
-from dispatcher.meta_info import PrivateMetaInfo, PublicMetaInfo
-from dispatcher.provider import Provider
-from dispatcher.task import build_task_from_query
 from utils.query_check_result import QueryValidationResult
 
-from storage import StorageManager, UsersStorage
+from backend import Backend
+from broker import BrokerClient, run_broker
+from messages import REGISTER_VALIDATOR, InvalidMessage, schema_error
+from node_socket import ENCODING_FEATURES, NodeWebSocket
+from result_waiters import ResultWaiters
+from storage import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, decode_cursor, parse_public_status
 from verification import verify
-from ws_connection import WSConnection
 
+from contextlib import asynccontextmanager
+from typing import Optional
 import json
-import jsonschema
-import uuid
 import asyncio
+import math
+import multiprocessing
 import uvicorn
 from fastapi import FastAPI, WebSocket, Request, Response, status, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from websockets.exceptions import ConnectionClosed
 
 
-app = FastAPI()
+# With several workers every worker process talks to the broker process
+# owning the dispatcher and the storages
+backend = BrokerClient(BROKER_SOCKET) if BACKEND_WORKERS > 1 else Backend()
+
+# Tasks a single POST /v1/tasks/batch may submit
+MAX_BATCH_TASKS = 1000
+# Priorities a task may be submitted with
+MIN_PRIORITY = -1000
+MAX_PRIORITY = 1000
+
+result_waiters = ResultWaiters(ttl=WS_TASK_TIMEOUT)
+backend.add_result_listener(result_waiters.set_result)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if isinstance(backend, BrokerClient):
+        await backend.connect()
+    else:
+        await backend.start()
+    yield
+    await backend.close()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -31,25 +65,17 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
-dispatcher = Dispatcher()
-
-storage_manager = StorageManager()
-users_storage = UsersStorage()
-
-registered_providers = {}
 
-connections = {}
-task_ready = {}
-
-
-def find_key_by_value(dict, value):
-    return next((k for k, v in dict.items() if v == value), None)
-
-
-def check_data_and_state(
+async def check_data_and_state(
     data: dict, from_comfy_inf: bool = False
 ) -> QueryValidationResult:
-    token = data.get("token")
+    state_validation_res = await check_state(data.get("token"))
+    if not state_validation_res.is_ok:
+        return state_validation_res
+    return check_pipelines(data, from_comfy_inf)
+
+
+async def check_state(token: Optional[str]) -> QueryValidationResult:
     if ENFORCE_JWT_AUTH and not verify(token):
         return QueryValidationResult(
             is_ok=False,
@@ -57,13 +83,40 @@ def check_data_and_state(
             error_code=401,
         )
 
-    if len(registered_providers) == 0:
+    if await backend.available_nodes() == 0:
         return QueryValidationResult(
             is_ok=False,
             error_data={"ok": False, "error": "no nodes available"},
             error_code=403,
         )
+    return QueryValidationResult(is_ok=True)
+
 
+def check_task_parameters(data: dict) -> QueryValidationResult:
+    """Checks the scheduling parameters of a task before it is stored, the
+    scheduler compares and adds them up."""
+    for name in ("max_cost", "time_to_money_ratio"):
+        value = data.get(name, 0)
+        if (isinstance(value, bool) or not isinstance(value, (int, float))
+                or not math.isfinite(value) or value < 0):
+            return QueryValidationResult(
+                is_ok=False,
+                error_data={"ok": False,
+                            "error": f"{name} must be a non-negative number"},
+                error_code=400,
+            )
+    priority = data.get("priority", 0)
+    if isinstance(priority, bool) or not isinstance(priority, int) or not MIN_PRIORITY <= priority <= MAX_PRIORITY:
+        return QueryValidationResult(
+            is_ok=False,
+            error_data={"ok": False,
+                        "error": f"priority must be an integer from {MIN_PRIORITY} to {MAX_PRIORITY}"},
+            error_code=400,
+        )
+    return QueryValidationResult(is_ok=True)
+
+
+def check_pipelines(data: dict, from_comfy_inf: bool = False) -> QueryValidationResult:
     if from_comfy_inf:
         pipeline_data = data.get("pipelineData")
         if not pipeline_data:
@@ -124,98 +177,130 @@ async def hello():
 
 @app.post("/v1/inference/comfyPipeline", status_code=202)
 async def add_comfy_task(request: Request, response: Response):
-    data = await request.get_json()
-    query_validation_res = check_data_and_state(data, True)
+    data = await request.json()
+    query_validation_res = await check_data_and_state(data, True)
     if not query_validation_res.is_ok:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
         return query_validation_res.error_data
+    query_validation_res = check_task_parameters(data)
+    if not query_validation_res.is_ok:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return query_validation_res.error_data
 
-    task_id = str(uuid.uuid4())
-    task = build_task_from_query(
-        task_id,
-        max_cost=data.get("max_cost", 15),
-        time_to_money_ratio=data.get("time_to_money_ratio", 1),
-        comfy_pipeline={
+    task_id = await backend.add_task(data.get("token"), {
+        "max_cost": data.get("max_cost", 15),
+        "time_to_money_ratio": data.get("time_to_money_ratio", 1),
+        "priority": data.get("priority", 0),
+        "gpu_type": data.get("gpu_type"),
+        "comfy_pipeline": {
             "pipelineData": data.get("pipelineData"),
             "pipelineDependencies": data.get("pipelineDependencies"),
         },
-    )
-
-    token = data.get("token")
-    storage_manager.add_task(users_storage.get_user_id(token), task_id, task)
-
-    await dispatcher.add_task(task)
+    })
 
     return {"ok": True, "message": "Task submitted successfully", "task_id": task_id}
 
 
 @app.get("/v1/nodes/health/", status_code=200)
 async def health(response: Response):
-    if len(registered_providers) != 0:
-        return {"availableNodesCount": len(registered_providers), "status": "ok"}
+    available_nodes = await backend.available_nodes()
+    if available_nodes != 0:
+        return {"availableNodesCount": available_nodes, "status": "ok"}
 
     response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
     return {"availableNodesCount": 0, "status": "error"}
 
 
+@app.get("/v1/storage/stats/", status_code=200)
+async def storage_stats():
+    return {"ok": True, **await backend.storage_stats()}
+
+
+def task_query_from_request(data: dict) -> dict:
+    return {
+        "max_cost": data.get("max_cost", 15),
+        "time_to_money_ratio": data.get("time_to_money_ratio", 1),
+        "priority": data.get("priority", 0),
+        "gpu_type": data.get("gpu_type"),
+        "standard_pipeline": data.get("standardPipeline"),
+        "comfy_pipeline": data.get("comfyPipeline"),
+    }
+
+
 @app.post("/v1/images/generation/", status_code=202)
 async def generate_image(request: Request, response: Response):
     data = await request.json()
-    query_validation_res = check_data_and_state(data, False)
+    query_validation_res = await check_data_and_state(data, False)
     if not query_validation_res.is_ok:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
         return query_validation_res.error_data
+    query_validation_res = check_task_parameters(data)
+    if not query_validation_res.is_ok:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return query_validation_res.error_data
 
-    task_id = str(uuid.uuid4())
-    task = build_task_from_query(
-        task_id,
-        max_cost=data.get("max_cost", 15),
-        time_to_money_ratio=data.get("time_to_money_ratio", 1),
-        standard_pipeline=data.get("standardPipeline"),
-        comfy_pipeline=data.get("comfyPipeline"),
-    )
-
-    token = data.get("token")
-    storage_manager.add_task(users_storage.get_user_id(token), task_id, task)
-
-    await dispatcher.add_task(task)
+    task_id = await backend.add_task(data.get("token"), task_query_from_request(data))
 
-    task_ready[task_id] = asyncio.Event()
     try:
-        await asyncio.wait_for(task_ready[task_id].wait(), WS_TASK_TIMEOUT)
-    except TimeoutError:
+        message = await result_waiters.wait(task_id, WS_TASK_TIMEOUT)
+    except (TimeoutError, asyncio.TimeoutError):
         response.status_code = status.HTTP_504_GATEWAY_TIMEOUT
         return {"error": "Timeout waiting for WebSocket response"}
 
-    if connections[task_id]["status"] == "ready":
-        return {"ok": True, "result": {"images": connections[task_id]}}
+    if message.get("status") == "ready":
+        return {"ok": True, "result": {"images": message}}
     else:
-        return {"ok": False, "error": connections[task_id]["error"]}
+        return {"ok": False, "error": message.get("error")}
 
 
 @app.post("/v1/tasks/", status_code=201)
 async def add_task(request: Request, response: Response):
     data = await request.json()
-    query_validation_res = check_data_and_state(data, False)
+    query_validation_res = await check_data_and_state(data, False)
     if not query_validation_res.is_ok:
         response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
         return query_validation_res.error_data
+    query_validation_res = check_task_parameters(data)
+    if not query_validation_res.is_ok:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return query_validation_res.error_data
 
-    task_id = str(uuid.uuid4())
-    task = build_task_from_query(
-        task_id,
-        max_cost=data.get("max_cost", 15),
-        time_to_money_ratio=data.get("time_to_money_ratio", 1),
-        standard_pipeline=data.get("standardPipeline"),
-        comfy_pipeline=data.get("comfyPipeline"),
-    )
+    task_id = await backend.add_task(data.get("token"), task_query_from_request(data))
 
-    token = data.get("token")
-    storage_manager.add_task(users_storage.get_user_id(token), task_id, task)
+    return {"ok": True, "message": "Task submitted successfully", "task_id": task_id}
 
-    await dispatcher.add_task(task)
 
-    return {"ok": True, "message": "Task submitted successfully", "task_id": task_id}
+@app.post("/v1/tasks/batch", status_code=201)
+async def add_tasks(request: Request, response: Response):
+    data = await request.json()
+    tasks = data.get("tasks")
+    if not isinstance(tasks, list) or not 0 < len(tasks) <= MAX_BATCH_TASKS:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"ok": False, "error": f"tasks must be a list of 1 to {MAX_BATCH_TASKS} tasks"}
+
+    # The token and the nodes are checked once for the whole batch
+    query_validation_res = await check_state(data.get("token"))
+    if not query_validation_res.is_ok:
+        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        return query_validation_res.error_data
+
+    for i, task_data in enumerate(tasks):
+        if not isinstance(task_data, dict):
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {"ok": False, "error": "task must be an object", "index": i}
+        query_validation_res = check_pipelines(task_data, False)
+        if not query_validation_res.is_ok:
+            response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+            return {**query_validation_res.error_data, "index": i}
+        query_validation_res = check_task_parameters(task_data)
+        if not query_validation_res.is_ok:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {**query_validation_res.error_data, "index": i}
+
+    task_ids = await backend.add_tasks(
+        data.get("token"), [task_query_from_request(task_data) for task_data in tasks])
+
+    return {"ok": True, "message": "Tasks submitted successfully", "task_ids": task_ids}
 
 
 @app.get("/v1/tasks/{task_id}", status_code=201)
@@ -226,9 +311,7 @@ async def get_task_info(task_id, request: Request, response: Response):
         response.status_code = status.HTTP_401_UNAUTHORIZED
         return {"ok": False, "error": "operation is not permitted"}
 
-    task_data = storage_manager.get_task_data_with_verification(
-        users_storage.get_user_id(token), task_id
-    )
+    task_data = await backend.get_task(token, task_id)
 
     if not task_data:
         response.status_code = status.HTTP_403_FORBIDDEN
@@ -241,6 +324,32 @@ async def get_task_info(task_id, request: Request, response: Response):
     }
 
 
+def tasks_page_query(request: Request) -> tuple[int, Optional[str], Optional[str]]:
+    """Returns the `limit`, `after` and `status` query parameters, raises
+    `ValueError` if any of them is invalid."""
+    limit = int(request.query_params.get("limit", DEFAULT_PAGE_SIZE))
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    after = request.query_params.get("after")
+    if after is not None:
+        decode_cursor(after)
+    status_name = request.query_params.get("status")
+    if status_name is not None:
+        parse_public_status(status_name)
+    return limit, after, status_name
+
+
+async def stream_tasks(token: Optional[str], limit: int, after: Optional[str], status_name: Optional[str]):
+    # Holds a single page at a time however many tasks the user has
+    while True:
+        page = await backend.get_tasks_page(token, limit, after, status_name)
+        for task_id, task_data in page["tasks"].items():
+            yield json.dumps({"task_id": task_id, **task_data}) + "\n"
+        after = page["next"]
+        if after is None:
+            return
+
+
 @app.get("/v1/tasks/", status_code=200)
 async def get_tasks(request: Request, response: Response):
     token = request.headers.get("token")
@@ -249,125 +358,92 @@ async def get_tasks(request: Request, response: Response):
         response.status_code = status.HTTP_401_UNAUTHORIZED
         return {"ok": False, "error": "operation is not permitted"}
 
-    tasks = storage_manager.get_tasks(users_storage.get_user_id(token))
+    try:
+        limit, after, status_name = tasks_page_query(request)
+    except ValueError as e:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {"ok": False, "error": str(e)}
+
+    # NDJSON walks every task from the cursor on, `limit` tasks per read
+    if (request.query_params.get("stream") == "true"
+            or "application/x-ndjson" in request.headers.get("accept", "")):
+        return StreamingResponse(
+            stream_tasks(token, limit, after, status_name), media_type="application/x-ndjson")
+
+    page = await backend.get_tasks_page(token, limit, after, status_name)
+    tasks = page["tasks"]
 
-    if not tasks:
+    if not tasks and after is None and status_name is None:
         response.status_code = status.HTTP_403_FORBIDDEN
         return {"ok": False, "error": "No tasks for this user"}
 
-    tasks_to_return = {
-        task_id: {"status": task_data["status"],
-                  "result": task_data.get("result")}
-        for task_id, task_data in tasks.items()
-    }
-    return {"ok": True, "count": len(tasks), "data": tasks_to_return}
+    return {"ok": True, "count": len(tasks), "data": tasks, "next": page["next"]}
 
 
 @app.websocket("/")
 async def websocket_connection(ws: WebSocket):
     await ws.accept()
+    # Stands for the node's connection from here on, it encodes the frames
+    # as negotiated on register
+    node_ws = NodeWebSocket(ws)
+    node_id = None
     while True:
         try:
-            data = await ws.receive_text()
+            data = await node_ws.receive()
         except (WebSocketDisconnect, ConnectionClosed):
-            if ws in registered_providers:
-                id_ = registered_providers[ws]
-                print(f"Node {id_} disconnected")
-                registered_providers.pop(ws)
-                provider = dispatcher.providers.get(id_)
-                if provider:
-                    await provider.on_connection_lost()
+            if node_id is not None:
+                await backend.node_disconnected(node_id, node_ws)
             break
         except Exception as e:
             logger.error(str(e))
             break
 
         if data == "close":
-            if ws in registered_providers:
-                id_ = registered_providers[ws]
-                print(f"Node {id_} disconnected")
-                registered_providers.pop(ws)
-                provider = dispatcher.providers.get(id_)
-                if provider:
-                    await provider.on_connection_lost()
+            if node_id is not None:
+                await backend.node_disconnected(node_id, node_ws)
             break
 
-        data_json = json.loads(data)
+        try:
+            data_json = node_ws.decode(data)
+        except InvalidMessage as e:
+            logger.warning(f"Skipping message of node {node_id}: {e}")
+            continue
+
         msg_type = data_json.get("type")
         if msg_type == "register":
-            node_id = data_json.get("node_id")
-            try:
-                metadata = data_json["metadata"]
-                public_meta = PublicMetaInfo(
-                    models=metadata.get("models", []),
-                    gpu_type=metadata.get("gpu_type", ""),
-                    ncpu=metadata.get("ncpu", 0),
-                    ram=metadata.get("ram", 0)
-                )
-            except Exception as e:
-                ws.close(
-                    reason=1008, message="No metadata received on register")
-                print(f"Skipping node without metadata info: {e}")
-                break
-
-            print(f"Node {node_id} connected")
-            if node_id in dispatcher.providers:
-                existing_provider = dispatcher.providers[node_id]
-                existing_provider.update_public_meta_info(public_meta)
-                existing_provider.restore_connection(ws=ws)
-                print(f"Updated ws for {node_id}")
-            else:
-                private_meta = PrivateMetaInfo()
-                network_connection = WSConnection(ws)
-                provider = Provider(node_id, public_meta,
-                                    private_meta, network_connection)
-                dispatcher.add_provider(provider)
-
-            previous_ws = find_key_by_value(registered_providers, node_id)
-            if previous_ws is not None and previous_ws != ws:
-                registered_providers.pop(previous_ws)
+            error = schema_error(REGISTER_VALIDATOR, data_json)
+            if error is not None:
+                await ws.close(
+                    code=1008, reason=f"Invalid register message: {error}")
                 logger.warning(
-                    f"Disconnected provider connection found saved in registered")
-
-            registered_providers[ws] = node_id
-
-            print(f"Registered providers: {registered_providers.values()}")
-
-        elif msg_type == "result" or msg_type == "error":
-            try:
-                jsonschema.validate(instance=data_json,
-                                    schema=TASK_RESULT_SCHEMA)
-            except Exception as e:
-                logger.error(
-                    f"Task result {data_json} was not recieved due to schema validation error: {e}")
-
-            task_id = data_json.get("taskId")
-            id_ = registered_providers.get(ws)
-            if id_ is None:
-                logger.warning(f"Not registered provider sent result: {ws}")
+                    f"Skipping node with invalid register message: {error}")
                 break
 
-            provider = dispatcher.providers.get(id_)
-            if provider is not None:
-                task_data = storage_manager.get_task_data(task_id)
-                if task_data:
-                    task = task_data.get("task")
-                    if task:
-                        if msg_type == "result":
-                            provider.task_completed(task)
-                            storage_manager.add_result(
-                                task_id, data_json.get("resultsUrl"))
-                        else:
-                            provider.task_failed(task, data_json.get("error"))
-                            # TODO: add to storage manager
-
-            if task_id in task_ready:
-                connections[task_id] = data_json
-                task_ready[task_id].set()
+            node_id = data_json.get("node_id")
+            features = data_json.get("features", [])
+            # Old nodes know nothing of the encodings and get no reply
+            if any(feature in ENCODING_FEATURES for feature in features):
+                await ws.send_json({"type": "registered", "features": node_ws.negotiate(features)})
+            await backend.register_node(
+                node_id, data_json["metadata"], features, node_ws, data_json.get("tasks", []))
+
+        elif node_id is None:
+            logger.warning(f"Not registered provider sent {msg_type}: {ws}")
+            if msg_type == "result" or msg_type == "error":
+                break
 
         else:
-            logger.warning(f"Unknown message type: {msg_type}")
+            await backend.handle_node_message(node_id, data_json)
 
 
 if __name__ == "__main__":
-    uvicorn.run("run:app", host="0.0.0.0", port=HTTP_WS_PORT, reload=True)
+    if BACKEND_WORKERS > 1:
+        broker_process = multiprocessing.Process(
+            target=run_broker, args=(BROKER_SOCKET,), daemon=True)
+        broker_process.start()
+        uvicorn.run("run:app", host="0.0.0.0",
+                    port=HTTP_WS_PORT, workers=BACKEND_WORKERS,
+                    ws_ping_interval=WS_PING_INTERVAL, ws_ping_timeout=WS_PING_TIMEOUT)
+    else:
+        uvicorn.run("run:app", host="0.0.0.0", port=HTTP_WS_PORT, reload=True,
+                    ws_ping_interval=WS_PING_INTERVAL, ws_ping_timeout=WS_PING_TIMEOUT)
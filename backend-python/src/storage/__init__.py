@@ -0,0 +1,7 @@
+from storage.cache import TaskCache
+from storage.engine import StorageEngine
+from storage.manager import StorageManager, create_storage_engine, parse_public_status
+from storage.memory import MemoryStorageEngine
+from storage.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, TaskPage, decode_cursor
+from storage.rows import build_task
+from storage.users import UsersStorage
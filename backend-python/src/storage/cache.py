@@ -0,0 +1,91 @@
+from typing import NamedTuple, Optional
+from collections import OrderedDict
+import time
+
+TASK_CACHE_SIZE = 10000
+# Seconds a task read from an engine is served from the cache, bounds how
+# stale a row changed by another backend instance may get
+TASK_CACHE_TTL = 300
+
+
+class _CachedTask(NamedTuple):
+    expires_at: float
+    # None if the task was read without its owner
+    user_id: Optional[int]
+    task_data: dict
+
+
+class TaskCache:
+    """Least recently used task data by task id, each entry expiring
+    `ttl` seconds after it was stored."""
+
+    def __init__(self, size: int = TASK_CACHE_SIZE, ttl: float = TASK_CACHE_TTL):
+        self._size = size
+        self._ttl = ttl
+        self._tasks: OrderedDict[str, _CachedTask] = OrderedDict()
+        # task id -> number of reads of the task from an engine in flight
+        self._reads: dict[str, int] = dict()
+        # Tasks written while a read was in flight, the read is not cached
+        self._written_during_read: set[str] = set()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def get(self, task_id: str, user_id: Optional[int] = None) -> Optional[dict]:
+        """Returns the cached task data, if `user_id` is given only if the
+        task is known to belong to that user."""
+        cached = self._tasks.get(task_id)
+        if cached is None or cached.expires_at <= time.monotonic():
+            if cached is not None:
+                del self._tasks[task_id]
+            self.misses += 1
+            return None
+        if user_id is not None and cached.user_id != user_id:
+            self.misses += 1
+            return None
+
+        self._tasks.move_to_end(task_id)
+        self.hits += 1
+        return cached.task_data
+
+    def put(self, task_id: str, task_data: dict, user_id: Optional[int] = None) -> None:
+        self._written(task_id)
+        cached = self._tasks.get(task_id)
+        if user_id is None and cached is not None:
+            user_id = cached.user_id
+        self._tasks[task_id] = _CachedTask(
+            time.monotonic() + self._ttl, user_id, task_data)
+        self._tasks.move_to_end(task_id)
+        while len(self._tasks) > self._size:
+            self._tasks.popitem(last=False)
+
+    def update(self, task_id: str, **fields) -> None:
+        """Changes fields of the cached task data, if the task is cached."""
+        self._written(task_id)
+        cached = self._tasks.get(task_id)
+        if cached is not None:
+            cached.task_data.update(fields)
+
+    def invalidate(self, task_id: str) -> None:
+        self._written(task_id)
+        self._tasks.pop(task_id, None)
+
+    def start_read(self, task_id: str) -> None:
+        """Marks a read of the task from an engine, its data is cached by
+        `finish_read` unless the task is written meanwhile."""
+        self._reads[task_id] = self._reads.get(task_id, 0) + 1
+
+    def finish_read(self, task_id: str, task_data: Optional[dict], user_id: Optional[int] = None) -> None:
+        written = task_id in self._written_during_read
+        self._reads[task_id] -= 1
+        if self._reads[task_id] == 0:
+            del self._reads[task_id]
+            self._written_during_read.discard(task_id)
+        if task_data is not None and not written:
+            self.put(task_id, task_data, user_id)
+
+    def _written(self, task_id: str) -> None:
+        if task_id in self._reads:
+            self._written_during_read.add(task_id)
@@ -0,0 +1,69 @@
+from dispatcher.task import Task
+from dispatcher.task_info import PublicTaskStatus
+from storage.pagination import TaskPage
+
+from abc import ABC, abstractmethod
+from typing import Optional
+
+
+class StorageEngine(ABC):
+    """Where `StorageManager` keeps the tasks of the users.
+
+    The task data returned by the engines is a dict with the `task`, its
+    public `status` name and the `result`, if any, which is
+    `{'images': ...}` for a successful task and `{'error': ...}` for a
+    failed one.
+    """
+
+    @abstractmethod
+    async def add_task(self, user_id: int, task_id: str, task: Task) -> None:
+        pass
+
+    async def add_tasks(self, user_id: int, tasks: list[Task]) -> None:
+        """Adds several tasks of the user, engines writing to a database do
+        it in one statement or transaction."""
+        for task in tasks:
+            await self.add_task(user_id, task.id, task)
+
+    @abstractmethod
+    async def add_result(self, task_id: str, result_image_url: str) -> None:
+        pass
+
+    @abstractmethod
+    async def add_error(self, task_id: str, error: Optional[str]) -> None:
+        """Stores the task as failed, with the error as its result."""
+        pass
+
+    @abstractmethod
+    async def get_task_data(self, task_id: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    async def get_task_data_with_verification(self, user_id: int, task_id: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    async def get_tasks(self, user_id: int) -> Optional[dict]:
+        """Returns the task data of the user's tasks by task id."""
+        pass
+
+    @abstractmethod
+    async def get_tasks_page(
+            self,
+            user_id: int,
+            limit: int,
+            after: Optional[tuple[float, str]] = None,
+            status: Optional[PublicTaskStatus] = None,
+    ) -> TaskPage:
+        """Returns up to `limit` of the user's tasks with the given public
+        `status`, ordered by creation time and id, starting after the
+        (creation time, task id) position `after`."""
+        pass
+
+    def stats(self) -> dict:
+        """Returns figures about the stored tasks, such as their number
+        and the memory they take."""
+        return {}
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,166 @@
+from constants.env import (
+    MAX_COMPLETED_TASKS,
+    MAX_TASKS_PER_USER,
+    SQLITE_PATH,
+    STORAGE_ENGINE,
+    TASK_RETENTION_SECONDS,
+)
+from dispatcher.task import Task
+from dispatcher.task_info import PublicTaskStatus
+from storage.cache import TaskCache
+from storage.engine import StorageEngine
+from storage.pagination import TaskPage, decode_cursor
+from storage.memory import MemoryStorageEngine
+
+from typing import Awaitable, Optional
+
+STORAGE_ENGINES = ('memory', 'sqlite', 'supabase')
+
+
+def create_storage_engine(name: str = STORAGE_ENGINE) -> StorageEngine:
+    if name == 'memory':
+        return MemoryStorageEngine(
+            max_completed_age=TASK_RETENTION_SECONDS,
+            max_completed=MAX_COMPLETED_TASKS,
+            max_tasks_per_user=MAX_TASKS_PER_USER)
+    if name == 'sqlite':
+        from storage.sqlite_engine import SQLiteStorageEngine
+        return SQLiteStorageEngine(SQLITE_PATH)
+    if name == 'supabase':
+        from storage.supabase_engine import SupabaseStorageEngine
+        return SupabaseStorageEngine()
+    raise ValueError(
+        f"Unknown storage engine {name}, expected one of {STORAGE_ENGINES}")
+
+
+def parse_public_status(status: str) -> PublicTaskStatus:
+    try:
+        return PublicTaskStatus[status.upper()]
+    except KeyError:
+        raise ValueError(f"Unknown task status {status}")
+
+
+class StorageManager:
+    """Stores the tasks in `engine`.
+
+    With a `cache` the tasks added or read recently are served without
+    reading the engine. Added tasks are cached with the `Task` object the
+    dispatcher updates, so their status stays current, and every result
+    and status written goes to the cache too.
+    """
+
+    def __init__(self, engine: Optional[StorageEngine] = None, cache: Optional[TaskCache] = None):
+        self._engine = engine if engine is not None else MemoryStorageEngine()
+        self._cache = cache
+
+    @property
+    def engine(self):
+        return self._engine
+
+    @property
+    def cache(self):
+        return self._cache
+
+    async def add_task(self, user_id: int, task_id: str, task: Task) -> None:
+        await self._engine.add_task(user_id, task_id, task)
+        if self._cache is not None:
+            self._cache.put(task_id, {
+                'task': task, 'status': PublicTaskStatus.PENDING.name}, user_id)
+
+    async def add_tasks(self, user_id: int, tasks: list[Task]) -> None:
+        await self._engine.add_tasks(user_id, tasks)
+        if self._cache is not None:
+            for task in tasks:
+                self._cache.put(task.id, {
+                    'task': task, 'status': PublicTaskStatus.PENDING.name}, user_id)
+
+    async def add_result(self, task_id: str, result_image_url: str) -> None:
+        try:
+            await self._engine.add_result(task_id, result_image_url)
+        except Exception:
+            # The engine may or may not hold the result now
+            self.invalidate(task_id)
+            raise
+        if self._cache is not None:
+            self._cache.update(task_id, status=PublicTaskStatus.SUCCESS.name,
+                               result={'images': result_image_url})
+
+    async def add_error(self, task_id: str, error: Optional[str]) -> None:
+        try:
+            await self._engine.add_error(task_id, error)
+        except Exception:
+            self.invalidate(task_id)
+            raise
+        if self._cache is not None:
+            self._cache.update(task_id, status=PublicTaskStatus.FAILED.name,
+                               result={'error': error})
+
+    def task_status_changed(self, task: Task) -> None:
+        """Caches the `Task` object whose status changed in place of a copy
+        read from the engine, so reads see its current status."""
+        if self._cache is not None:
+            self._cache.update(task.id, task=task)
+
+    async def get_task_data(self, task_id: str) -> Optional[dict]:
+        if self._cache is None:
+            return await self._engine.get_task_data(task_id)
+
+        task_data = self._cache.get(task_id)
+        if task_data is None:
+            task_data = await self._read_through(
+                task_id, self._engine.get_task_data(task_id))
+        return task_data
+
+    async def get_task_data_with_verification(self, user_id: int, task_id: str) -> Optional[dict]:
+        if self._cache is None:
+            return await self._engine.get_task_data_with_verification(user_id, task_id)
+
+        task_data = self._cache.get(task_id, user_id)
+        if task_data is None:
+            task_data = await self._read_through(
+                task_id, self._engine.get_task_data_with_verification(user_id, task_id), user_id)
+        return task_data
+
+    async def _read_through(self, task_id: str, read: Awaitable[Optional[dict]], user_id: Optional[int] = None) -> Optional[dict]:
+        # A task written while it is read may be returned as it was, but it
+        # is not cached that way
+        task_data = None
+        self._cache.start_read(task_id)
+        try:
+            task_data = await read
+        finally:
+            self._cache.finish_read(task_id, task_data, user_id)
+        return task_data
+
+    async def get_tasks_page(
+            self,
+            user_id: int,
+            limit: int,
+            after: Optional[str] = None,
+            status: Optional[str] = None,
+    ) -> TaskPage:
+        """Returns up to `limit` of the user's tasks, the oldest first,
+        following the task the cursor `after` points to. `status` is the
+        name of a public status. Raises `ValueError` for a malformed cursor
+        or an unknown status."""
+        position = decode_cursor(after) if after is not None else None
+        public_status = parse_public_status(
+            status) if status is not None else None
+        return await self._engine.get_tasks_page(user_id, limit, position, public_status)
+
+    def stats(self) -> dict:
+        stats = self._engine.stats()
+        if self._cache is not None:
+            stats['cached_tasks'] = len(self._cache)
+        return stats
+
+    def invalidate(self, task_id: str) -> None:
+        """Makes the next read of the task go to the engine."""
+        if self._cache is not None:
+            self._cache.invalidate(task_id)
+
+    async def get_tasks(self, user_id: int) -> Optional[dict]:
+        return await self._engine.get_tasks(user_id)
+
+    async def close(self) -> None:
+        await self._engine.close()
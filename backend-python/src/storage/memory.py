@@ -0,0 +1,194 @@
+from dispatcher.task import Task
+from dispatcher.task_info import PublicTaskStatus
+from storage.engine import StorageEngine
+from storage.pagination import TaskPage, build_page
+
+from collections import OrderedDict
+from typing import Optional
+import asyncio
+import bisect
+import math
+import sys
+import time
+
+# Seconds between eviction passes, each pass removes at most
+# EVICTION_BATCH tasks before it yields to the event loop
+EVICTION_INTERVAL = 10
+EVICTION_BATCH = 1000
+# Bytes a stored task takes besides its pipeline strings
+TASK_OVERHEAD_BYTES = 2048
+
+
+def estimate_task_size(task: Task) -> int:
+    size = TASK_OVERHEAD_BYTES
+    options = task.task_options
+    if options is not None and options.comfy_pipeline is not None:
+        size += sys.getsizeof(options.comfy_pipeline.pipeline_data)
+        size += sys.getsizeof(options.comfy_pipeline.pipeline_dependencies)
+    if options is not None and options.standard_pipeline is not None:
+        size += sys.getsizeof(options.standard_pipeline.prompt)
+    return size
+
+
+class MemoryStorageEngine(StorageEngine):
+    """Keeps the tasks in dicts of the process.
+
+    Completed tasks, successful or failed, are evicted once they are older
+    than `max_completed_age` seconds or more than `max_completed` of them
+    are stored, the oldest first, by a background task started with the
+    first added task. A user with more than `max_tasks_per_user` tasks loses the
+    oldest of their completed tasks right away. Tasks not completed yet are
+    never evicted.
+    """
+
+    def __init__(
+            self,
+            max_completed_age: float = math.inf,
+            max_completed: float = math.inf,
+            max_tasks_per_user: float = math.inf,
+    ):
+        self._max_completed_age = max_completed_age
+        self._max_completed = max_completed
+        self._max_tasks_per_user = max_tasks_per_user
+        self._users_to_tasks = dict()
+        self._task_to_users = dict()
+        # user id -> (creation time, task id) of the user's tasks, sorted
+        self._users_to_positions: dict[int, list[tuple[float, str]]] = dict()
+        # task id -> completion time of the completed tasks, the oldest first
+        self._completed: OrderedDict[str, float] = OrderedDict()
+        self._users_to_completed: dict[int, OrderedDict[str, None]] = dict()
+        self._task_sizes: dict[str, int] = dict()
+        self._size = 0
+        self._eviction_future: Optional[asyncio.Future] = None
+
+    async def add_task(self, user_id: int, task_id: str, task: Task) -> None:
+        if task_id in self._task_to_users:
+            self._remove_task(task_id)
+        if user_id not in self._users_to_tasks:
+            self._users_to_tasks[user_id] = {}
+        self._users_to_tasks[user_id][task_id] = {
+            'task': task, 'status': PublicTaskStatus.PENDING.name}
+        self._task_to_users[task_id] = user_id
+        # Tasks are mostly added in creation order, so this appends
+        bisect.insort(self._users_to_positions.setdefault(user_id, []),
+                      (task.submitted_at, task_id))
+        self._task_sizes[task_id] = estimate_task_size(task)
+        self._size += self._task_sizes[task_id]
+
+        self._evict_user_tasks(user_id)
+        if self._eviction_future is None or self._eviction_future.done():
+            self._eviction_future = asyncio.ensure_future(
+                self._evict_periodically())
+
+    async def add_result(self, task_id: str, result_image_url: str) -> None:
+        self._complete_task(task_id, PublicTaskStatus.SUCCESS, {
+                            'images': result_image_url})
+
+    async def add_error(self, task_id: str, error: Optional[str]) -> None:
+        self._complete_task(task_id, PublicTaskStatus.FAILED, {'error': error})
+
+    def _complete_task(self, task_id: str, status: PublicTaskStatus, result: dict) -> None:
+        if task_id not in self._task_to_users:
+            return
+        user_id = self._task_to_users[task_id]
+        self._users_to_tasks[user_id][task_id]['status'] = status.name
+        self._users_to_tasks[user_id][task_id]['result'] = result
+
+        self._completed[task_id] = time.monotonic()
+        self._completed.move_to_end(task_id)
+        self._users_to_completed.setdefault(
+            user_id, OrderedDict())[task_id] = None
+        self._evict_user_tasks(user_id)
+
+    async def get_task_data(self, task_id: str) -> Optional[dict]:
+        if task_id not in self._task_to_users:
+            return None
+
+        return self._users_to_tasks[self._task_to_users[task_id]][task_id]
+
+    async def get_task_data_with_verification(self, user_id: int, task_id: str) -> Optional[dict]:
+        if user_id not in self._users_to_tasks or task_id not in self._users_to_tasks[user_id]:
+            return None
+
+        return self._users_to_tasks[user_id][task_id]
+
+    async def get_tasks(self, user_id: int) -> Optional[dict]:
+        if user_id not in self._users_to_tasks:
+            return None
+
+        return self._users_to_tasks[user_id]
+
+    async def get_tasks_page(
+            self,
+            user_id: int,
+            limit: int,
+            after: Optional[tuple[float, str]] = None,
+            status: Optional[PublicTaskStatus] = None,
+    ) -> TaskPage:
+        positions = self._users_to_positions.get(user_id, [])
+        start = bisect.bisect_right(
+            positions, after) if after is not None else 0
+        tasks = list()
+        for i in range(start, len(positions)):
+            created_at, task_id = positions[i]
+            task_data = self._users_to_tasks[user_id][task_id]
+            if status is not None and task_data['status'] != status.name:
+                continue
+            tasks.append((created_at, task_id, task_data))
+            if len(tasks) > limit:
+                break
+        return build_page(tasks, limit)
+
+    def stats(self) -> dict:
+        return {
+            'tasks': len(self._task_to_users),
+            'completed_tasks': len(self._completed),
+            'users': len(self._users_to_tasks),
+            'approximate_bytes': self._size,
+        }
+
+    def evict(self, limit: int = EVICTION_BATCH) -> int:
+        """Removes up to `limit` completed tasks past the retention limits,
+        returns the number of removed tasks."""
+        deadline = time.monotonic() - self._max_completed_age
+        evicted = 0
+        while self._completed and evicted < limit:
+            task_id, completed_at = next(iter(self._completed.items()))
+            if completed_at > deadline and len(self._completed) <= self._max_completed:
+                break
+            self._remove_task(task_id)
+            evicted += 1
+        return evicted
+
+    async def close(self) -> None:
+        if self._eviction_future is not None:
+            self._eviction_future.cancel()
+
+    async def _evict_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(EVICTION_INTERVAL)
+            while self.evict() == EVICTION_BATCH:
+                await asyncio.sleep(0)
+
+    def _evict_user_tasks(self, user_id: int) -> None:
+        completed = self._users_to_completed.get(user_id)
+        while completed and len(self._users_to_tasks[user_id]) > self._max_tasks_per_user:
+            self._remove_task(next(iter(completed)))
+
+    def _remove_task(self, task_id: str) -> None:
+        user_id = self._task_to_users.pop(task_id)
+        task_data = self._users_to_tasks[user_id].pop(task_id)
+        positions = self._users_to_positions[user_id]
+        position = (task_data['task'].submitted_at, task_id)
+        del positions[bisect.bisect_left(positions, position)]
+        if not self._users_to_tasks[user_id]:
+            del self._users_to_tasks[user_id]
+            del self._users_to_positions[user_id]
+
+        self._completed.pop(task_id, None)
+        completed = self._users_to_completed.get(user_id)
+        if completed is not None:
+            completed.pop(task_id, None)
+            if not completed:
+                del self._users_to_completed[user_id]
+        self._size -= self._task_sizes.pop(task_id)
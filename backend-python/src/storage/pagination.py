@@ -0,0 +1,43 @@
+from typing import NamedTuple, Optional
+import base64
+import json
+import math
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class TaskPage(NamedTuple):
+    # Task data by task id, the oldest task first
+    tasks: dict
+    # Cursor of the last task of the page, None on the last page
+    next_cursor: Optional[str]
+
+
+def encode_cursor(created_at: float, task_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([created_at, task_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[float, str]:
+    """Returns the creation time and the id of the task the cursor points
+    to, raises `ValueError` for malformed cursors."""
+    try:
+        created_at, task_id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor {cursor}") from e
+    if (isinstance(created_at, bool) or not isinstance(created_at, (int, float))
+            or not math.isfinite(created_at) or not isinstance(task_id, str)):
+        raise ValueError(f"Invalid cursor {cursor}")
+    return float(created_at), task_id
+
+
+def build_page(tasks: list[tuple[float, str, dict]], limit: int) -> TaskPage:
+    """Makes a page of the first `limit` of `tasks`, given as (creation
+    time, task id, task data) in the page order. Engines fetch one task
+    more than `limit` to tell whether another page follows."""
+    next_cursor = None
+    if len(tasks) > limit:
+        tasks = tasks[:limit]
+        next_cursor = encode_cursor(tasks[-1][0], tasks[-1][1])
+    return TaskPage({task_id: task_data for _, task_id, task_data in tasks}, next_cursor)
@@ -0,0 +1,72 @@
+from dispatcher.task import Task, restore_task
+from dispatcher.task_info import PublicTaskStatus, TaskInfo, TaskStatus
+
+from storage.pagination import TaskPage, build_page
+
+from typing import Optional
+import json
+
+# Columns of a task row, shared by the engines storing tasks in a table
+TASK_COLUMNS = ('id', 'user_id', 'priority', 'status', 'provider_id',
+                'num_failed_attempts', 'info', 'log', 'public_status', 'result',
+                'submitted_at')
+
+
+def task_row(user_id: int, task_id: str, task: Task) -> dict:
+    return {
+        'id': task_id,
+        'user_id': user_id,
+        'priority': task.priority,
+        'provider_id': task.provider_id,
+        'status': task.status.value,
+        'info': task.task_info.json,
+        'public_status': PublicTaskStatus.PENDING.value,
+        'log': json.dumps(task.get_log_string()),
+        # Seconds since the epoch, tasks are paged in this order
+        'submitted_at': task.submitted_at}
+
+
+def result_row(task_id: str, result_image_url: str) -> dict:
+    return {
+        'id': task_id,
+        'public_status': PublicTaskStatus.SUCCESS.value,
+        'result': json.dumps({'images': result_image_url})}
+
+
+def error_row(task_id: str, error: Optional[str]) -> dict:
+    return {
+        'id': task_id,
+        'public_status': PublicTaskStatus.FAILED.value,
+        'result': json.dumps({'error': error})}
+
+
+def build_task(data: dict) -> Task:
+    task = restore_task(
+        TaskInfo.from_dict(json.loads(data.get('info') or '{}')),
+        TaskStatus(data.get('status') or TaskStatus.UNSCHEDULED.value),
+        data.get('provider_id'),
+        data.get('submitted_at'))
+    task.set_priority(data.get('priority') or 0)
+    return task
+
+
+def task_data_from_row(row: dict) -> dict:
+    result = row.get('result')
+    return {
+        'task': build_task(row),
+        'status': PublicTaskStatus(row.get('public_status') or PublicTaskStatus.PENDING.value).name,
+        'result': json.loads(result) if result else None
+    }
+
+
+def tasks_data_from_rows(rows: list[dict]) -> Optional[dict]:
+    if len(rows) == 0:
+        return None
+    return {row['id']: task_data_from_row(row) for row in rows}
+
+
+def page_from_rows(rows: list[dict], limit: int) -> TaskPage:
+    return build_page([
+        (row.get('submitted_at') or 0, row['id'], task_data_from_row(row))
+        for row in rows[:limit + 1]
+    ], limit)
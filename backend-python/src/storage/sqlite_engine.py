@@ -0,0 +1,193 @@
+from dispatcher.task import Task
+from dispatcher.task_info import PublicTaskStatus
+from storage.engine import StorageEngine
+from storage.pagination import TaskPage
+from storage.rows import TASK_COLUMNS, error_row, page_from_rows, result_row, task_data_from_row, task_row, tasks_data_from_rows
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+import asyncio
+import sqlite3
+import threading
+
+READER_THREADS = 4
+# Milliseconds a connection waits for a lock held by another process
+BUSY_TIMEOUT_MS = 5000
+
+_CREATE_STATEMENTS = (
+    """CREATE TABLE IF NOT EXISTS tasks (
+        id TEXT PRIMARY KEY,
+        user_id TEXT,
+        priority INTEGER,
+        status INTEGER,
+        provider_id TEXT,
+        num_failed_attempts INTEGER DEFAULT 0,
+        info TEXT,
+        log TEXT,
+        public_status INTEGER,
+        result TEXT,
+        submitted_at REAL
+    )""",
+    "CREATE INDEX IF NOT EXISTS tasks_user_submitted_at ON tasks (user_id, submitted_at, id)",
+    "CREATE INDEX IF NOT EXISTS tasks_public_status ON tasks (public_status)",
+)
+
+# Columns added after the table was first created, with their value in
+# the rows written before
+_ADDED_COLUMNS = (
+    ('submitted_at', 'REAL', 0),
+)
+
+_COLUMNS = ", ".join(TASK_COLUMNS)
+# The statements never change, so sqlite3 prepares each of them once per
+# connection and reuses it from its statement cache
+_UPSERT_TASK = (
+    "INSERT INTO tasks (id, user_id, priority, provider_id, status, info, public_status, log, submitted_at) "
+    "VALUES (:id, :user_id, :priority, :provider_id, :status, :info, :public_status, :log, :submitted_at) "
+    "ON CONFLICT (id) DO UPDATE SET user_id = excluded.user_id, priority = excluded.priority, "
+    "provider_id = excluded.provider_id, status = excluded.status, info = excluded.info, "
+    "public_status = excluded.public_status, log = excluded.log, submitted_at = excluded.submitted_at"
+)
+_UPDATE_RESULT = "UPDATE tasks SET public_status = :public_status, result = :result WHERE id = :id"
+_SELECT_TASK = f"SELECT {_COLUMNS} FROM tasks WHERE id = ?"
+_SELECT_USER_TASK = f"SELECT {_COLUMNS} FROM tasks WHERE id = ? AND user_id = ?"
+_SELECT_USER_TASKS = f"SELECT {_COLUMNS} FROM tasks WHERE user_id = ?"
+# Pages search the (user_id, submitted_at, id) index from the position
+# after the cursor, a NULL status matches every task
+_SELECT_USER_TASKS_PAGE = (
+    f"SELECT {_COLUMNS} FROM tasks WHERE user_id = :user_id "
+    "AND (submitted_at, id) > (:after_submitted_at, :after_id) "
+    "AND (:public_status IS NULL OR public_status = :public_status) "
+    "ORDER BY submitted_at, id LIMIT :limit"
+)
+# Position before every task
+_FIRST_POSITION = (-1.0, '')
+
+
+class SQLiteStorageEngine(StorageEngine):
+    """Keeps the tasks in a local SQLite database in WAL mode.
+
+    Every write goes through a single writer thread with its own
+    connection, while reads run on a small pool of reader threads, which
+    WAL lets proceed next to the writer. `path` must be a file, as every
+    connection to ":memory:" opens a separate database.
+    """
+
+    def __init__(self, path: str, reader_threads: int = READER_THREADS):
+        self._path = path
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = list()
+        self._connections_lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='sqlite-writer')
+        self._readers = ThreadPoolExecutor(
+            max_workers=reader_threads, thread_name_prefix='sqlite-reader')
+        self._writer.submit(self._create_tables).result()
+
+    async def add_task(self, user_id: int, task_id: str, task: Task) -> None:
+        row = task_row(str(user_id), task_id, task)
+        await self._run(self._writer, self._execute_write, _UPSERT_TASK, row)
+
+    async def add_tasks(self, user_id: int, tasks: list[Task]) -> None:
+        rows = [task_row(str(user_id), task.id, task) for task in tasks]
+        await self._run(self._writer, self._execute_writes, _UPSERT_TASK, rows)
+
+    async def add_result(self, task_id: str, result_image_url: str) -> None:
+        await self._run(self._writer, self._execute_write,
+                        _UPDATE_RESULT, result_row(task_id, result_image_url))
+
+    async def add_error(self, task_id: str, error: Optional[str]) -> None:
+        await self._run(self._writer, self._execute_write,
+                        _UPDATE_RESULT, error_row(task_id, error))
+
+    async def get_task_data(self, task_id: str) -> Optional[dict]:
+        rows = await self._run(self._readers, self._fetch, _SELECT_TASK, (task_id,))
+        return task_data_from_row(rows[0]) if rows else None
+
+    async def get_task_data_with_verification(self, user_id: int, task_id: str) -> Optional[dict]:
+        rows = await self._run(self._readers, self._fetch,
+                               _SELECT_USER_TASK, (task_id, str(user_id)))
+        return task_data_from_row(rows[0]) if rows else None
+
+    async def get_tasks(self, user_id: int) -> Optional[dict]:
+        rows = await self._run(self._readers, self._fetch,
+                               _SELECT_USER_TASKS, (str(user_id),))
+        return tasks_data_from_rows(rows)
+
+    async def get_tasks_page(
+            self,
+            user_id: int,
+            limit: int,
+            after: Optional[tuple[float, str]] = None,
+            status: Optional[PublicTaskStatus] = None,
+    ) -> TaskPage:
+        after_submitted_at, after_id = after if after is not None else _FIRST_POSITION
+        rows = await self._run(self._readers, self._fetch, _SELECT_USER_TASKS_PAGE, {
+            'user_id': str(user_id),
+            'after_submitted_at': after_submitted_at,
+            'after_id': after_id,
+            'public_status': status.value if status is not None else None,
+            'limit': limit + 1,
+        })
+        return page_from_rows(rows, limit)
+
+    async def close(self) -> None:
+        await asyncio.to_thread(self._close)
+
+    async def _run(self, executor: ThreadPoolExecutor, function: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self._path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+            # With WAL a commit is durable against crashes of the process
+            # without waiting for fsync
+            connection.execute("PRAGMA synchronous = NORMAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _create_tables(self) -> None:
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode = WAL")
+        with connection:
+            for statement in _CREATE_STATEMENTS[:1]:
+                connection.execute(statement)
+            # Databases created before a column was added get it here
+            columns = {row['name']
+                       for row in connection.execute("PRAGMA table_info(tasks)")}
+            for column, column_type, value in _ADDED_COLUMNS:
+                if column not in columns:
+                    connection.execute(
+                        f"ALTER TABLE tasks ADD COLUMN {column} {column_type}")
+                    connection.execute(
+                        f"UPDATE tasks SET {column} = ?", (value,))
+            for statement in _CREATE_STATEMENTS[1:]:
+                connection.execute(statement)
+
+    def _execute_write(self, statement: str, parameters: dict) -> None:
+        connection = self._connection()
+        with connection:
+            connection.execute(statement, parameters)
+
+    def _execute_writes(self, statement: str, parameters: list[dict]) -> None:
+        connection = self._connection()
+        with connection:
+            connection.executemany(statement, parameters)
+
+    def _fetch(self, statement: str, parameters: tuple | dict) -> list[dict]:
+        rows = self._connection().execute(statement, parameters).fetchall()
+        return [dict(row) for row in rows]
+
+    def _close(self) -> None:
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
@@ -0,0 +1,159 @@
+from constants.env import SUPABASE_URL, SUPABASE_KEY
+from dispatcher.task import Task
+from dispatcher.task_info import PublicTaskStatus
+from storage.engine import StorageEngine
+from storage.pagination import TaskPage, encode_cursor
+from storage.rows import TASK_COLUMNS, error_row, page_from_rows, result_row, task_data_from_row, task_row, tasks_data_from_rows
+from write_behind import WriteBehindQueue
+
+from postgrest.types import ReturnMethod
+from supabase import create_client, Client
+from typing import Optional
+import asyncio
+import math
+import uuid
+
+
+class SupabaseStorageEngine(StorageEngine):
+    def __init__(self, table_name='TasksV1_tests'):
+        self._client: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+        self._table_name = table_name
+        # Handlers never wait for the database, reads see the rows not
+        # written yet through the queue
+        self._writes = WriteBehindQueue(self._upsert_rows)
+
+    async def add_task(self, user_id: int, task_id: str, task: Task) -> None:
+        await self._writes.put(task_row(user_id, task_id, task))
+
+    async def add_tasks(self, user_id: int, tasks: list[Task]) -> None:
+        # The queue writes rows put together in one upsert
+        for task in tasks:
+            await self._writes.put(task_row(user_id, task.id, task))
+
+    async def add_result(self, task_id: str, result_image_url: str) -> None:
+        await self._writes.put(result_row(task_id, result_image_url))
+
+    async def add_error(self, task_id: str, error: Optional[str]) -> None:
+        await self._writes.put(error_row(task_id, error))
+
+    async def get_task_data(self, task_id: str) -> Optional[dict]:
+        rows = await asyncio.to_thread(self._select, id=task_id)
+        row = self._with_pending_writes(task_id, rows)
+        return task_data_from_row(row) if row is not None else None
+
+    async def get_task_data_with_verification(self, user_id: int, task_id: str) -> Optional[dict]:
+        rows = await asyncio.to_thread(self._select, id=task_id, user_id=user_id)
+        row = self._with_pending_writes(task_id, rows)
+        if row is None or row.get('user_id') != user_id:
+            return None
+        return task_data_from_row(row)
+
+    async def get_tasks(self, user_id: int) -> Optional[dict]:
+        rows = await asyncio.to_thread(self._select, user_id=user_id)
+
+        raw_tasks = {row['id']: row for row in rows}
+        for row in self._writes.pending_rows():
+            if row['id'] in raw_tasks:
+                raw_tasks[row['id']].update(row)
+            elif row.get('user_id') == user_id and 'info' in row:
+                raw_tasks[row['id']] = row
+        return tasks_data_from_rows(list(raw_tasks.values()))
+
+    async def get_tasks_page(
+            self,
+            user_id: int,
+            limit: int,
+            after: Optional[tuple[float, str]] = None,
+            status: Optional[PublicTaskStatus] = None,
+    ) -> TaskPage:
+        rows = await asyncio.to_thread(self._select_page, user_id, limit + 1, after, status)
+        # Rows past the last one of a full page belong to the next pages
+        last = _position(rows[limit - 1]) if len(rows) > limit else None
+        rows = {row['id']: row for row in rows[:limit]}
+        for row in self._writes.pending_rows():
+            if row['id'] in rows:
+                rows[row['id']].update(row)
+            elif (row.get('user_id') == user_id and 'info' in row
+                  and (after is None or _position(row) > after)
+                  and (last is None or _position(row) <= last)):
+                rows[row['id']] = row
+
+        rows = sorted((
+            row for row in rows.values()
+            if status is None or row.get('public_status') == status.value
+        ), key=_position)
+        page = page_from_rows(rows, limit)
+        if last is not None and page.next_cursor is None:
+            page = TaskPage(page.tasks, encode_cursor(*last))
+        return page
+
+    async def close(self) -> None:
+        # Writes the task updates still queued for the database
+        await asyncio.to_thread(self._writes.close)
+
+    def flush(self) -> None:
+        """Waits until every task update made so far is in the database."""
+        self._writes.flush()
+
+    def _select(self, **filters) -> list[dict]:
+        query = self._client.table(self._table_name).select(*TASK_COLUMNS)
+        for column, value in filters.items():
+            query = query.eq(column, value)
+        data, _ = query.execute()
+        return data[1]
+
+    def _select_page(
+            self,
+            user_id: int,
+            limit: int,
+            after: Optional[tuple[float, str]],
+            status: Optional[PublicTaskStatus],
+    ) -> list[dict]:
+        query = self._client.table(self._table_name).select(
+            *TASK_COLUMNS).eq('user_id', user_id)
+        if status is not None:
+            query = query.eq('public_status', status.value)
+        if after is not None:
+            query = query.or_(_after_filter(*after))
+        data, _ = query.order('submitted_at').order(
+            'id').limit(limit).execute()
+        return data[1]
+
+    def _upsert_rows(self, rows: list[dict]):
+        # Bulk upserts fill the missing columns of a row with nulls, so only
+        # rows updating the same columns go together
+        batches = dict()
+        for row in rows:
+            batches.setdefault(tuple(sorted(row.keys())), []).append(row)
+        for batch in batches.values():
+            self._client.table(self._table_name).upsert(
+                batch, returning=ReturnMethod.minimal).execute()
+
+    def _with_pending_writes(self, task_id: str, rows: list[dict]) -> Optional[dict]:
+        pending_row = self._writes.pending_row(task_id)
+        if len(rows) == 0:
+            # A result alone is not a task
+            return pending_row if pending_row and 'info' in pending_row else None
+        return {**rows[0], **(pending_row or {})}
+
+
+def _after_filter(submitted_at: float, task_id: str) -> str:
+    """Returns the PostgREST filter of the rows after a cursor position.
+    The position comes from a client, so it is checked to be a number and
+    a task id before it is put into the filter."""
+    if isinstance(submitted_at, bool) or not isinstance(submitted_at, (int, float)) \
+            or not math.isfinite(submitted_at):
+        raise ValueError(f"Invalid cursor time {submitted_at}")
+    try:
+        # Task ids are UUIDs in their canonical form
+        canonical_id = str(uuid.UUID(task_id))
+    except (TypeError, ValueError, AttributeError):
+        canonical_id = None
+    if canonical_id != task_id:
+        raise ValueError(f"Invalid cursor task id {task_id}")
+    submitted_at = repr(float(submitted_at))
+    return f'submitted_at.gt.{submitted_at},and(submitted_at.eq.{submitted_at},id.gt.{task_id})'
+
+
+def _position(row: dict) -> tuple[float, str]:
+    return (row.get('submitted_at') or 0, row['id'])
@@ -0,0 +1,31 @@
+from collections import OrderedDict
+import uuid
+
+MAX_CACHED_TOKENS = 10000
+_USERS_NAMESPACE = uuid.UUID("6f0b7c1e-3f5a-4c2e-9a51-2d8e4b9c7a10")
+
+
+class UsersStorage:
+    """Maps tokens to user ids.
+
+    The id is derived from the token, so only the recently used tokens are
+    kept and a token evicted from the cache maps to the same user again.
+    """
+
+    def __init__(self, max_cached_tokens: int = MAX_CACHED_TOKENS):
+        self._max_cached_tokens = max_cached_tokens
+        self._tokens_to_users: OrderedDict[str, int] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._tokens_to_users)
+
+    def get_user_id(self, token: str) -> int:
+        if token in self._tokens_to_users:
+            self._tokens_to_users.move_to_end(token)
+            return self._tokens_to_users[token]
+
+        user_id = uuid.uuid5(_USERS_NAMESPACE, token or "").int
+        self._tokens_to_users[token] = user_id
+        if len(self._tokens_to_users) > self._max_cached_tokens:
+            self._tokens_to_users.popitem(last=False)
+        return user_id
@@ -0,0 +1,185 @@
+from dispatcher.util.logger import logger
+
+from collections import OrderedDict
+from typing import Callable, Optional
+import asyncio
+import atexit
+import threading
+import time
+
+# Seconds updates are gathered before they are written in one batch
+FLUSH_INTERVAL = 0.05
+MAX_BATCH_ROWS = 500
+# Rows waiting to be written, beyond that `put` waits for the database
+MAX_PENDING_ROWS = 10000
+MAX_WRITE_ATTEMPTS = 3
+RETRY_DELAY = 1.0
+
+
+class WriteBehindQueue:
+    """Writes rows in the background, so callers never wait for the
+    database.
+
+    Updates of the same row are merged until the row is written, and rows
+    are passed to `write_rows` in batches from a single thread. Rows not
+    written yet are visible through `pending_row` and `pending_rows`. The
+    rows left are written on `close` and at interpreter exit.
+    """
+
+    def __init__(
+            self,
+            write_rows: Callable[[list[dict]], None],
+            key: str = 'id',
+            flush_interval: float = FLUSH_INTERVAL,
+            max_batch_rows: int = MAX_BATCH_ROWS,
+            max_pending_rows: int = MAX_PENDING_ROWS,
+            retry_delay: float = RETRY_DELAY,
+    ):
+        self._write_rows = write_rows
+        self._key = key
+        self._flush_interval = flush_interval
+        self._max_batch_rows = max_batch_rows
+        self._max_pending_rows = max_pending_rows
+        self._retry_delay = retry_delay
+        self._pending: OrderedDict[str, dict] = OrderedDict()
+        # Rows being written, still visible to readers
+        self._writing: dict[str, dict] = dict()
+        self._attempts: dict[str, int] = dict()
+        self._condition = threading.Condition()
+        self._flush_requested = False
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __len__(self) -> int:
+        with self._condition:
+            return len(self._pending) + len(self._writing)
+
+    async def put(self, row: dict) -> None:
+        """Puts the row, while `max_pending_rows` rows wait to be written it
+        waits for the database without blocking the event loop."""
+        while not self.put_nowait(row):
+            logger.warning(
+                f'{self._max_pending_rows} rows wait to be written, waiting for the database')
+            await asyncio.to_thread(self._wait_for_room)
+
+    def put_nowait(self, row: dict) -> bool:
+        """Puts the row unless `max_pending_rows` rows wait to be written,
+        returns whether it was put."""
+        row_id = row[self._key]
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('Write behind queue is closed')
+            if len(self._pending) >= self._max_pending_rows and row_id not in self._pending:
+                self._flush_requested = True
+                self._condition.notify_all()
+                return False
+
+            if row_id in self._pending:
+                self._pending[row_id].update(row)
+            else:
+                self._pending[row_id] = dict(row)
+            self._condition.notify_all()
+            return True
+
+    def _wait_for_room(self) -> None:
+        with self._condition:
+            self._condition.wait_for(
+                lambda: len(self._pending) < self._max_pending_rows or self._closed)
+
+    def pending_row(self, row_id: str) -> Optional[dict]:
+        with self._condition:
+            if row_id not in self._pending and row_id not in self._writing:
+                return None
+            return {**self._writing.get(row_id, {}), **self._pending.get(row_id, {})}
+
+    def pending_rows(self) -> list[dict]:
+        with self._condition:
+            row_ids = list(self._writing.keys()) + \
+                [row_id for row_id in self._pending if row_id not in self._writing]
+            return [
+                {**self._writing.get(row_id, {}), **
+                 self._pending.get(row_id, {})}
+                for row_id in row_ids
+            ]
+
+    def flush(self) -> None:
+        """Waits until every row put so far is written."""
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            self._condition.wait_for(
+                lambda: not self._pending and not self._writing)
+
+    def close(self) -> None:
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        atexit.unregister(self.close)
+
+    def _take_batch(self) -> Optional[list[dict]]:
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending or self._closed)
+            if not self._pending:
+                return None
+
+            deadline = time.monotonic() + self._flush_interval
+            while (not self._closed and not self._flush_requested
+                   and len(self._pending) < self._max_batch_rows):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            while self._pending and len(self._writing) < self._max_batch_rows:
+                row_id, row = self._pending.popitem(last=False)
+                self._writing[row_id] = row
+            if not self._pending:
+                self._flush_requested = False
+            # Rows taken for writing make room for the callers waiting in put
+            self._condition.notify_all()
+            return list(self._writing.values())
+
+    def _run(self) -> None:
+        while True:
+            rows = self._take_batch()
+            if rows is None:
+                return
+
+            try:
+                self._write_rows(rows)
+                failed = False
+            except Exception as e:
+                logger.error(f'Failed to write {len(rows)} rows: {e}')
+                failed = True
+
+            with self._condition:
+                if failed:
+                    self._requeue_failed()
+                else:
+                    for row_id in self._writing:
+                        self._attempts.pop(row_id, None)
+                self._writing.clear()
+                self._condition.notify_all()
+
+            if failed and not self._closed:
+                time.sleep(self._retry_delay)
+
+    def _requeue_failed(self) -> None:
+        for row_id, row in self._writing.items():
+            attempts = self._attempts.get(row_id, 0) + 1
+            if attempts >= MAX_WRITE_ATTEMPTS:
+                logger.error(
+                    f'Dropping row {row_id} after {attempts} failed writes')
+                self._attempts.pop(row_id, None)
+                continue
+            self._attempts[row_id] = attempts
+            # Updates put while the row was written are newer
+            row.update(self._pending.get(row_id, {}))
+            self._pending[row_id] = row
+            self._pending.move_to_end(row_id, last=False)
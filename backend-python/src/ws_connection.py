@@ -1,57 +1,203 @@
-from constants.static import TASK_SCHEMA
-
 from dispatcher.util.logger import logger
 from dispatcher.network_connection import NetworkConnection
 from dispatcher.task import Task
+from dispatcher.task_info import ComfyPipelineOptions, TaskStatus, TaskStatusPayload
+from messages import TASK_COMFY_OPTIONS_VALIDATOR, TASK_OPTIONS_VALIDATOR, schema_error
+from node_socket import EncodedPart, NodeMessage
 
+from collections import OrderedDict
 from fastapi import WebSocket
-import jsonschema
+from typing import Any, Iterable, Optional, Sequence
+import json
+
+# Features a node may list in the "features" field of its register message
+BATCH_FEATURE = "tasksBatch"
+# Nodes with this feature get the hashes of ComfyUI pipelines and fetch the
+# pipelines they have not cached with a "blob" message
+BLOBS_FEATURE = "blobs"
+
+
+# Encoded "comfyOptions" kept for the pipelines sent most recently
+COMFY_OPTIONS_CACHE_SIZE = 1024
+
+
+def encode_payload(value: Any) -> str:
+    # The encoding of WebSocket.send_json
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+class ComfyOptionsPayloads:
+    """Validated and encoded "comfyOptions" of the pipelines, shared by
+    the tasks with the same pipeline hashes and reused on every resend, so
+    a large ComfyUI graph is encoded once, to JSON and, for the nodes
+    asking for them, to MessagePack and deflate."""
+
+    def __init__(self, size: int = COMFY_OPTIONS_CACHE_SIZE):
+        self._size = size
+        # (pipeline hash, dependencies hash, hashes only) -> (payload, error)
+        self._payloads: OrderedDict[tuple,
+                                    tuple[Optional[EncodedPart], Optional[str]]] = OrderedDict()
+
+    def get(self, pipeline: ComfyPipelineOptions,
+            hashes_only: bool) -> tuple[Optional[EncodedPart], Optional[str]]:
+        """Returns the payload and None, or the schema validation error."""
+        if pipeline.pipeline_data_hash is None:
+            # Pipelines not put into the blob store have no key
+            return self._encode(pipeline, hashes_only)
+
+        key = (pipeline.pipeline_data_hash,
+               pipeline.pipeline_dependencies_hash, hashes_only)
+        payload = self._payloads.get(key)
+        if payload is None:
+            payload = self._payloads[key] = self._encode(pipeline, hashes_only)
+            while len(self._payloads) > self._size:
+                self._payloads.popitem(last=False)
+        else:
+            self._payloads.move_to_end(key)
+        return payload
+
+    def _encode(self, pipeline: ComfyPipelineOptions,
+                hashes_only: bool) -> tuple[Optional[EncodedPart], Optional[str]]:
+        if hashes_only:
+            options = {
+                "pipelineDataHash": pipeline.pipeline_data_hash,
+                "pipelineDependenciesHash": pipeline.pipeline_dependencies_hash,
+            }
+        else:
+            options = {
+                "pipelineData": pipeline.pipeline_data,
+                "pipelineDependencies": pipeline.pipeline_dependencies,
+            }
+        error = schema_error(TASK_COMFY_OPTIONS_VALIDATOR, options)
+        return (EncodedPart(encode_payload(options), options) if error is None else None, error)
+
+
+_comfy_options_payloads = ComfyOptionsPayloads()
+
+
+class EncodedTask:
+    """Options of a task validated and encoded for the nodes when the task
+    is submitted, reused on every send of the task."""
+
+    __slots__ = ("options", "comfy_options", "comfy_option_hashes", "error")
+
+    def __init__(
+            self,
+            options: Optional[EncodedPart],
+            comfy_options: Optional[EncodedPart],
+            comfy_option_hashes: Optional[EncodedPart],
+            error: Optional[str],
+    ):
+        self.options = options
+        self.comfy_options = comfy_options
+        # Sent to the nodes fetching blobs, if the pipeline has hashes
+        self.comfy_option_hashes = comfy_option_hashes
+        # Schema validation error of the options, a task with one is not sent
+        self.error = error
+
+
+def encode_task(task: Task) -> EncodedTask:
+    """Validates and encodes the options of the task, keeps them on the
+    task and returns them. Pipelines must be put into the blob store first
+    for the nodes fetching blobs to get their hashes."""
+    options = task.task_options
+    standard_pipeline = options.standard_pipeline if options is not None else None
+    comfy_pipeline = options.comfy_pipeline if options is not None else None
+
+    standard_options = (
+        {
+            "prompt": standard_pipeline.prompt,
+            "model": standard_pipeline.model,
+            "size": standard_pipeline.size,
+            "steps": standard_pipeline.steps,
+        }
+        if standard_pipeline
+        else None
+    )
+    error = schema_error(TASK_OPTIONS_VALIDATOR, standard_options)
+    comfy_options = comfy_option_hashes = None
+    if error is None and comfy_pipeline:
+        comfy_options, error = _comfy_options_payloads.get(
+            comfy_pipeline, False)
+        if error is None and comfy_pipeline.pipeline_data_hash is not None:
+            comfy_option_hashes, error = _comfy_options_payloads.get(
+                comfy_pipeline, True)
+
+    encoded = EncodedTask(
+        EncodedPart(encode_payload(standard_options))
+        if standard_options is not None and error is None else None,
+        comfy_options, comfy_option_hashes, error)
+    task.set_node_payload(encoded)
+    return encoded
 
 
 class WSConnection(NetworkConnection):
-    def __init__(self, ws: WebSocket):
+    def __init__(self, ws: WebSocket, features: Iterable[str] = ()):
         super().__init__()
         self.ws = ws
+        self.features = frozenset(features)
 
-    async def restore_connection(self, ws: WebSocket):
-        self.ws = ws
+    @property
+    def supports_batching(self) -> bool:
+        return BATCH_FEATURE in self.features
 
-    async def send_task(self, task: Task):
-        clientTask = {"taskId": task.id}
-
-        clientTask["options"] = (
-            {
-                "prompt": task.task_options.standard_pipeline.prompt,
-                "model": task.task_options.standard_pipeline.model,
-                "size": task.task_options.standard_pipeline.size,
-                "steps": task.task_options.standard_pipeline.steps,
-            }
-            if task.task_options.standard_pipeline
-            else None
-        )
-
-        clientTask["comfyOptions"] = (
-            {
-                "pipelineData": task.task_options.comfy_pipeline.pipeline_data,
-                "pipelineDependencies": task.task_options.comfy_pipeline.pipeline_dependencies,
-            }
-            if task.task_options.comfy_pipeline
-            else None
-        )
+    @property
+    def supports_blobs(self) -> bool:
+        return BLOBS_FEATURE in self.features
+
+    def restore_connection(self, ws: WebSocket, features: Iterable[str] = ()):
+        self.ws = ws
+        self.features = frozenset(features)
 
-        try:
-            jsonschema.validate(instance=clientTask, schema=TASK_SCHEMA)
-        except Exception as e:
+    def _encode_client_task(self, task: Task) -> Optional[NodeMessage]:
+        encoded = task.node_payload
+        if encoded is None:
+            encoded = encode_task(task)
+        if encoded.error is not None:
             logger.error(
-                f"Task {clientTask} was not sent due to schema validation error: {e}"
+                f"Task {task.id} was not sent due to schema validation error: {encoded.error}"
             )
+            return None
+
+        comfy_options = encoded.comfy_options
+        if self.supports_blobs and encoded.comfy_option_hashes is not None:
+            comfy_options = encoded.comfy_option_hashes
+        return NodeMessage({"taskId": task.id, "options": encoded.options, "comfyOptions": comfy_options})
+
+    async def send_task(self, task: Task):
+        clientTask = self._encode_client_task(task)
+        if clientTask is None:
+            return
+
+        await self.ws.send_text(clientTask)
+        task.set_status(TaskStatusPayload(task_status=TaskStatus.SENT))
+
+    async def send_tasks(self, tasks: Sequence[Task]):
+        if not self.supports_batching:
+            await super().send_tasks(tasks)
             return
 
-        await self.ws.send_json(clientTask)
+        sent_tasks = list()
+        clientTasks = list()
+        for task in tasks:
+            clientTask = self._encode_client_task(task)
+            if clientTask is not None:
+                sent_tasks.append(task)
+                clientTasks.append(clientTask)
+        if not clientTasks:
+            return
 
-    async def abortTask(self, task: Task):
+        await self.ws.send_text(NodeMessage(
+            {"type": "tasks", "tasks": [clientTask.value for clientTask in clientTasks]}))
+        for task in sent_tasks:
+            task.set_status(TaskStatusPayload(task_status=TaskStatus.SENT))
+
+    async def abort_task(self, task: Task):
         clientTaskAbort = {
             "type": "abort",
             "taskId": task.id,
         }
         await self.ws.send_json(clientTaskAbort)
+
+    async def send_blob(self, reply: dict):
+        await self.ws.send_json(reply)
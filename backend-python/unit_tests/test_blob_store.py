@@ -0,0 +1,93 @@
+import asyncio
+import json
+import sys
+import pytest
+sys.path.append("/backend-python/src")
+
+from backend import Backend
+from blob_store import BlobStore, encode_blob
+from dispatcher.task import build_task_from_query
+from ws_connection import BLOBS_FEATURE
+
+pytest_plugins = ('pytest_asyncio',)
+
+NODE_METADATA = {"models": [], "gpu_type": "gpu1", "ncpu": 8, "ram": 32}
+PIPELINE = '{"3": {"class_type": "KSampler", "inputs": {"seed": 1}}}'
+DEPENDENCIES = {"images": "imageNameToImage map"}
+
+
+class NodeWebSocketMock:
+    def __init__(self) -> None:
+        self.sent = []
+
+    async def send_json(self, payload):
+        self.sent.append(payload)
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+
+def comfy_query():
+    return {
+        "max_cost": 15,
+        "time_to_money_ratio": 1,
+        "comfy_pipeline": {"pipelineData": PIPELINE, "pipelineDependencies": dict(DEPENDENCIES)},
+    }
+
+
+def test_blobs_shared_between_tasks():
+    store = BlobStore()
+    pipelines = [
+        build_task_from_query(str(i), **comfy_query()).task_options.comfy_pipeline
+        for i in range(2)
+    ]
+    for pipeline in pipelines:
+        store.add_pipeline(pipeline)
+
+    assert len(store) == 2
+    assert pipelines[0].pipeline_data_hash == pipelines[1].pipeline_data_hash
+    assert pipelines[0].pipeline_dependencies is pipelines[1].pipeline_dependencies
+    assert store.get(pipelines[0].pipeline_dependencies_hash) == DEPENDENCIES
+
+
+def test_least_recently_used_blobs_dropped():
+    size = len(encode_blob("a" * 10))
+    store = BlobStore(max_bytes=2 * size)
+    first, _ = store.put("a" * 10)
+    second, _ = store.put("b" * 10)
+    store.get(first)
+    store.put("c" * 10)
+    assert store.get(first) == "a" * 10 and store.get(second) is None
+    assert store.size == 2 * size
+
+
+@pytest.mark.asyncio
+async def test_node_fetches_blob_by_hash():
+    backend = Backend()
+    node_ws = NodeWebSocketMock()
+    await backend.register_node("node1", NODE_METADATA, [BLOBS_FEATURE], node_ws)
+    task_id = await backend.add_task("token", comfy_query())
+    await asyncio.sleep(0)
+
+    comfy_options = node_ws.sent[0]["comfyOptions"]
+    assert node_ws.sent[0]["taskId"] == task_id and "pipelineData" not in comfy_options
+
+    # The reply is sent by the writer of the provider, not by the handler
+    await backend.handle_node_message("node1", {
+        "type": "blob", "hash": comfy_options["pipelineDataHash"]})
+    assert len(node_ws.sent) == 1
+    await asyncio.sleep(0)
+    assert node_ws.sent[1] == {
+        "type": "blob", "hash": comfy_options["pipelineDataHash"], "data": PIPELINE}
+
+    # Blobs dropped from the store are still served from the tasks in progress
+    backend.blob_store = BlobStore()
+    await backend.handle_node_message("node1", {
+        "type": "blob", "hash": comfy_options["pipelineDependenciesHash"]})
+    await asyncio.sleep(0)
+    assert node_ws.sent[2]["data"] == DEPENDENCIES
+
+    await backend.handle_node_message("node1", {"type": "blob", "hash": "missing"})
+    await asyncio.sleep(0)
+    assert node_ws.sent[3] == {"type": "blob", "hash": "missing", "error": "unknown blob"}
+    await backend.close()
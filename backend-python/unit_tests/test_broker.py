@@ -0,0 +1,156 @@
+import asyncio
+import json
+import sys
+import pytest
+sys.path.append("/backend-python/src")
+
+from backend import Backend
+from broker import BrokerClient, BrokerServer
+
+pytest_plugins = ('pytest_asyncio',)
+
+NODE_METADATA = {"models": ["SD2.1"], "gpu_type": "gpu1", "ncpu": 8, "ram": 32}
+TASK_QUERY = {
+    "max_cost": 15,
+    "time_to_money_ratio": 1,
+    "standard_pipeline": {
+        "prompt": "space surfer",
+        "model": "SD2.1",
+        "size": {"height": 512, "width": 512},
+        "steps": 25,
+    },
+}
+
+
+class NodeWebSocketMock:
+    def __init__(self) -> None:
+        self.sent = []
+
+    async def send_json(self, payload):
+        self.sent.append(payload)
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+
+@pytest.mark.asyncio
+async def test_task_routed_between_workers(tmp_path):
+    path = str(tmp_path / "broker.sock")
+    backend = Backend()
+    server = asyncio.ensure_future(BrokerServer(backend).serve(path))
+    worker1 = BrokerClient(path)
+    worker2 = BrokerClient(path)
+    await worker1.connect()
+    await worker2.connect()
+
+    results = []
+    worker2.add_result_listener(lambda task_id, message: results.append(task_id))
+
+    # the node is connected to the first worker
+    node_ws = NodeWebSocketMock()
+    await worker1.register_node("node1", NODE_METADATA, [], node_ws)
+    assert await worker2.available_nodes() == 1
+
+    # the task is submitted to the second worker
+    task_id = await worker2.add_task("token", TASK_QUERY)
+    for _ in range(100):
+        if node_ws.sent:
+            break
+        await asyncio.sleep(0.01)
+    assert node_ws.sent[0]["taskId"] == task_id
+
+    await worker1.handle_node_message("node1", {
+        "type": "result", "taskId": task_id, "resultsUrl": ["url"], "status": "ready"})
+    for _ in range(100):
+        if results:
+            break
+        await asyncio.sleep(0.01)
+    assert results == [task_id]
+
+    task_data = await worker2.get_task("token", task_id)
+    assert task_data == {"status": "SUCCESS", "result": {"images": ["url"]}}
+    assert await worker1.get_task("other token", task_id) is None
+
+    await worker1.close()
+    await worker2.close()
+    await asyncio.sleep(0.01)
+    server.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await server
+    await backend.close()
+
+
+class StalledWebSocketMock(NodeWebSocketMock):
+    def __init__(self) -> None:
+        super().__init__()
+        self.released = asyncio.Event()
+
+    async def send_text(self, text):
+        await self.released.wait()
+        await super().send_text(text)
+
+
+async def wait_until(condition):
+    for _ in range(100):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_stalled_node_does_not_block_worker(tmp_path):
+    path = str(tmp_path / "broker.sock")
+    backend = Backend()
+    server = asyncio.ensure_future(BrokerServer(backend).serve(path))
+    worker = BrokerClient(path)
+    await worker.connect()
+
+    stalled_ws = StalledWebSocketMock()
+    await worker.register_node("node1", NODE_METADATA, [], stalled_ws)
+    first_id = await worker.add_task("token", TASK_QUERY)
+
+    # the stalled node holds neither the replies nor the other nodes
+    node_ws = NodeWebSocketMock()
+    await worker.register_node("node2", NODE_METADATA, [], node_ws)
+    second_id = await asyncio.wait_for(worker.add_task("token", TASK_QUERY), 1)
+    await wait_until(lambda: node_ws.sent)
+    assert node_ws.sent[0]["taskId"] == second_id
+    assert backend.dispatcher.providers["node1"].outbox_length == 1
+
+    # the broker's provider only drops the send once the node has it
+    stalled_ws.released.set()
+    await wait_until(lambda: stalled_ws.sent)
+    assert stalled_ws.sent[0]["taskId"] == first_id
+    await wait_until(lambda: backend.dispatcher.providers["node1"].outbox_length == 0)
+    assert backend.dispatcher.providers["node1"].outbox_length == 0
+
+    await worker.close()
+    server.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await server
+    await backend.close()
+
+    # calls fail once the connection to the broker is gone
+    with pytest.raises(ConnectionError):
+        await worker.available_nodes()
+
+
+@pytest.mark.asyncio
+async def test_broadcast_failures_logged(caplog):
+    backend = Backend()
+    broker = BrokerServer(backend)
+
+    class ClosedSession:
+        async def send(self, message):
+            raise ConnectionError("worker is gone")
+
+    broker._sessions.add(ClosedSession())
+    for callback in backend._result_listeners:
+        callback("1", {"type": "result", "taskId": "1"})
+    # The broadcast is kept until it is done and its error is logged
+    assert len(broker._futures) == 1
+    for _ in range(2):
+        await asyncio.sleep(0)
+    assert len(broker._futures) == 0
+    assert "worker is gone" in caplog.text
+    await backend.close()
@@ -1,18 +1,26 @@
 import sys
 import pytest
 import asyncio
+import json
 
 sys.path.append("/backend-python/src")
 
 from dispatcher.dispatcher import Dispatcher
 from dispatcher.meta_info import PrivateMetaInfo, PublicMetaInfo
-from dispatcher.provider import Provider, OFFLINE_TIMEOUT
+from dispatcher.provider import Provider, BATCH_WINDOW, MAX_OUTBOX_SIZE, OFFLINE_TIMEOUT
 from dispatcher.network_connection import NetworkConnection
-from dispatcher.task import Task
+from dispatcher.task import Task, build_task_from_query
 from dispatcher.task_info import TaskInfo, TaskStatus, TaskStatusPayload
 
 pytest_plugins = ('pytest_asyncio',)
 
+
+async def wait_for_writers():
+    # Lets the pulls and then the provider writers sending the tasks run
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
 @pytest.mark.asyncio
 async def test_add_task():
     dispatcher = Dispatcher()
@@ -24,18 +32,20 @@ async def test_add_task():
     p3 = Provider("3", pub_meta_info, PrivateMetaInfo(), NetworkConnection())
 
     await dispatcher.add_task(t1)
-    assert t1.status == TaskStatus.FAILED
+    assert t1.status == TaskStatus.QUEUED and len(dispatcher.entry_queue) == 1
 
     dispatcher.add_provider(p1)
     dispatcher.add_provider(p2)
     dispatcher.add_provider(p3)
     assert len(dispatcher.providers) == 3
 
-    await dispatcher.add_task(t1)
+    await wait_for_writers()
+    assert len(dispatcher.entry_queue) == 0
     prev = p1 if t1 in p1.tasks_in_progress else (p2 if t1 in p2.tasks_in_progress else p3)
     assert t1.status == TaskStatus.SENT and t1.provider_id == prev.id
     assert prev.queue_length == 1  and p1.queue_length + p2.queue_length + p3.queue_length == 1
     await dispatcher.add_task(t2)
+    await wait_for_writers()
     assert  t2.status == TaskStatus.SENT and t2.provider_id != prev.id
     assert prev.queue_length == 1 and p1.queue_length + p2.queue_length + p3.queue_length == 2
 
@@ -54,9 +64,11 @@ async def test_reschedule_task():
 
     # reschedule on connection lost
     await dispatcher.add_task(t1)
+    await wait_for_writers()
     assert t1.status == TaskStatus.SENT and p1.queue_length + p2.queue_length == 1
     scheduled_to1 = p1 if p1.id ==  t1.provider_id else p2
     await scheduled_to1.on_connection_lost()
+    await wait_for_writers()
     assert t1.status == TaskStatus.SENT and t1.provider_id != scheduled_to1.id
     assert scheduled_to1.is_online == False and scheduled_to1.queue_length == 0 and p1.queue_length + p2.queue_length == 1
 
@@ -67,9 +79,11 @@ async def test_reschedule_task():
     dispatcher.add_provider(p3)
     t1.set_status(TaskStatusPayload(task_status=TaskStatus.UNSCHEDULED))
     await dispatcher.add_task(t1)
+    await wait_for_writers()
     assert t1.status == TaskStatus.SENT and p1.queue_length + p2.queue_length == 1
     scheduled_to2 = p1 if p1.id == t1.provider_id else (p2 if p2.id == t1.provider_id else p3)
     await scheduled_to2.on_closed()
+    await wait_for_writers()
     assert len(dispatcher.providers) == 1
     assert t1.status == TaskStatus.SENT and t1.provider_id != scheduled_to2.id and t1.provider_id != scheduled_to1.id
     assert scheduled_to1.queue_length == 0 and scheduled_to2.queue_length == 0 and p1.queue_length + p2.queue_length + p3.queue_length == 1
@@ -87,12 +101,15 @@ async def test_abort_task():
 
     # abort task
     await dispatcher.add_task(t1)
+    await wait_for_writers()
     assert t1.status == TaskStatus.SENT and p1.queue_length == 1
     await p1.abort_task(t1)
+    await wait_for_writers()
     assert t1.status == TaskStatus.ABORTED and p1.queue_length == 0
 
     # fail task
     await dispatcher.add_task(t1)
+    await wait_for_writers()
     assert t1.status == TaskStatus.SENT and p1.queue_length == 1
     p1.task_failed(t1, "test failure")
     assert t1.status == TaskStatus.FAILED and p1.queue_length == 0
@@ -123,3 +140,428 @@ async def test_providers_simple():
     await dispatcher.remove_provider(p2.id)
     await dispatcher.remove_provider(p3.id)
     assert len(dispatcher.providers) == 0
+
+
+@pytest.mark.asyncio
+async def test_least_loaded_provider():
+    dispatcher = Dispatcher()
+    pub_meta_info = PublicMetaInfo(models=[], gpu_type="gpu1", ncpu=8, ram=32)
+    p1 = Provider("1", pub_meta_info, PrivateMetaInfo(), NetworkConnection())
+    p2 = Provider("2", pub_meta_info, PrivateMetaInfo(), NetworkConnection())
+    dispatcher.add_provider(p1)
+    dispatcher.add_provider(p2)
+
+    tasks = [Task(task_info=TaskInfo(id=str(i), max_cost=1, time_to_money_ratio = 1)) for i in range(4)]
+    for task in tasks:
+        await dispatcher.add_task(task)
+    assert p1.queue_length == 2 and p2.queue_length == 2
+
+    for task in list(p2.tasks_in_progress):
+        p2.task_completed(task)
+    t5 = Task(task_info=TaskInfo(id="5", max_cost=1, time_to_money_ratio = 1))
+    await dispatcher.add_task(t5)
+    assert t5.provider_id == p2.id
+    await dispatcher.close()
+
+
+
+@pytest.mark.asyncio
+async def test_entry_queue():
+    dispatcher = Dispatcher()
+    pub_meta_info = PublicMetaInfo(models=[], gpu_type="gpu1", ncpu=8, ram=32)
+    p1 = Provider("1", pub_meta_info, PrivateMetaInfo(), NetworkConnection())
+
+    low = Task(task_info=TaskInfo(id="1", max_cost=1, time_to_money_ratio = 1))
+    high = Task(task_info=TaskInfo(id="2", max_cost=1, time_to_money_ratio = 1, priority=10))
+    t3 = Task(task_info=TaskInfo(id="3", max_cost=1, time_to_money_ratio = 1))
+    await dispatcher.add_task(low)
+    await dispatcher.add_task(high)
+    assert low.status == TaskStatus.QUEUED and high.status == TaskStatus.QUEUED
+
+    assert dispatcher.entry_queue.pop_task() == high
+    assert dispatcher.entry_queue.pop_task() == low
+    assert dispatcher.entry_queue.pop_task() is None
+
+    # tasks are pulled from the queue once a provider has free capacity
+    await dispatcher.add_task(low)
+    await dispatcher.add_task(t3)
+    dispatcher.add_provider(p1)
+    await wait_for_writers()
+    assert low.status == TaskStatus.SENT and t3.status == TaskStatus.SENT
+    assert p1.queue_length == 2 and len(dispatcher.entry_queue) == 0
+
+
+@pytest.mark.asyncio
+async def test_capable_provider_preferred():
+    dispatcher = Dispatcher()
+    p1 = Provider("1", PublicMetaInfo(models=["SD1.5"], gpu_type="gpu1", ncpu=8, ram=32),
+                  PrivateMetaInfo(), NetworkConnection())
+    p2 = Provider("2", PublicMetaInfo(models=["SDXL"], gpu_type="gpu2", ncpu=8, ram=32),
+                  PrivateMetaInfo(), NetworkConnection())
+    dispatcher.add_provider(p1)
+    dispatcher.add_provider(p2)
+
+    t1 = build_task_from_query("1", max_cost=1, time_to_money_ratio=1,
+                               standard_pipeline={"prompt": "space surfer", "model": "SDXL"})
+    t2 = build_task_from_query("2", max_cost=1, time_to_money_ratio=1,
+                               standard_pipeline={"prompt": "space surfer", "model": "SDXL"})
+    await dispatcher.add_task(t1)
+    await dispatcher.add_task(t2)
+    assert t1.provider_id == p2.id and t2.provider_id == p2.id
+
+    t3 = build_task_from_query("3", max_cost=1, time_to_money_ratio=1, gpu_type="gpu1",
+                               comfy_pipeline={"pipelineData": json.dumps(
+                                   {"4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "SD1.5"}}}),
+                                   "pipelineDependencies": None})
+    assert t3.required_models == {"SD1.5"}
+    await dispatcher.add_task(t3)
+    assert t3.provider_id == p1.id
+
+    # no capable provider, the least loaded one is used
+    t4 = build_task_from_query("4", max_cost=1, time_to_money_ratio=1,
+                               standard_pipeline={"prompt": "space surfer", "model": "SD2.1"})
+    await dispatcher.add_task(t4)
+    assert t4.provider_id == p1.id
+
+    # capabilities follow meta info updates
+    p1.task_completed(t3)
+    p1.update_public_meta_info(PublicMetaInfo(models=["SDXL"], gpu_type="gpu1", ncpu=8, ram=32))
+    t5 = build_task_from_query("5", max_cost=1, time_to_money_ratio=1,
+                               standard_pipeline={"prompt": "space surfer", "model": "SDXL"})
+    await dispatcher.add_task(t5)
+    assert t5.provider_id == p1.id
+
+
+@pytest.mark.asyncio
+async def test_earliest_finish_time():
+    dispatcher = Dispatcher()
+    pub_meta_info = PublicMetaInfo(models=[], gpu_type="gpu1", ncpu=8, ram=32)
+    fast = Provider("1", pub_meta_info, PrivateMetaInfo(), NetworkConnection())
+    dispatcher.add_provider(fast)
+
+    def sd_task(task_id):
+        return build_task_from_query(task_id, max_cost=1, time_to_money_ratio=1,
+                                     standard_pipeline={"prompt": "space surfer", "model": "SD1.5"})
+
+    warmup = sd_task("0")
+    await dispatcher.add_task(warmup)
+    await asyncio.sleep(0.01)
+    fast.task_completed(warmup)
+    assert 0.01 <= fast.estimate_task_time(warmup) < 1 and fast.waiting_time == 0
+
+    slow = Provider("2", pub_meta_info, PrivateMetaInfo(), NetworkConnection())
+    dispatcher.add_provider(slow)
+
+    # the fast provider finishes three queued tasks before an idle provider
+    # without history finishes one
+    tasks = [sd_task(str(i)) for i in range(1, 4)]
+    for task in tasks:
+        await dispatcher.add_task(task)
+    assert fast.queue_length == 3 and slow.queue_length == 0
+    assert fast.waiting_time == pytest.approx(3 * fast.estimate_task_time(warmup))
+
+
+@pytest.mark.asyncio
+async def test_parallel_provider_estimates():
+    dispatcher = Dispatcher()
+    pub_meta_info = PublicMetaInfo(models=[], gpu_type="gpu1", ncpu=8, ram=32, credits=2)
+    provider = Provider("1", pub_meta_info, PrivateMetaInfo(), NetworkConnection())
+    dispatcher.add_provider(provider)
+
+    tasks = [build_task_from_query(str(i), max_cost=1, time_to_money_ratio=1,
+                                   standard_pipeline={"prompt": "space surfer", "model": "SD1.5"})
+             for i in range(4)]
+    for task in tasks[:2]:
+        await dispatcher.add_task(task)
+    await wait_for_writers()
+    for task in tasks[:2]:
+        provider.task_started(task)
+    await asyncio.sleep(0.05)
+    for task in tasks[:2]:
+        provider.task_completed(task)
+
+    # both tasks ran for their whole time, not one after the other
+    assert 0.05 <= provider.estimate_task_time(tasks[0]) < 1
+
+    # the two queued tasks run side by side
+    for task in tasks[2:]:
+        await dispatcher.add_task(task)
+    assert provider.waiting_time == pytest.approx(provider.estimate_task_time(tasks[2]))
+    await dispatcher.close()
+
+
+@pytest.mark.asyncio
+async def test_cost_aware_scheduling():
+    dispatcher = Dispatcher()
+    cheap = Provider("1", PublicMetaInfo(models=[], gpu_type="gpu1", ncpu=8, ram=32, price=1),
+                     PrivateMetaInfo(), NetworkConnection())
+    expensive = Provider("2", PublicMetaInfo(models=[], gpu_type="gpu2", ncpu=8, ram=32, price=10),
+                         PrivateMetaInfo(), NetworkConnection())
+    dispatcher.add_provider(cheap)
+    dispatcher.add_provider(expensive)
+
+    # keep the cheap provider busy, so it only finishes after the expensive one
+    for i in range(3):
+        await dispatcher.add_task(Task(task_info=TaskInfo(id=str(i), max_cost=1, time_to_money_ratio=0)))
+    assert cheap.queue_length == 3 and expensive.queue_length == 0
+
+    batch = Task(task_info=TaskInfo(id="batch", max_cost=15, time_to_money_ratio=0.01))
+    await dispatcher.add_task(batch)
+    assert batch.provider_id == cheap.id
+
+    urgent = Task(task_info=TaskInfo(id="urgent", max_cost=15, time_to_money_ratio=10))
+    await dispatcher.add_task(urgent)
+    assert urgent.provider_id == expensive.id
+
+    # nobody serves the task within budget, it stays queued without
+    # blocking the tasks behind it
+    cheap.update_public_meta_info(PublicMetaInfo(models=[], gpu_type="gpu1", ncpu=8, ram=32, price=5))
+    too_cheap = Task(task_info=TaskInfo(id="too_cheap", max_cost=2, time_to_money_ratio=1))
+    await dispatcher.add_task(too_cheap)
+    assert too_cheap.status == TaskStatus.QUEUED
+
+    other = Task(task_info=TaskInfo(id="other", max_cost=15, time_to_money_ratio=1))
+    await dispatcher.add_task(other)
+    await wait_for_writers()
+    assert other.status == TaskStatus.SENT and too_cheap.status == TaskStatus.QUEUED
+    assert len(dispatcher.entry_queue) == 1
+
+
+class BatchingConnection(NetworkConnection):
+    def __init__(self):
+        super().__init__()
+        self.frames = []
+
+    @property
+    def supports_batching(self):
+        return True
+
+    async def send_tasks(self, tasks):
+        self.frames.append([task.id for task in tasks])
+        await super().send_tasks(tasks)
+
+
+@pytest.mark.asyncio
+async def test_batched_delivery():
+    dispatcher = Dispatcher()
+    pub_meta_info = PublicMetaInfo(models=[], gpu_type="gpu1", ncpu=8, ram=32)
+    connection = BatchingConnection()
+    p1 = Provider("1", pub_meta_info, PrivateMetaInfo(), connection)
+    dispatcher.add_provider(p1)
+
+    tasks = [Task(task_info=TaskInfo(id=str(i), max_cost=1, time_to_money_ratio = 1)) for i in range(3)]
+    for task in tasks:
+        await dispatcher.add_task(task)
+    assert connection.frames == [] and p1.queue_length == 3
+
+    # aborted before the batch is sent
+    await p1.abort_task(tasks[1])
+    await asyncio.sleep(BATCH_WINDOW * 2)
+    assert connection.frames == [["0", "2"]]
+    assert tasks[0].status == TaskStatus.SENT and tasks[2].status == TaskStatus.SENT
+
+
+@pytest.mark.asyncio
+async def test_close_cancels_provider_futures():
+    dispatcher = Dispatcher()
+    pub_meta_info = PublicMetaInfo(models=[], gpu_type="gpu1", ncpu=8, ram=32)
+    batching = Provider("1", pub_meta_info, PrivateMetaInfo(), BatchingConnection())
+    offline = Provider("2", pub_meta_info, PrivateMetaInfo(), NetworkConnection())
+    dispatcher.add_provider(batching)
+    dispatcher.add_provider(offline)
+
+    # a batch waiting for its window, a writer and an offline timeout
+    await dispatcher.add_task(Task(task_info=TaskInfo(id="1", max_cost=1, time_to_money_ratio=1)))
+    await offline.schedule_task(Task(task_info=TaskInfo(id="2", max_cost=1, time_to_money_ratio=1)))
+    offline.start_offline()
+    assert len(asyncio.all_tasks()) > 1
+
+    await dispatcher.close()
+    assert asyncio.all_tasks() == {asyncio.current_task()}
+
+
+@pytest.mark.asyncio
+async def test_provider_credits():
+    dispatcher = Dispatcher()
+    small = Provider("1", PublicMetaInfo(models=[], gpu_type="cpu", ncpu=2, ram=4, credits=1),
+                     PrivateMetaInfo(), NetworkConnection())
+    big = Provider("2", PublicMetaInfo(models=[], gpu_type="gpu1", ncpu=64, ram=512, credits=2),
+                   PrivateMetaInfo(), NetworkConnection())
+    dispatcher.add_provider(small)
+    dispatcher.add_provider(big)
+    assert small.credits == 1 and big.credits == 2
+
+    tasks = [Task(task_info=TaskInfo(id=str(i), max_cost=1, time_to_money_ratio = 1)) for i in range(4)]
+    for task in tasks:
+        await dispatcher.add_task(task)
+    assert small.queue_length == 1 and big.queue_length == 2
+    assert tasks[3].status == TaskStatus.QUEUED
+
+    # credits granted at runtime pull the queued task
+    big.set_credits(3)
+    await asyncio.sleep(0)
+    assert tasks[3].provider_id == big.id and len(dispatcher.entry_queue) == 0
+
+
+@pytest.mark.asyncio
+async def test_work_stealing():
+    dispatcher = Dispatcher()
+    pub_meta_info = PublicMetaInfo(models=[], gpu_type="gpu1", ncpu=8, ram=32)
+    busy = Provider("1", pub_meta_info, PrivateMetaInfo(), NetworkConnection())
+    dispatcher.add_provider(busy)
+
+    tasks = [Task(task_info=TaskInfo(id=str(i), max_cost=1, time_to_money_ratio = 1)) for i in range(3)]
+    for task in tasks:
+        await dispatcher.add_task(task)
+    busy.task_started(tasks[0])
+    assert busy.last_unstarted_task == tasks[2]
+
+    idle = Provider("2", pub_meta_info, PrivateMetaInfo(), NetworkConnection())
+    dispatcher.add_provider(idle)
+    await wait_for_writers()
+    assert tasks[2].provider_id == idle.id and tasks[2].status == TaskStatus.SENT
+    assert busy.queue_length == 2 and idle.queue_length == 1
+
+    # the rest would not finish earlier on the other provider
+    assert tasks[0].provider_id == busy.id and tasks[1].provider_id == busy.id
+
+    # started tasks are never stolen
+    busy.task_started(tasks[1])
+    idle.task_completed(tasks[2])
+    await asyncio.sleep(0)
+    assert busy.queue_length == 2 and idle.queue_length == 0
+
+
+@pytest.mark.asyncio
+async def test_add_tasks():
+    dispatcher = Dispatcher()
+    pub_meta_info = PublicMetaInfo(models=[], gpu_type="gpu1", ncpu=8, ram=32, credits=2)
+    provider = Provider("1", pub_meta_info, PrivateMetaInfo(), NetworkConnection())
+    dispatcher.add_provider(provider)
+
+    tasks = [Task(task_info=TaskInfo(id=str(i), max_cost=1, time_to_money_ratio = 1)) for i in range(4)]
+    await dispatcher.add_tasks(tasks)
+    await wait_for_writers()
+    assert [task.status for task in tasks] == [TaskStatus.SENT] * 2 + [TaskStatus.QUEUED] * 2
+    assert len(dispatcher.entry_queue) == 2
+
+    provider.task_completed(tasks[0])
+    await wait_for_writers()
+    assert tasks[2].status == TaskStatus.SENT and len(dispatcher.entry_queue) == 1
+
+
+class StalledConnection(NetworkConnection):
+    def __init__(self):
+        super().__init__()
+        self.released = asyncio.Event()
+
+    async def send_task(self, task):
+        await self.released.wait()
+        await super().send_task(task)
+
+
+@pytest.mark.asyncio
+async def test_stalled_provider_backpressure():
+    dispatcher = Dispatcher()
+    pub_meta_info = PublicMetaInfo(models=[], gpu_type="gpu1", ncpu=8, ram=32)
+    connection = StalledConnection()
+    stalled = Provider("1", pub_meta_info, PrivateMetaInfo(), connection)
+    dispatcher.add_provider(stalled)
+
+    # scheduling never waits for the node
+    tasks = [Task(task_info=TaskInfo(id=str(i), max_cost=1, time_to_money_ratio = 1))
+             for i in range(MAX_OUTBOX_SIZE + 1)]
+    for task in tasks:
+        await asyncio.wait_for(dispatcher.add_task(task), 1)
+    await wait_for_writers()
+    assert stalled.outbox_length == MAX_OUTBOX_SIZE and not stalled.has_capacity
+    assert tasks[-1].status == TaskStatus.QUEUED
+
+    connection.released.set()
+    await wait_for_writers()
+    assert all(task.status == TaskStatus.SENT for task in tasks)
+    assert stalled.outbox_length == 0 and len(dispatcher.entry_queue) == 0
+
+
+@pytest.mark.asyncio
+async def test_parked_tasks():
+    dispatcher = Dispatcher()
+    expensive = Provider("1", PublicMetaInfo(models=[], gpu_type="gpu1", ncpu=8, ram=32, price=10),
+                         PrivateMetaInfo(), NetworkConnection())
+    dispatcher.add_provider(expensive)
+
+    # tasks over budget are parked and not pulled while only the expensive
+    # provider is available
+    low = Task(task_info=TaskInfo(id="low", max_cost=5, time_to_money_ratio=1))
+    high = Task(task_info=TaskInfo(id="high", max_cost=2, time_to_money_ratio=1, priority=10))
+    await dispatcher.add_task(low)
+    await dispatcher.add_task(high)
+    assert low.status == TaskStatus.QUEUED and high.status == TaskStatus.QUEUED
+    assert dispatcher.entry_queue.pop_task(expensive.price) is None
+    assert len(dispatcher.entry_queue) == 2
+
+    # a provider within the budget of both takes them by priority
+    cheap = Provider("2", PublicMetaInfo(models=[], gpu_type="gpu1", ncpu=8, ram=32, price=1, credits=1),
+                     PrivateMetaInfo(), NetworkConnection())
+    dispatcher.add_provider(cheap)
+    await wait_for_writers()
+    assert high.provider_id == cheap.id and low.status == TaskStatus.QUEUED
+
+    cheap.task_completed(high)
+    await wait_for_writers()
+    assert low.provider_id == cheap.id and len(dispatcher.entry_queue) == 0
+
+
+@pytest.mark.asyncio
+async def test_stealing_keeps_models():
+    dispatcher = Dispatcher()
+    busy = Provider("1", PublicMetaInfo(models=["SDXL"], gpu_type="gpu1", ncpu=8, ram=32),
+                    PrivateMetaInfo(), NetworkConnection())
+    dispatcher.add_provider(busy)
+
+    tasks = [build_task_from_query(str(i), max_cost=1, time_to_money_ratio=1,
+                                   standard_pipeline={"prompt": "space surfer", "model": "SDXL"})
+             for i in range(3)]
+    for task in tasks:
+        await dispatcher.add_task(task)
+    busy.task_started(tasks[0])
+
+    # the idle provider would finish earlier but does not have the model
+    idle = Provider("2", PublicMetaInfo(models=["SD1.5"], gpu_type="gpu1", ncpu=8, ram=32),
+                    PrivateMetaInfo(), NetworkConnection())
+    dispatcher.add_provider(idle)
+    await wait_for_writers()
+    assert busy.queue_length == 3 and idle.queue_length == 0
+
+    capable = Provider("3", PublicMetaInfo(models=["SDXL"], gpu_type="gpu1", ncpu=8, ram=32),
+                       PrivateMetaInfo(), NetworkConnection())
+    dispatcher.add_provider(capable)
+    await wait_for_writers()
+    assert tasks[2].provider_id == capable.id and idle.queue_length == 0
+    await dispatcher.close()
+
+
+@pytest.mark.asyncio
+async def test_no_stealing_without_started_reports():
+    dispatcher = Dispatcher()
+    pub_meta_info = PublicMetaInfo(models=[], gpu_type="gpu1", ncpu=8, ram=32)
+    busy = Provider("1", pub_meta_info, PrivateMetaInfo(), NetworkConnection())
+    dispatcher.add_provider(busy)
+
+    tasks = [Task(task_info=TaskInfo(id=str(i), max_cost=1, time_to_money_ratio=1)) for i in range(3)]
+    for task in tasks:
+        await dispatcher.add_task(task)
+
+    # the node never reports started tasks, so they may all be running
+    idle = Provider("2", pub_meta_info, PrivateMetaInfo(), NetworkConnection())
+    dispatcher.add_provider(idle)
+    await wait_for_writers()
+    assert busy.queue_length == 3 and idle.queue_length == 0
+    assert all(task.provider_id == busy.id for task in tasks)
+
+    # a node reporting the start of its first task becomes a victim
+    busy.task_started(tasks[0])
+    await dispatcher.steal_tasks(idle)
+    await wait_for_writers()
+    assert tasks[2].provider_id == idle.id
+    await dispatcher.close()
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import sys
+import pytest
+sys.path.append("/backend-python/src")
+
+from backend import Backend
+from dispatcher.dispatcher import Dispatcher
+from dispatcher.meta_info import PrivateMetaInfo, PublicMetaInfo
+from dispatcher.network_connection import NetworkConnection
+from dispatcher.provider import Provider
+from dispatcher.task import Task
+from dispatcher.task_info import TaskInfo
+from heartbeat import HEARTBEAT_FEATURE
+
+pytest_plugins = ('pytest_asyncio',)
+
+NODE_METADATA = {"models": [], "gpu_type": "gpu1", "ncpu": 8, "ram": 32}
+TASK_QUERY = {
+    "max_cost": 15,
+    "time_to_money_ratio": 1,
+    "standard_pipeline": {"prompt": "space surfer", "model": "SD2.1"},
+}
+
+
+class NodeWebSocketMock:
+    def __init__(self) -> None:
+        self.sent = []
+        self.closed = False
+
+    async def send_json(self, payload):
+        self.sent.append(payload)
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+    async def close(self, code=1000, reason=""):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_pong_measures_rtt():
+    backend = Backend(heartbeat_interval=0, heartbeat_timeout=10)
+    node_ws = NodeWebSocketMock()
+    await backend.register_node("node1", NODE_METADATA, [HEARTBEAT_FEATURE], node_ws)
+    await backend.heartbeat.check()
+    await asyncio.sleep(0)
+    ping = node_ws.sent[0]
+    assert ping["type"] == "ping"
+
+    provider = backend.dispatcher.providers["node1"]
+    await backend.handle_node_message("node1", {"type": "pong", "t": "later"})
+    assert provider.rtt == 0
+    await backend.handle_node_message("node1", {"type": "pong", "t": ping["t"]})
+    assert provider.rtt > 0
+    await backend.close()
+
+
+@pytest.mark.asyncio
+async def test_silent_node_goes_offline():
+    backend = Backend(heartbeat_interval=0, heartbeat_timeout=0.01)
+    node_ws = NodeWebSocketMock()
+    quiet_ws = NodeWebSocketMock()
+    await backend.register_node("node1", NODE_METADATA, [HEARTBEAT_FEATURE], node_ws)
+    # Nodes without the feature are never pinged
+    await backend.register_node("node2", {**NODE_METADATA, "credits": 0}, [], quiet_ws)
+    task_id = await backend.add_task("token", TASK_QUERY)
+    await asyncio.sleep(0)
+    assert node_ws.sent[0]["taskId"] == task_id
+
+    await asyncio.sleep(0.02)
+    await backend.heartbeat.check()
+    provider = backend.dispatcher.providers["node1"]
+    assert node_ws.closed and not quiet_ws.closed
+    assert not provider.is_online and provider.queue_length == 0
+    assert await backend.available_nodes() == 1
+    assert (await backend.get_task("token", task_id))["status"] == "PENDING"
+
+    # The node registering again within OFFLINE_TIMEOUT gets the task back
+    node_ws = NodeWebSocketMock()
+    await backend.register_node("node1", NODE_METADATA, [HEARTBEAT_FEATURE], node_ws)
+    # The queued task is pulled, then sent by the writer of the provider
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert backend.dispatcher.providers["node1"] is provider and provider.is_online
+    assert node_ws.sent[0]["taskId"] == task_id
+    await backend.close()
+
+
+@pytest.mark.asyncio
+async def test_rtt_counts_in_score():
+    dispatcher = Dispatcher()
+    pub_meta_info = PublicMetaInfo(models=[], gpu_type="gpu1", ncpu=8, ram=32)
+    far = Provider("1", pub_meta_info, PrivateMetaInfo(), NetworkConnection())
+    near = Provider("2", pub_meta_info, PrivateMetaInfo(), NetworkConnection())
+    dispatcher.add_provider(far)
+    dispatcher.add_provider(near)
+    far.record_rtt(2.0)
+    near.record_rtt(0.1)
+    near.record_rtt(0.5)
+    assert near.rtt == pytest.approx(0.15)
+
+    task = Task(task_info=TaskInfo(id="1", max_cost=1, time_to_money_ratio=1))
+    await dispatcher.add_task(task)
+    assert task.provider_id == near.id
@@ -0,0 +1,158 @@
+import asyncio
+import json
+import sys
+import pytest
+sys.path.append("/backend-python/src")
+
+from backend import Backend
+from dispatcher.task import Task
+from dispatcher.task_info import ScheduledPayload, TaskInfo, TaskStatus, TaskStatusPayload
+from journal import TaskJournal, replay_journal
+
+pytest_plugins = ('pytest_asyncio',)
+
+NODE_METADATA = {"models": ["SD2.1"], "gpu_type": "gpu1", "ncpu": 8, "ram": 32}
+TASK_QUERY = {
+    "max_cost": 15,
+    "time_to_money_ratio": 1,
+    "standard_pipeline": {
+        "prompt": "space surfer",
+        "model": "SD2.1",
+        "size": {"height": 512, "width": 512},
+        "steps": 25,
+    },
+}
+
+
+class NodeWebSocketMock:
+    def __init__(self) -> None:
+        self.sent = []
+
+    async def send_json(self, payload):
+        self.sent.append(payload)
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+
+def test_replay_and_compaction(tmp_path):
+    path = str(tmp_path / "tasks.journal")
+    journal = TaskJournal(path)
+    journal.open(dict())
+    tasks = [Task(TaskInfo(id=str(i), max_cost=1, time_to_money_ratio=1)) for i in range(3)]
+    for task in tasks:
+        journal.task_submitted(7, task)
+        task.set_on_status_changed(journal.task_status_changed)
+    tasks[0].set_status(ScheduledPayload(provider_id="node1", min_score=0, waiting_time=0))
+    tasks[0].set_status(TaskStatusPayload(task_status=TaskStatus.SENT))
+    tasks[1].set_status(TaskStatusPayload(task_status=TaskStatus.QUEUED))
+    tasks[2].set_status(TaskStatusPayload(task_status=TaskStatus.COMPLETED))
+    journal.close()
+    # A write cut short by a crash
+    with open(path, "a") as file:
+        file.write('{"e": "sent", "id"')
+
+    recovered = replay_journal(path)
+    assert set(recovered) == {"0", "1"}
+    assert recovered["0"].status == TaskStatus.SENT and recovered["0"].provider_id == "node1"
+    assert recovered["1"].status == TaskStatus.QUEUED and recovered["1"].provider_id is None
+    assert recovered["0"].user_id == 7 and recovered["0"].submitted_at == tasks[0].submitted_at
+    assert TaskInfo.from_dict(recovered["0"].info) == tasks[0].task_info
+
+    journal = TaskJournal(path)
+    journal.open(recovered)
+    journal.close()
+    with open(path) as file:
+        assert len(file.readlines()) == 4
+    assert replay_journal(path) == recovered
+
+
+def test_periodic_compaction(tmp_path):
+    path = str(tmp_path / "tasks.journal")
+    journal = TaskJournal(path, compaction_events=4)
+    journal.open(dict())
+    tasks = [Task(TaskInfo(id=str(i), max_cost=1, time_to_money_ratio=1)) for i in range(3)]
+    for task in tasks:
+        journal.task_submitted(7, task)
+        task.set_on_status_changed(journal.task_status_changed)
+    tasks[0].set_status(TaskStatusPayload(task_status=TaskStatus.COMPLETED))
+    # A task failed by a provider going offline is queued again after the
+    # next compaction
+    tasks[1].set_status(TaskStatusPayload(task_status=TaskStatus.FAILED))
+    journal.flush()
+    with open(path) as file:
+        assert sorted(json.loads(line)["id"] for line in file) == ["1", "1", "2"]
+
+    tasks[1].set_status(TaskStatusPayload(task_status=TaskStatus.QUEUED))
+    tasks[2].set_status(TaskStatusPayload(task_status=TaskStatus.FAILED))
+    for _ in range(3):
+        tasks[1].set_status(TaskStatusPayload(task_status=TaskStatus.QUEUED))
+    journal.flush()
+    journal.close()
+    with open(path) as file:
+        assert len(file.readlines()) == 4
+    assert set(replay_journal(path)) == {"1"}
+
+
+@pytest.mark.asyncio
+async def test_tasks_recovered_after_restart(tmp_path):
+    path = str(tmp_path / "tasks.journal")
+    backend = Backend(journal_path=path)
+    await backend.start()
+    await backend.register_node("node1", NODE_METADATA, [], NodeWebSocketMock())
+    sent_task_id = await backend.add_task("token", TASK_QUERY)
+    lost_task_id = await backend.add_task("token", TASK_QUERY)
+    completed_task_id = await backend.add_task("token", TASK_QUERY)
+    await backend.handle_node_message("node1", {
+        "type": "result", "taskId": completed_task_id, "resultsUrl": ["url"]})
+    await backend.close()
+
+    backend = Backend(journal_path=path)
+    await backend.start()
+    assert await backend.get_task("token", sent_task_id) == {"status": "PENDING", "result": None}
+    assert await backend.get_task("token", completed_task_id) is None
+
+    # The node still working on the task takes it back without a resend,
+    # the task it no longer holds is sent again
+    node_ws = NodeWebSocketMock()
+    await backend.register_node("node1", NODE_METADATA, [], node_ws, [sent_task_id])
+    provider = backend.dispatcher.providers["node1"]
+    task = provider.get_task_in_progress(sent_task_id)
+    assert task is not None and task.status == TaskStatus.SCHEDULED
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert [message["taskId"] for message in node_ws.sent] == [lost_task_id]
+
+    for task_id in (sent_task_id, lost_task_id):
+        await backend.handle_node_message("node1", {
+            "type": "result", "taskId": task_id, "resultsUrl": ["url"]})
+    assert (await backend.get_task("token", sent_task_id))["status"] == "SUCCESS"
+    await backend.close()
+    assert replay_journal(path) == dict()
+
+
+@pytest.mark.asyncio
+async def test_sent_tasks_journaled(tmp_path):
+    path = str(tmp_path / "tasks.journal")
+    backend = Backend(journal_path=path)
+    await backend.start()
+    node_ws = NodeWebSocketMock()
+    await backend.register_node("node1", NODE_METADATA, ["tasksBatch"], node_ws)
+    task_id = await backend.add_task("token", TASK_QUERY)
+    batch_task_ids = await backend.add_tasks("token", [TASK_QUERY, TASK_QUERY])
+    await asyncio.sleep(0.05)
+    assert len(node_ws.sent) == 1 and len(node_ws.sent[0]["tasks"]) == 3
+    await backend.close()
+
+    # The tasks written to the node are replayed as sent to it
+    tasks = replay_journal(path)
+    for journaled_id in (task_id, *batch_task_ids):
+        assert tasks[journaled_id].status == TaskStatus.SENT
+        assert tasks[journaled_id].provider_id == "node1"
+
+    backend = Backend(journal_path=path)
+    await backend.start()
+    await backend.register_node("node1", NODE_METADATA, [], NodeWebSocketMock(), [task_id])
+    task = backend.dispatcher.providers["node1"].get_task_in_progress(task_id)
+    assert task is not None and task.status == TaskStatus.SENT
+    await backend.close()
@@ -0,0 +1,73 @@
+import sys
+import pytest
+sys.path.append("/backend-python/src")
+
+from backend import Backend
+from messages import REGISTER_VALIDATOR, InvalidMessage, decode_message, schema_error
+
+pytest_plugins = ('pytest_asyncio',)
+
+NODE_METADATA = {"models": [], "gpu_type": "gpu1", "ncpu": 8, "ram": 32}
+TASK_QUERY = {
+    "max_cost": 15,
+    "time_to_money_ratio": 1,
+    "standard_pipeline": {"prompt": "space surfer", "model": "SD2.1"},
+}
+
+
+class NodeWebSocketMock:
+    async def send_json(self, payload):
+        pass
+
+    async def send_text(self, text):
+        pass
+
+
+def test_decode_message():
+    assert decode_message('{"type": "status"}') == {"type": "status"}
+    with pytest.raises(InvalidMessage):
+        decode_message('{"type": ')
+    with pytest.raises(InvalidMessage):
+        decode_message('["register"]')
+
+
+def test_register_schema():
+    register = {"type": "register", "node_id": "node1", "metadata": NODE_METADATA}
+    assert schema_error(REGISTER_VALIDATOR, register) is None
+    assert schema_error(REGISTER_VALIDATOR, {**register, "metadata": None}) is not None
+    assert schema_error(REGISTER_VALIDATOR, {"type": "register", "metadata": {}}) is not None
+
+
+@pytest.mark.asyncio
+async def test_malformed_result_fails_task():
+    backend = Backend()
+    messages = []
+    backend.add_result_listener(lambda task_id, message: messages.append(message))
+    await backend.register_node("node1", NODE_METADATA, [], NodeWebSocketMock())
+    task_id = await backend.add_task("token", TASK_QUERY)
+
+    await backend.handle_node_message("node1", {"type": "result", "taskId": task_id, "resultsUrl": "url"})
+    assert messages[0]["type"] == "error" and messages[0]["taskId"] == task_id
+    assert backend.dispatcher.providers["node1"].queue_length == 0
+    task_data = await backend.get_task("token", task_id)
+    assert task_data["status"] == "FAILED"
+    assert task_data["result"]["error"].startswith("Invalid task result")
+    await backend.close()
+
+
+@pytest.mark.asyncio
+async def test_invalid_task_options_fail_task():
+    backend = Backend()
+    messages = []
+    backend.add_result_listener(lambda task_id, message: messages.append(message))
+    await backend.register_node("node1", NODE_METADATA, [], NodeWebSocketMock())
+    task_id = await backend.add_task("token", {
+        **TASK_QUERY, "standard_pipeline": {"prompt": "space surfer", "model": "SD2.1", "size": 512}})
+
+    # The options are validated once on submission, the task is never sent
+    assert messages[0]["type"] == "error" and messages[0]["taskId"] == task_id
+    assert backend.dispatcher.providers["node1"].queue_length == 0
+    task_data = await backend.get_task("token", task_id)
+    assert task_data["status"] == "FAILED"
+    assert task_data["result"]["error"].startswith("Invalid task options")
+    await backend.close()
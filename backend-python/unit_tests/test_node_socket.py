@@ -0,0 +1,105 @@
+import json
+import sys
+import zlib
+import pytest
+sys.path.append("/backend-python/src")
+
+from messages import InvalidMessage
+from node_socket import (COMPRESSION_THRESHOLD, DEFLATE_FEATURE, MSGPACK_FEATURE, EncodedPart, NodeMessage,
+                         NodeWebSocket)
+
+pytest_plugins = ('pytest_asyncio',)
+
+RESULT = {"type": "result", "taskId": "1", "resultsUrl": ["url"]}
+
+
+class WebSocketMock:
+    def __init__(self, frames=()) -> None:
+        self.frames = list(frames)
+        self.sent = []
+
+    async def receive(self):
+        return self.frames.pop(0)
+
+    async def send_json(self, payload):
+        self.sent.append(("text", json.dumps(payload)))
+
+    async def send_text(self, text):
+        self.sent.append(("text", text))
+
+    async def send_bytes(self, data):
+        self.sent.append(("bytes", data))
+
+
+@pytest.mark.asyncio
+async def test_json_text_by_default():
+    ws = WebSocketMock([{"type": "websocket.receive", "text": json.dumps(RESULT)}])
+    node_ws = NodeWebSocket(ws)
+    assert node_ws.negotiate(["tasksBatch"]) == []
+    assert node_ws.decode(await node_ws.receive()) == RESULT
+
+    await node_ws.send_text("x" * COMPRESSION_THRESHOLD)
+    assert ws.sent == [("text", "x" * COMPRESSION_THRESHOLD)]
+
+
+@pytest.mark.asyncio
+async def test_deflate():
+    ws = WebSocketMock()
+    node_ws = NodeWebSocket(ws)
+    assert node_ws.negotiate([DEFLATE_FEATURE]) == [DEFLATE_FEATURE]
+
+    # Small messages are not worth compressing
+    await node_ws.send_json({"type": "abort", "taskId": "1"})
+    await node_ws.send_text(json.dumps({"pipelineData": "x" * COMPRESSION_THRESHOLD}))
+    assert ws.sent[0] == ("text", '{"type":"abort","taskId":"1"}')
+    kind, data = ws.sent[1]
+    assert kind == "bytes" and len(data) < COMPRESSION_THRESHOLD
+    assert json.loads(zlib.decompress(data)) == {"pipelineData": "x" * COMPRESSION_THRESHOLD}
+
+    assert node_ws.decode(zlib.compress(json.dumps(RESULT).encode())) == RESULT
+    with pytest.raises(InvalidMessage):
+        node_ws.decode(json.dumps(RESULT).encode())
+
+
+@pytest.mark.asyncio
+async def test_msgpack():
+    msgpack = pytest.importorskip("msgpack")
+    ws = WebSocketMock()
+    node_ws = NodeWebSocket(ws)
+    assert node_ws.negotiate([MSGPACK_FEATURE, DEFLATE_FEATURE]) == [MSGPACK_FEATURE, DEFLATE_FEATURE]
+
+    await node_ws.send_text('{"taskId":"1","options":null,"comfyOptions":null}')
+    kind, data = ws.sent[0]
+    assert kind == "bytes"
+    assert msgpack.unpackb(zlib.decompress(data)) == {"taskId": "1", "options": None, "comfyOptions": None}
+    assert node_ws.decode(zlib.compress(msgpack.packb(RESULT))) == RESULT
+
+
+@pytest.mark.asyncio
+async def test_node_message_reuses_encoded_parts():
+    msgpack = pytest.importorskip("msgpack")
+    options = {"pipelineData": "x" * COMPRESSION_THRESHOLD, "pipelineDependencies": None}
+    part = EncodedPart(json.dumps(options, separators=(",", ":")), options)
+    value = {"type": "tasks", "tasks": [
+        {"taskId": str(i), "options": None, "comfyOptions": part} for i in range(2)]}
+    message = NodeMessage(value)
+    expected = {"type": "tasks", "tasks": [
+        {"taskId": str(i), "options": None, "comfyOptions": options} for i in range(2)]}
+    assert json.loads(message) == expected
+
+    for features, decode in (([DEFLATE_FEATURE], lambda data: json.loads(zlib.decompress(data))),
+                             ([MSGPACK_FEATURE], msgpack.unpackb),
+                             ([MSGPACK_FEATURE, DEFLATE_FEATURE], lambda data: msgpack.unpackb(zlib.decompress(data)))):
+        ws = WebSocketMock()
+        node_ws = NodeWebSocket(ws)
+        node_ws.negotiate(features)
+        await node_ws.send_text(message)
+        kind, data = ws.sent[0]
+        assert kind == "bytes"
+        assert decode(data) == expected
+
+    # The shared part is encoded once for every message holding it
+    packed = part.data(True)
+    deflated = part.deflated(True)
+    NodeMessage({"taskId": "3", "options": None, "comfyOptions": part}).frame(True, True)
+    assert part.data(True) is packed and part.deflated(True) is deflated
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import sys
+import pytest
+sys.path.append("/backend-python/src")
+
+from backend import Backend
+from dispatcher.task_info import TaskStatus, TaskStatusPayload
+from result_cache import ResultCache
+
+pytest_plugins = ('pytest_asyncio',)
+
+NODE_METADATA = {"models": [], "gpu_type": "gpu1", "ncpu": 8, "ram": 32}
+TASK_QUERY = {
+    "max_cost": 15,
+    "time_to_money_ratio": 1,
+    "comfy_pipeline": {
+        "pipelineData": '{"3": {"class_type": "KSampler", "inputs": {"seed": 1}}}',
+        "pipelineDependencies": None,
+    },
+}
+
+
+class NodeWebSocketMock:
+    def __init__(self) -> None:
+        self.sent = []
+
+    async def send_json(self, payload):
+        self.sent.append(payload)
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+
+async def start_backend():
+    backend = Backend(result_cache_size=10)
+    node_ws = NodeWebSocketMock()
+    await backend.register_node("node1", NODE_METADATA, [], node_ws)
+    messages = []
+    backend.add_result_listener(lambda task_id, message: messages.append((task_id, message)))
+    return backend, node_ws, messages
+
+
+@pytest.mark.asyncio
+async def test_identical_pipelines_executed_once():
+    backend, node_ws, messages = await start_backend()
+    leader_id = await backend.add_task("token", TASK_QUERY)
+    follower_id = await backend.add_task("token", TASK_QUERY)
+    await asyncio.sleep(0)
+    assert [task["taskId"] for task in node_ws.sent] == [leader_id]
+    assert (await backend.get_task("token", follower_id))["status"] == "PENDING"
+
+    await backend.handle_node_message("node1", {
+        "type": "result", "taskId": leader_id, "resultsUrl": ["url"]})
+    for task_id in (leader_id, follower_id):
+        assert await backend.get_task("token", task_id) == {
+            "status": "SUCCESS", "result": {"images": ["url"]}}
+    assert {task_id for task_id, _ in messages} == {leader_id, follower_id}
+
+    # A repeat of a completed pipeline is served from the cache
+    cached_id = await backend.add_task("token", TASK_QUERY)
+    await asyncio.sleep(0)
+    assert len(node_ws.sent) == 1
+    assert (await backend.get_task("token", cached_id))["status"] == "SUCCESS"
+    assert messages[-1] == (cached_id, {"type": "result", "taskId": cached_id, "resultsUrl": ["url"]})
+    assert (await backend.storage_stats())["result_cache_hits"] == 1
+
+    # Other users get the pipeline executed for them
+    other_id = await backend.add_task("other token", TASK_QUERY)
+    await asyncio.sleep(0)
+    assert [task["taskId"] for task in node_ws.sent] == [leader_id, other_id]
+    assert (await backend.get_task("other token", other_id))["status"] == "PENDING"
+    await backend.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_pipeline_not_cached():
+    backend, node_ws, messages = await start_backend()
+    leader_id = await backend.add_task("token", TASK_QUERY)
+    follower_id = await backend.add_task("token", TASK_QUERY)
+    await asyncio.sleep(0)
+    await backend.handle_node_message("node1", {
+        "type": "error", "taskId": leader_id, "error": "out of memory"})
+    assert messages[0] == (follower_id, {
+        "type": "error", "taskId": follower_id, "error": "out of memory"})
+
+    retry_id = await backend.add_task("token", TASK_QUERY)
+    await asyncio.sleep(0)
+    assert [task["taskId"] for task in node_ws.sent] == [leader_id, retry_id]
+    await backend.close()
+
+
+def test_results_expire():
+    cache = ResultCache(size=1, ttl=0)
+    cache.put("key", ["url"])
+    assert cache.get("key") is None and len(cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_followers_released_when_leader_dropped():
+    backend, node_ws, messages = await start_backend()
+    leader_id = await backend.add_task("token", TASK_QUERY)
+    follower_id = await backend.add_task("token", TASK_QUERY)
+    leader = (await backend.storage_manager.get_task_data(leader_id))["task"]
+    # As the dispatcher does with a task no queue can take
+    leader.set_status(TaskStatusPayload(task_status=TaskStatus.FAILED))
+    await asyncio.sleep(0)
+    assert messages == [(follower_id, {"type": "error", "taskId": follower_id, "error": "Task was dropped"})]
+    assert (await backend.get_task("token", follower_id))["status"] == "FAILED"
+    await backend.close()
+
+
+@pytest.mark.asyncio
+async def test_follower_dispatched_after_timeout():
+    backend = Backend(result_cache_size=10, result_follow_timeout=0.01)
+    await backend.add_task("token", TASK_QUERY)
+    follower_id = await backend.add_task("token", TASK_QUERY)
+    assert len(backend.dispatcher.entry_queue) == 1
+
+    # The leader is never scheduled, the follower stops waiting for it
+    await asyncio.sleep(0.05)
+    assert len(backend.dispatcher.entry_queue) == 2
+    follower = (await backend.storage_manager.get_task_data(follower_id))["task"]
+    assert follower.status == TaskStatus.QUEUED
+    assert (await backend.storage_stats())["pipelines_in_flight"] == 1
+    await backend.close()
@@ -0,0 +1,104 @@
+import sys
+sys.path.append("/backend-python/src")
+
+from result_waiters import ResultWaiters
+
+import asyncio
+import pytest
+
+pytest_plugins = ('pytest_asyncio',)
+
+
+@pytest.mark.asyncio
+async def test_result_waiters():
+    waiters = ResultWaiters(ttl=0.05, max_unclaimed=2)
+
+    # Every waiter of a task gets the result, nothing is kept afterwards
+    first = asyncio.ensure_future(waiters.wait("1", 1))
+    second = asyncio.ensure_future(waiters.wait("1", 1))
+    await asyncio.sleep(0)
+    assert len(waiters) == 1
+    waiters.set_result("1", {"status": "ready"})
+    assert await first == {"status": "ready"}
+    assert await second == {"status": "ready"}
+    assert len(waiters) == 0
+
+    # A timed out waiter is removed without failing the other waiters
+    timed_out = asyncio.ensure_future(waiters.wait("2", 0.01))
+    waiting = asyncio.ensure_future(waiters.wait("2", 1))
+    with pytest.raises(asyncio.TimeoutError):
+        await timed_out
+    waiters.set_result("2", {"status": "ready"})
+    assert await waiting == {"status": "ready"}
+    with pytest.raises(asyncio.TimeoutError):
+        await waiters.wait("3", 0.01)
+    assert len(waiters) == 0
+
+    # Results arriving before the waiter are kept until they expire
+    waiters.set_result("4", {"status": "ready"})
+    assert await waiters.wait("4", 1) == {"status": "ready"}
+    for task_id in ["5", "6", "7"]:
+        waiters.set_result(task_id, {"status": "ready"})
+    assert len(waiters) == 2
+    await asyncio.sleep(0.06)
+    with pytest.raises(asyncio.TimeoutError):
+        await waiters.wait("7", 0.01)
+    assert len(waiters) == 0
+
+
+@pytest.mark.asyncio
+async def test_result_waiters_timeout():
+    waiters = ResultWaiters()
+    with pytest.raises(asyncio.TimeoutError):
+        await waiters.wait("1", 0.01)
+    assert len(waiters) == 0
+
+    # A result arriving after its only waiter gave up is kept for a later one
+    waiters.set_result("1", {"status": "ready"})
+    assert len(waiters) == 1
+    assert await waiters.wait("1", 0.01) == {"status": "ready"}
+    assert len(waiters) == 0
+
+
+@pytest.mark.asyncio
+async def test_result_waiters_unclaimed_result():
+    waiters = ResultWaiters()
+    waiters.set_result("1", {"status": "ready", "attempt": 1})
+    # The latest result of a task replaces the one not claimed yet
+    waiters.set_result("1", {"status": "ready", "attempt": 2})
+    assert len(waiters) == 1
+
+    # Claimed at once and only once
+    assert await asyncio.wait_for(waiters.wait("1"), 0.01) == {"status": "ready", "attempt": 2}
+    with pytest.raises(asyncio.TimeoutError):
+        await waiters.wait("1", 0.01)
+
+
+@pytest.mark.asyncio
+async def test_result_waiters_unclaimed_results_expire():
+    waiters = ResultWaiters(ttl=0.05)
+    waiters.set_result("1", {"status": "ready"})
+    await asyncio.sleep(0.03)
+    waiters.set_result("2", {"status": "ready"})
+    await asyncio.sleep(0.03)
+
+    # Only the results past their time to live are dropped
+    with pytest.raises(asyncio.TimeoutError):
+        await waiters.wait("1", 0.01)
+    assert len(waiters) == 1
+    assert await waiters.wait("2", 0.01) == {"status": "ready"}
+
+
+@pytest.mark.asyncio
+async def test_result_waiters_unclaimed_results_bounded():
+    waiters = ResultWaiters(max_unclaimed=2)
+    for task_id in ["1", "2", "3"]:
+        waiters.set_result(task_id, {"status": "ready", "taskId": task_id})
+
+    # The oldest unclaimed result makes room for the newest
+    assert len(waiters) == 2
+    with pytest.raises(asyncio.TimeoutError):
+        await waiters.wait("1", 0.01)
+    assert await waiters.wait("2", 0.01) == {"status": "ready", "taskId": "2"}
+    assert await waiters.wait("3", 0.01) == {"status": "ready", "taskId": "3"}
+    assert len(waiters) == 0
@@ -2,51 +2,241 @@ import sys
 sys.path.append("/backend-python/src")
 
 from dispatcher.task import Task
-from dispatcher.task_info import PublicTaskStatus, TaskInfo
-from storage import StorageManager, UsersStorage
+from dispatcher.task_info import PublicTaskStatus, TaskInfo, TaskStatus, TaskStatusPayload
+from storage import MemoryStorageEngine, StorageManager, TaskCache, UsersStorage
+from storage.pagination import decode_cursor, encode_cursor
+from storage.sqlite_engine import SQLiteStorageEngine
+from storage.supabase_engine import _after_filter
 
+import asyncio
+import pytest
+import pytest_asyncio
 
-def test_storage_manager():
-    manager = StorageManager()
+pytest_plugins = ('pytest_asyncio',)
+
+
+@pytest_asyncio.fixture(params=["memory", "sqlite"])
+async def manager(request, tmp_path):
+    if request.param == "memory":
+        engine = MemoryStorageEngine()
+    else:
+        engine = SQLiteStorageEngine(str(tmp_path / "tasks.db"))
+    manager = StorageManager(engine)
+    yield manager
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_storage_manager(manager):
     users_storage = UsersStorage()
     uid1 = users_storage.get_user_id("token1")
     uid2 = users_storage.get_user_id("token2")
-    manager.add_task(
+    await manager.add_task(
         uid1, "1", Task(TaskInfo(id="1", max_cost=1, time_to_money_ratio=10))
     )
-    manager.add_task(
+    await manager.add_task(
         uid2, "2", Task(TaskInfo(id="2", max_cost=2, time_to_money_ratio=20))
     )
 
-    task_info = manager.get_task_data("1")
-    task_info["status"] == PublicTaskStatus.PENDING.name
+    task_info = await manager.get_task_data("1")
+    assert task_info["status"] == PublicTaskStatus.PENDING.name
     assert isinstance(task_info["task"], Task)
     assert task_info["task"].id == "1"
     assert task_info["task"].max_cost == 1
     assert task_info["task"].time_to_money_ratio == 10
 
-    task_info = manager.get_task_data("2")
-    task_info["status"] == PublicTaskStatus.PENDING.name
+    task_info = await manager.get_task_data("2")
+    assert task_info["status"] == PublicTaskStatus.PENDING.name
     assert isinstance(task_info["task"], Task)
     assert task_info["task"].id == "2"
     assert task_info["task"].max_cost == 2
     assert task_info["task"].time_to_money_ratio == 20
 
-    task_info = manager.get_task_data_with_verification(uid2, "2")
-    task_info["status"] == PublicTaskStatus.PENDING.name
+    task_info = await manager.get_task_data_with_verification(uid2, "2")
+    assert task_info["status"] == PublicTaskStatus.PENDING.name
     assert isinstance(task_info["task"], Task)
     assert task_info["task"].id == "2"
     assert task_info["task"].max_cost == 2
     assert task_info["task"].time_to_money_ratio == 20
 
-    task_info = manager.get_task_data_with_verification(uid1, "2")
+    task_info = await manager.get_task_data_with_verification(uid1, "2")
     assert task_info is None
+    assert await manager.get_task_data("3") is None
 
-    manager.add_result("2", "result_image_url")
-    task_info = manager.get_task_data_with_verification(uid2, "2")
-    task_info["status"] == PublicTaskStatus.SUCCESS.name
+    await manager.add_result("2", "result_image_url")
+    task_info = await manager.get_task_data_with_verification(uid2, "2")
+    assert task_info["status"] == PublicTaskStatus.SUCCESS.name
     assert isinstance(task_info["task"], Task)
     assert task_info["task"].id == "2"
     assert task_info["task"].max_cost == 2
     assert task_info["task"].time_to_money_ratio == 20
     assert task_info["result"] == {"images": "result_image_url"}
+
+    tasks = await manager.get_tasks(uid1)
+    assert list(tasks.keys()) == ["1"]
+    assert await manager.get_tasks(users_storage.get_user_id("token3")) is None
+
+
+@pytest.mark.asyncio
+async def test_storage_manager_cache(tmp_path):
+    engine = SQLiteStorageEngine(str(tmp_path / "tasks.db"))
+    manager = StorageManager(engine, TaskCache(size=2))
+    await manager.add_task(1, "1", Task(TaskInfo(id="1", max_cost=1, time_to_money_ratio=10)))
+
+    # Added tasks are served from the cache with results written through
+    await manager.add_result("1", "result_image_url")
+    task_info = await manager.get_task_data_with_verification(1, "1")
+    assert task_info["status"] == PublicTaskStatus.SUCCESS.name
+    assert task_info["result"] == {"images": "result_image_url"}
+    assert await manager.get_task_data_with_verification(2, "1") is None
+    assert manager.cache.hits == 1
+
+    # Evicted tasks are read from the engine once and cached again
+    await manager.add_task(1, "2", Task(TaskInfo(id="2", max_cost=1, time_to_money_ratio=10)))
+    await manager.add_task(1, "3", Task(TaskInfo(id="3", max_cost=1, time_to_money_ratio=10)))
+    assert len(manager.cache) == 2
+    misses = manager.cache.misses
+    assert (await manager.get_task_data("1"))["result"] == {"images": "result_image_url"}
+    assert (await manager.get_task_data_with_verification(1, "1"))["task"].id == "1"
+    assert manager.cache.misses == misses + 2
+    assert (await manager.get_task_data_with_verification(1, "1"))["task"].id == "1"
+    assert manager.cache.misses == misses + 2
+
+    manager.invalidate("1")
+    assert await manager.get_task_data("1") is not None
+    assert manager.cache.misses == misses + 3
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_storage_manager_cache_write_through(tmp_path):
+    engine = SQLiteStorageEngine(str(tmp_path / "tasks.db"))
+    manager = StorageManager(engine, TaskCache(size=1))
+    task = Task(TaskInfo(id="1", max_cost=1, time_to_money_ratio=10))
+    await manager.add_task(1, "1", task)
+    await manager.add_task(1, "2", Task(TaskInfo(id="2", max_cost=1, time_to_money_ratio=10)))
+
+    # A result written while the task is read is not lost by caching the read
+    read_task_data = engine.get_task_data
+    written = asyncio.Event()
+
+    async def get_task_data_before_write(task_id):
+        task_data = await read_task_data(task_id)
+        await written.wait()
+        return task_data
+
+    engine.get_task_data = get_task_data_before_write
+    read = asyncio.ensure_future(manager.get_task_data("1"))
+    await asyncio.sleep(0.01)
+    await manager.add_result("1", "result_image_url")
+    written.set()
+    assert (await read)["status"] == PublicTaskStatus.PENDING.name
+    engine.get_task_data = read_task_data
+    task_info = await manager.get_task_data("1")
+    assert task_info["status"] == PublicTaskStatus.SUCCESS.name
+
+    # The cached copy read from the engine is replaced by the updated task
+    task.set_status(TaskStatusPayload(task_status=TaskStatus.COMPLETED))
+    manager.task_status_changed(task)
+    assert (await manager.get_task_data("1"))["task"] is task
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_storage_manager_tasks_page(manager):
+    for i in range(5):
+        await manager.add_task(1, str(i), Task(TaskInfo(id=str(i), max_cost=1, time_to_money_ratio=10)))
+    await manager.add_task(2, "5", Task(TaskInfo(id="5", max_cost=1, time_to_money_ratio=10)))
+    await manager.add_result("1", "result_image_url")
+    await manager.add_result("3", "result_image_url")
+
+    page = await manager.get_tasks_page(1, 2)
+    assert list(page.tasks.keys()) == ["0", "1"]
+    page = await manager.get_tasks_page(1, 2, page.next_cursor)
+    assert list(page.tasks.keys()) == ["2", "3"]
+    page = await manager.get_tasks_page(1, 2, page.next_cursor)
+    assert list(page.tasks.keys()) == ["4"]
+    assert page.next_cursor is None
+
+    page = await manager.get_tasks_page(1, 1, status="success")
+    assert list(page.tasks.keys()) == ["1"]
+    page = await manager.get_tasks_page(1, 1, page.next_cursor, "success")
+    assert list(page.tasks.keys()) == ["3"]
+    assert page.tasks["3"]["result"] == {"images": "result_image_url"}
+    assert page.next_cursor is None
+
+    await manager.add_error("4", "out of memory")
+    page = await manager.get_tasks_page(1, 10, status="failed")
+    assert page.tasks["4"]["result"] == {"error": "out of memory"}
+
+    with pytest.raises(ValueError):
+        await manager.get_tasks_page(1, 1, "not a cursor")
+    with pytest.raises(ValueError):
+        await manager.get_tasks_page(1, 1, status="lost")
+
+
+@pytest.mark.asyncio
+async def test_memory_storage_retention():
+    engine = MemoryStorageEngine(max_completed=2, max_tasks_per_user=3)
+    manager = StorageManager(engine)
+    for i in range(3):
+        await manager.add_task(1, str(i), Task(TaskInfo(id=str(i), max_cost=1, time_to_money_ratio=10)))
+        await manager.add_result(str(i), "result_image_url")
+    await manager.add_task(1, "3", Task(TaskInfo(id="3", max_cost=1, time_to_money_ratio=10)))
+    await manager.add_task(2, "4", Task(TaskInfo(id="4", max_cost=1, time_to_money_ratio=10)))
+
+    # The user over the cap loses the oldest completed task
+    assert await manager.get_task_data("0") is None
+    assert list((await manager.get_tasks(1)).keys()) == ["1", "2", "3"]
+    assert manager.stats()["tasks"] == 4
+
+    # Completed tasks over the global limit go, failed ones count as
+    # completed, pending tasks stay
+    await manager.add_error("4", "out of memory")
+    assert (await manager.get_task_data("4"))["status"] == PublicTaskStatus.FAILED.name
+    assert engine.evict() == 1
+    assert await manager.get_task_data("1") is None
+    assert engine.evict() == 0
+    stats = manager.stats()
+    assert stats["tasks"] == 3
+    assert stats["completed_tasks"] == 2
+    assert stats["users"] == 2
+    assert stats["approximate_bytes"] > 0
+    page = await manager.get_tasks_page(1, 10)
+    assert list(page.tasks.keys()) == ["2", "3"]
+    await manager.close()
+
+
+def test_cursor_checked_before_filtering():
+    task_id = "0b9d808b-9894-4360-9e6c-d551120a420d"
+    assert decode_cursor(encode_cursor(1.5, task_id)) == (1.5, task_id)
+    assert _after_filter(1.5, task_id) == (
+        f"submitted_at.gt.1.5,and(submitted_at.eq.1.5,id.gt.{task_id})")
+
+    # A crafted cursor cannot add clauses to the filter
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor(float("nan"), task_id))
+    with pytest.raises(ValueError):
+        _after_filter(1.5, f"{task_id}),user_id.neq.(0")
+    with pytest.raises(ValueError):
+        _after_filter(1.5, task_id.upper())
+
+
+def test_users_storage():
+    users_storage = UsersStorage(max_cached_tokens=1)
+    uid1 = users_storage.get_user_id("token1")
+    uid2 = users_storage.get_user_id("token2")
+    assert uid1 != uid2
+    assert len(users_storage) == 1
+    assert users_storage.get_user_id("token1") == uid1
+
+
+@pytest.mark.asyncio
+async def test_add_tasks(manager):
+    uid = UsersStorage().get_user_id("token")
+    tasks = [Task(TaskInfo(id=str(i), max_cost=1, time_to_money_ratio=1)) for i in range(3)]
+    await manager.add_tasks(uid, tasks)
+
+    stored = await manager.get_tasks(uid)
+    assert sorted(stored) == ["0", "1", "2"]
+    assert all(task_data["status"] == PublicTaskStatus.PENDING.name for task_data in stored.values())
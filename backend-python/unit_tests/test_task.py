@@ -1,13 +1,17 @@
 import copy
 import sys
+import time
 sys.path.append("/backend-python/src")
 
 
 from dispatcher.task import build_task_from_query, Task
 from dispatcher.task_info import (
     ComfyPipelineOptions,
+    ScheduledPayload,
     StandardPipelineOptions,
     TaskOptions,
+    TaskStatus,
+    TaskStatusPayload,
 )
 
 COMMON_TASK_ID = "1"
@@ -69,3 +73,46 @@ def test_task_build_comfy():
             )
         }
     )
+
+
+def test_task_status_log():
+    task = build_task_from_query(COMMON_TASK_ID, **COMMON_TASK_DATA)
+    assert task.get_status_time(TaskStatus.SCHEDULED) is None
+
+    scheduled = ScheduledPayload(provider_id="p1", min_score=1, waiting_time=2)
+    task.set_status(TaskStatusPayload(task_status=TaskStatus.QUEUED))
+    task.set_status(scheduled)
+    task.set_status(TaskStatusPayload(task_status=TaskStatus.COMPLETED))
+
+    assert task.status == TaskStatus.COMPLETED
+    assert task.provider_id == "p1"
+    assert [log.task_status_payload for log in task.log] == [
+        TaskStatusPayload(task_status=TaskStatus.QUEUED),
+        scheduled,
+        TaskStatusPayload(task_status=TaskStatus.COMPLETED),
+    ]
+    assert task.get_status_time(TaskStatus.SCHEDULED) == task.log[1].date
+    assert task.get_status_time(TaskStatus.SCHEDULED) <= task.get_status_time(TaskStatus.COMPLETED)
+    assert "ASSIGNED TO PROVIDER: provider_id=p1" in task.get_log_string()
+
+
+def test_task_status_log_ignores_clock_jumps(monkeypatch):
+    task = build_task_from_query(COMMON_TASK_ID, **COMMON_TASK_DATA)
+    created_at = task.created_at
+    task.set_status(TaskStatusPayload(task_status=TaskStatus.QUEUED))
+
+    # The wall clock is set back an hour while the task waits
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now - 3600)
+    task.set_status(TaskStatusPayload(task_status=TaskStatus.COMPLETED))
+
+    queued_at = task.get_status_timestamp(TaskStatus.QUEUED)
+    assert 0 <= task.get_status_timestamp(TaskStatus.COMPLETED) - queued_at < 1
+    assert task.log[0].date <= task.log[1].date
+    assert (task.log[1].date - created_at).total_seconds() < 1
+
+
+def test_task_repeated_fields_interned():
+    first = build_task_from_query("1", standard_pipeline={"prompt": "a", "model": "".join(["SD", "2.1"])})
+    second = build_task_from_query("2", standard_pipeline={"prompt": "b", "model": "".join(["SD", "2.1"])})
+    assert first.task_options.standard_pipeline.model is second.task_options.standard_pipeline.model
@@ -0,0 +1,78 @@
+import sys
+sys.path.append("/backend-python/src")
+
+from write_behind import WriteBehindQueue
+
+import asyncio
+import pytest
+import threading
+
+pytest_plugins = ('pytest_asyncio',)
+
+
+def test_write_behind_queue():
+    written = []
+    can_write = threading.Event()
+
+    def write_rows(rows):
+        can_write.wait()
+        written.append([dict(row) for row in rows])
+
+    writes = WriteBehindQueue(write_rows, flush_interval=60)
+    writes.put_nowait({'id': '1', 'status': 1, 'info': 'a'})
+    writes.put_nowait({'id': '2', 'status': 1})
+    writes.put_nowait({'id': '1', 'status': 2})
+
+    # Updates of a row are merged and visible before they are written
+    assert writes.pending_row('1') == {'id': '1', 'status': 2, 'info': 'a'}
+    assert writes.pending_row('3') is None
+    assert len(writes.pending_rows()) == 2
+    assert written == []
+
+    can_write.set()
+    writes.flush()
+    assert written == [[{'id': '1', 'status': 2, 'info': 'a'},
+                        {'id': '2', 'status': 1}]]
+    assert len(writes) == 0
+
+    # Rows left are written on close
+    writes.put_nowait({'id': '3', 'status': 1})
+    writes.close()
+    assert written[-1] == [{'id': '3', 'status': 1}]
+
+
+def test_write_behind_queue_retries():
+    attempts = []
+
+    def write_rows(rows):
+        attempts.append([dict(row) for row in rows])
+        if len(attempts) == 1:
+            raise ConnectionError("database is not reachable")
+
+    writes = WriteBehindQueue(write_rows, flush_interval=0, retry_delay=0)
+    writes.put_nowait({'id': '1', 'status': 1})
+    writes.flush()
+    writes.close()
+    assert attempts == [[{'id': '1', 'status': 1}], [{'id': '1', 'status': 1}]]
+
+
+@pytest.mark.asyncio
+async def test_write_behind_queue_full():
+    can_write = threading.Event()
+    writes = WriteBehindQueue(lambda rows: can_write.wait(), flush_interval=60, max_pending_rows=1)
+    try:
+        await writes.put({'id': '1', 'status': 1})
+        assert not writes.put_nowait({'id': '2', 'status': 1})
+        # The full queue is flushed, the put waits until the row is taken
+        await asyncio.wait_for(writes.put({'id': '2', 'status': 1}), 1)
+
+        # The event loop keeps running while the put waits for the database
+        put = asyncio.ensure_future(writes.put({'id': '3', 'status': 1}))
+        await asyncio.sleep(0.05)
+        assert not put.done()
+        can_write.set()
+        await asyncio.wait_for(put, 1)
+        assert writes.pending_row('3') == {'id': '3', 'status': 1}
+    finally:
+        can_write.set()
+        writes.close()
@@ -5,7 +5,9 @@ import json
 sys.path.append("/backend-python/src")
 
 from dispatcher.task import build_task_from_query
-from ws_connection import WSConnection
+from blob_store import BlobStore
+from ws_connection import WSConnection, BATCH_FEATURE, BLOBS_FEATURE, ComfyOptionsPayloads, encode_task
+import ws_connection as ws_connection_module
 
 COMMON_TASK_ID = "1"
 COMMON_TASK_DATA = {"max_cost": 15, "time_to_money_ratio": 1}
@@ -19,6 +21,9 @@ class WSConnectionEchoMock:
     async def send_json(self, payload):
         self.payload = json.dumps(payload)
 
+    async def send_text(self, text):
+        self.payload = text
+
     async def recv(self) -> str:
         payload = self.payload
         self.payload = ""
@@ -44,7 +49,7 @@ async def test_ws_connection_valid_schema_standard():
     await ws_connection.send_task(task)
     assert (
         await echo.recv()
-        == """{"taskId": "1", "options": {"prompt": "space surfer", "model": "SD2.1", "size": {"height": 512, "width": 512}, "steps": null}, "comfyOptions": null}"""
+        == """{"taskId":"1","options":{"prompt":"space surfer","model":"SD2.1","size":{"height":512,"width":512},"steps":null},"comfyOptions":null}"""
     )
 
 @pytest.mark.asyncio
@@ -83,7 +88,7 @@ async def test_ws_connection_valid_schema_comfy():
     await ws_connection.send_task(task)
     assert (
         await echo.recv()
-        == """{"taskId": "1", "options": null, "comfyOptions": {"pipelineData": "somePipeline", "pipelineDependencies": {"images": "imageNameToImage map"}}}"""
+        == """{"taskId":"1","options":null,"comfyOptions":{"pipelineData":"somePipeline","pipelineDependencies":{"images":"imageNameToImage map"}}}"""
     )
 
 @pytest.mark.asyncio
@@ -101,3 +106,76 @@ async def test_ws_connection_invalid_schema_comfy():
     ws_connection = WSConnection(echo)
     await ws_connection.send_task(task)
     assert await echo.recv() == ""
+
+@pytest.mark.asyncio
+async def test_ws_connection_send_tasks_batch():
+    tasks = []
+    for task_id in ("1", "2"):
+        task_data = copy.deepcopy(COMMON_TASK_DATA)
+        task_data["comfy_pipeline"] = {
+            "pipelineData": "somePipeline",
+            "pipelineDependencies": None,
+        }
+        tasks.append(build_task_from_query(task_id, **task_data))
+
+    echo = WSConnectionEchoMock()
+    ws_connection = WSConnection(echo, features=[BATCH_FEATURE])
+    assert ws_connection.supports_batching
+    await ws_connection.send_tasks(tasks)
+    assert (
+        await echo.recv()
+        == """{"type":"tasks","tasks":[{"taskId":"1","options":null,"comfyOptions":{"pipelineData":"somePipeline","pipelineDependencies":null}},{"taskId":"2","options":null,"comfyOptions":{"pipelineData":"somePipeline","pipelineDependencies":null}}]}"""
+    )
+
+@pytest.mark.asyncio
+async def test_ws_connection_reuses_encoded_pipeline():
+    store = BlobStore()
+    tasks = []
+    for task_id in ("1", "2"):
+        task_data = copy.deepcopy(COMMON_TASK_DATA)
+        task_data["comfy_pipeline"] = {
+            "pipelineData": "somePipeline",
+            "pipelineDependencies": None,
+        }
+        tasks.append(build_task_from_query(task_id, **task_data))
+        store.add_pipeline(tasks[-1].task_options.comfy_pipeline)
+
+    echo = WSConnectionEchoMock()
+    ws_connection = WSConnection(echo)
+    payloads = ComfyOptionsPayloads()
+    encoded = [payloads.get(task.task_options.comfy_pipeline, False) for task in tasks]
+    assert encoded[0] is encoded[1]
+    assert encoded[0][0].text == '{"pipelineData":"somePipeline","pipelineDependencies":null}'
+    assert encoded[0][1] is None
+
+    # A resend produces the same frame
+    for _ in range(2):
+        await ws_connection.send_task(tasks[0])
+        assert (
+            await echo.recv()
+            == """{"taskId":"1","options":null,"comfyOptions":{"pipelineData":"somePipeline","pipelineDependencies":null}}"""
+        )
+
+
+@pytest.mark.asyncio
+async def test_ws_connection_sends_options_encoded_on_submission(monkeypatch):
+    task_data = copy.deepcopy(COMMON_TASK_DATA)
+    task_data["comfy_pipeline"] = {"pipelineData": "somePipeline", "pipelineDependencies": None}
+    task = build_task_from_query(COMMON_TASK_ID, **task_data)
+    BlobStore().add_pipeline(task.task_options.comfy_pipeline)
+    encoded = encode_task(task)
+    assert task.node_payload is encoded and encoded.error is None
+
+    # Sends reuse the options validated and encoded on submission
+    def schema_error(validator, value):
+        raise AssertionError("validated again")
+    monkeypatch.setattr(ws_connection_module, "schema_error", schema_error)
+
+    echo = WSConnectionEchoMock()
+    await WSConnection(echo).send_task(task)
+    assert json.loads(await echo.recv())["comfyOptions"] == {
+        "pipelineData": "somePipeline", "pipelineDependencies": None}
+    await WSConnection(echo, [BLOBS_FEATURE]).send_task(task)
+    assert json.loads(await echo.recv())["comfyOptions"] == {
+        "pipelineDataHash": task.task_options.comfy_pipeline.pipeline_data_hash,
+        "pipelineDependenciesHash": task.task_options.comfy_pipeline.pipeline_dependencies_hash}
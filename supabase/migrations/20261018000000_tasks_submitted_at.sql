@@ -0,0 +1,8 @@
+-- Tasks are paged by (submitted_at, id), submitted_at holds the seconds
+-- since the epoch the task was submitted at. Rows written before the
+-- column existed sort first, as they do in the SQLite engine.
+ALTER TABLE "TasksV1_tests"
+    ADD COLUMN IF NOT EXISTS submitted_at DOUBLE PRECISION NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS "TasksV1_tests_user_submitted_at"
+    ON "TasksV1_tests" (user_id, submitted_at, id);